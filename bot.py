@@ -11,335 +11,3520 @@ from dotenv import load_dotenv
 load_dotenv()
 
 import asyncio
+import atexit
+import contextvars
+import html
+import json
 import logging
+import logging.handlers
+import math
+import queue
+import random
 import sqlite3
+import threading
 import time
 import re
 import os
+import heapq
+import signal
+import bisect
+import collections
+import functools
+import contextlib
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 
 from aiogram import Bot, Dispatcher, F, types
 from aiogram.filters import Command
-from aiogram.types import Message
+from aiogram.types import (
+    BufferedInputFile, Message, InputMediaAudio, InputMediaDocument, InputMediaPhoto, InputMediaVideo
+)
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+import aiogram.methods
+from aiogram.methods import (
+    CopyMessage, CopyMessages, SendDocument, SendMediaGroup, SendMessage, TelegramMethod
+)
+from aiogram.client.default import Default
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+try:
+    import asyncpg  # optional: only needed for the PostgreSQL backend (DATABASE_URL)
+except ImportError:
+    asyncpg = None
+
+# ======================== Configuration (Environment Variables) ========================
+# Required environment variables:
+#   TELEGRAM_BOT_TOKEN - Your bot token from @BotFather
+#   STAFF_GROUP_ID - Staff group ID (negative integer for groups)
+#   ADMIN_USER_ID - Admin's Telegram user ID (positive integer)
+#
+# Example usage:
+#   TELEGRAM_BOT_TOKEN=123456:ABC-DEF... STAFF_GROUP_ID=-1001234567890 ADMIN_USER_ID=123456789 python bot.py
+# =======================================================================================
+
+def get_env_config():
+    """Load and validate configuration from environment variables"""
+    # Get API_TOKEN
+    api_token = os.getenv('TELEGRAM_BOT_TOKEN')
+    if not api_token:
+        raise ValueError("Environment variable TELEGRAM_BOT_TOKEN is required but not set")
+    
+    # Get STAFF_GROUP_ID
+    staff_group_id_str = os.getenv('STAFF_GROUP_ID')
+    if not staff_group_id_str:
+        raise ValueError("Environment variable STAFF_GROUP_ID is required but not set")
+    
+    try:
+        staff_group_id = int(staff_group_id_str)
+    except ValueError:
+        raise ValueError(f"STAFF_GROUP_ID must be a valid integer, got: {staff_group_id_str}")
+    
+    # Get ADMIN_USER_ID
+    admin_user_id_str = os.getenv('ADMIN_USER_ID')
+    if not admin_user_id_str:
+        raise ValueError("Environment variable ADMIN_USER_ID is required but not set")
+    
+    try:
+        admin_user_id = int(admin_user_id_str)
+    except ValueError:
+        raise ValueError(f"ADMIN_USER_ID must be a valid integer, got: {admin_user_id_str}")
+    
+    return api_token, staff_group_id, admin_user_id
+
+
+def validate_webhook_config():
+    """Validate update delivery settings (BOT_MODE and webhook options)"""
+    if BOT_MODE not in ('polling', 'webhook'):
+        raise ValueError(f"BOT_MODE must be 'polling' or 'webhook', got: {BOT_MODE}")
+    if BOT_MODE != 'webhook':
+        return
+    if not re.fullmatch(r'[A-Za-z0-9_-]{1,256}', WEBHOOK_SECRET):
+        raise ValueError(
+            "WEBHOOK_SECRET is required when BOT_MODE=webhook "
+            "(1-256 characters: A-Z, a-z, 0-9, _ and -)"
+        )
+    if WEBHOOK_REGISTER and not WEBHOOK_URL.startswith('https://'):
+        raise ValueError(f"WEBHOOK_URL must be a public https:// URL, got: {WEBHOOK_URL or '(not set)'}")
+
+
+def get_int_env(name: str, default: int) -> int:
+    """Read an optional integer setting from environment variables"""
+    value = os.getenv(name)
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"{name} must be a valid integer, got: {value}")
+
+
+# Load configuration
+API_TOKEN, STAFF_GROUP_ID, ADMIN_USER_ID = get_env_config()
+
+# Update delivery: 'polling' (default) or 'webhook' (aiohttp server, e.g. behind a load balancer)
+BOT_MODE = os.getenv('BOT_MODE', 'polling').strip().lower()
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '').rstrip('/')           # Public base URL, e.g. https://bot.example.com
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')                 # Checked against X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = get_int_env('WEBHOOK_PORT', 8080)
+WEBHOOK_MAX_CONNECTIONS = get_int_env('WEBHOOK_MAX_CONNECTIONS', 40)
+WEBHOOK_REGISTER = os.getenv('WEBHOOK_REGISTER', '1') != '0'      # 0 = skip setWebhook (local testing)
+validate_webhook_config()
+
+# Optional: re-resolve bot username periodically (seconds, 0 = only at startup)
+BOT_IDENTITY_REFRESH_SECONDS = get_int_env('BOT_IDENTITY_REFRESH_SECONDS', 0)
+
+# Outbound flood control (Telegram allows ~30 msg/s overall, ~20 msg/min per group)
+OUTBOUND_GLOBAL_RATE = get_int_env('OUTBOUND_GLOBAL_RATE', 30)          # messages per second
+OUTBOUND_GROUP_RATE = get_int_env('OUTBOUND_GROUP_RATE', 20)            # messages per minute per group
+OUTBOUND_GROUP_BURST = get_int_env('OUTBOUND_GROUP_BURST', 5)           # back-to-back sends per group
+OUTBOUND_MAX_IN_FLIGHT = get_int_env('OUTBOUND_MAX_IN_FLIGHT', 16)      # concurrent Bot API calls
+OUTBOUND_MAX_ATTEMPTS = get_int_env('OUTBOUND_MAX_ATTEMPTS', 5)         # per send, incl. RetryAfter
+
+# Durable outbox (staff replies, ticket wrappers, continuations): retry rounds with exponential
+# backoff before a call is dead-lettered, and how long finished rows keep their idempotency key
+OUTBOX_MAX_ATTEMPTS = get_int_env('OUTBOX_MAX_ATTEMPTS', 8)
+OUTBOX_RETENTION_HOURS = get_int_env('OUTBOX_RETENTION_HOURS', 48)
+
+# Texts over one Telegram message are sent in up to this many parts; longer ones as a .txt document
+LONG_TEXT_MAX_PARTS = max(get_int_env('LONG_TEXT_MAX_PARTS', 4), 1)
+
+# Abuse throttling (opt-in): new tickets and /t messages per user and per customer group
+# within a sliding window (0 = no limit); replies to an open ticket are never throttled
+THROTTLE_USER_LIMIT = get_int_env('THROTTLE_USER_LIMIT', 0)
+THROTTLE_GROUP_LIMIT = get_int_env('THROTTLE_GROUP_LIMIT', 0)
+THROTTLE_WINDOW_SECONDS = max(get_int_env('THROTTLE_WINDOW_SECONDS', 60), 1)
+# A mention within this many seconds of the user's last ticket message continues that ticket (0 = off)
+TICKET_MERGE_SECONDS = get_int_env('TICKET_MERGE_SECONDS', 0)
+
+# Album items arrive as separate updates; wait this long after the last one before handling the album
+ALBUM_WINDOW_MS = get_int_env('ALBUM_WINDOW_MS', 800)
+
+# Text replies of one customer to one ticket arriving within this window go to staff as one message
+# (opt-in: every text reply then waits the window before it reaches staff; 0 = off)
+CONTINUATION_COALESCE_MS = get_int_env('CONTINUATION_COALESCE_MS', 0)
+
+# Ticket texts are written to the search index in batches: every interval, or sooner at the batch size
+SEARCH_INDEX_INTERVAL_MS = get_int_env('SEARCH_INDEX_INTERVAL_MS', 1000)
+SEARCH_INDEX_BATCH_SIZE = get_int_env('SEARCH_INDEX_BATCH_SIZE', 200)
+
+# Updates processed in parallel (updates of one chat / ticket thread still run in order)
+MAX_CONCURRENT_UPDATES = get_int_env('MAX_CONCURRENT_UPDATES', 32)
+
+# On SIGTERM, in-flight updates and queued sends get this long to finish
+SHUTDOWN_TIMEOUT_SECONDS = get_int_env('SHUTDOWN_TIMEOUT_SECONDS', 20)
+
+# Optional: Prometheus metrics endpoint (0 = disabled, no instrumentation installed)
+METRICS_PORT = get_int_env('METRICS_PORT', 0)
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+
+# Optional: Bot API server base URL (local Bot API server or tools/fake_bot_api.py; empty = api.telegram.org)
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', '').rstrip('/')
+
+# Logging: 'text' (default) or 'json' (one object per line with update/ticket context fields)
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text').strip().lower()
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').strip().upper()
+LOG_FILE = os.getenv('LOG_FILE', '')                                  # empty = stderr
+LOG_QUEUE_SIZE = get_int_env('LOG_QUEUE_SIZE', 10000)                 # records waiting for the log thread
+LOG_DEBUG_SAMPLE_PERCENT = get_int_env('LOG_DEBUG_SAMPLE_PERCENT', 100)  # share of DEBUG records kept
+if LOG_FORMAT not in ('text', 'json'):
+    raise ValueError(f"LOG_FORMAT must be 'text' or 'json', got: {LOG_FORMAT}")
+
+
+# ======================== Logging ========================
+
+LOG_TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Fields of the update / ticket being handled, attached to every record logged meanwhile
+LOG_CONTEXT_FIELDS = ('update_id', 'chat_id', 'user_id', 'ticket_id')
+log_context = contextvars.ContextVar('log_context', default={})
+
+
+def bind_log_context(**fields):
+    """Add fields (e.g. ticket_id) to the log records of the current update"""
+    log_context.set({**log_context.get(), **fields})
+
+
+class LogContextFilter(logging.Filter):
+    """Copies the log context onto each record and samples DEBUG records"""
+
+    def __init__(self, debug_sample_percent: int = 100):
+        super().__init__()
+        self.debug_sample_rate = debug_sample_percent / 100
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno <= logging.DEBUG and random.random() >= self.debug_sample_rate:
+            return False
+        for name, value in log_context.get().items():
+            if not hasattr(record, name):  # extra={...} of the call wins
+                setattr(record, name, value)
+        return True
+
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message and context fields"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for name in LOG_CONTEXT_FIELDS:
+            value = getattr(record, name, None)
+            if value is not None:
+                entry[name] = value
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to the log thread without formatting or I/O on the event loop
+
+    The standard QueueHandler formats the record in prepare(); here only the
+    message arguments are merged (they may change after the call returns),
+    timestamps, JSON and tracebacks are rendered by the listener thread.
+    When the queue is full (output blocked) records are dropped and counted
+    instead of stalling the caller.
+    """
+
+    def __init__(self, records: queue.Queue):
+        super().__init__(records)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(level: str = LOG_LEVEL, fmt: str = LOG_FORMAT, log_file: str = LOG_FILE,
+                  queue_size: int = LOG_QUEUE_SIZE, debug_sample_percent: int = LOG_DEBUG_SAMPLE_PERCENT):
+    """
+    Route all log records through a bounded queue to a background writer thread
+    
+    Returns:
+        (queue handler, listener)
+    """
+    output = logging.FileHandler(log_file, encoding='utf-8') if log_file else logging.StreamHandler()
+    output.setFormatter(JsonLogFormatter() if fmt == 'json' else logging.Formatter(LOG_TEXT_FORMAT))
+    records = queue.Queue(maxsize=queue_size)
+    handler = LogQueueHandler(records)
+    handler.addFilter(LogContextFilter(debug_sample_percent))
+    
+    root = logging.getLogger()
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+    
+    listener = logging.handlers.QueueListener(records, output, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)  # writes out the records still queued
+    return handler, listener
+
+
+log_handler, log_listener = setup_logging()
+logger = logging.getLogger(__name__)
+
+
+# ======================== Metrics ========================
+
+# Latency buckets in seconds (Bot API calls are 50-500 ms, DB calls well under 1 ms)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = '') -> str:
+    """Render a Prometheus label set, e.g. {method="sendMessage"}"""
+    pairs = [
+        f'{name}="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+        for name, value in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    """Monotonic counter with optional labels"""
+
+    def __init__(self, registry: 'MetricsRegistry', name: str, help_text: str, labels: tuple = ()):
+        self.registry = registry
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values = {}
+
+    def inc(self, *label_values, amount: float = 1):
+        if not self.registry.enabled:
+            return
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for label_values, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Histogram:
+    """Latency histogram with fixed buckets and optional labels"""
+
+    def __init__(self, registry: 'MetricsRegistry', name: str, help_text: str,
+                 labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.registry = registry
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}   # label values -> [per-bucket counts (last is +Inf), sum]
+
+    def observe(self, value: float, *label_values):
+        if not self.registry.enabled:
+            return
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def totals(self) -> dict:
+        """Observation count and sum per label set, e.g. {('save_ticket',): (120, 0.031)}"""
+        return {labels: (sum(counts), total) for labels, (counts, total) in self._series.items()}
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for label_values, (counts, total) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                le = _format_labels(self.labels, label_values, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            labels = _format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Gauge:
+    """Gauge whose value is read from a callback at scrape time"""
+
+    def __init__(self, name: str, help_text: str, read):
+        self.name = name
+        self.help_text = help_text
+        self.read = read
+
+    def render(self) -> list:
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge",
+                f"{self.name} {self.read()}"]
+
+
+class MetricsRegistry:
+    """
+    In-process metrics in the Prometheus text format
+
+    When disabled, recording is a single attribute check and the timing
+    middlewares/decorators are not installed at all.
+    """
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self._metrics = []
+
+    def counter(self, name: str, help_text: str, labels: tuple = ()) -> Counter:
+        metric = Counter(self, name, help_text, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help_text: str, labels: tuple = ()) -> Histogram:
+        metric = Histogram(self, name, help_text, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name: str, help_text: str, read) -> Gauge:
+        metric = Gauge(name, help_text, read)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry(enabled=METRICS_PORT > 0)
+
+HANDLER_SECONDS = metrics.histogram('bot_handler_seconds', 'Update handler duration', ('handler',))
+HANDLER_ERRORS = metrics.counter('bot_handler_errors_total', 'Unhandled handler exceptions', ('handler',))
+API_SECONDS = metrics.histogram('bot_api_seconds', 'Bot API call latency', ('method',))
+API_ERRORS = metrics.counter('bot_api_errors_total', 'Failed Bot API calls', ('method', 'error'))
+DB_SECONDS = metrics.histogram('bot_db_seconds', 'Ticket store call latency', ('op',))
+DB_COMMITS = metrics.counter('bot_db_commits_total', 'SQLite group commits')
+DB_COMMITTED_WRITES = metrics.counter('bot_db_committed_writes_total', 'Store writes carried by group commits')
+SEND_RETRIES = metrics.counter('bot_send_retries_total', 'Send queue retries', ('reason',))
+OUTBOX_EVENTS = metrics.counter('bot_outbox_calls_total', 'Durable outbox call outcomes', ('event',))
+TICKET_EVENTS = metrics.counter('bot_tickets_total', 'Ticket lifecycle events', ('event',))
+COALESCED = metrics.counter('bot_continuations_coalesced_total', 'Customer text replies merged into another staff post')
+THROTTLED = metrics.counter('bot_throttled_total', 'Customer messages dropped by abuse throttling', ('scope',))
+RETENTION_ARCHIVED = metrics.counter('bot_retention_archived_total', 'Rows moved to the archive database', ('table',))
+RETENTION_RECLAIMED = metrics.counter('bot_retention_reclaimed_bytes_total', 'Bytes released by compaction')
+COPY_FALLBACKS = metrics.counter('bot_copy_fallbacks_total', 'Media copies that needed a fallback path', ('path',))
+metrics.gauge('bot_log_records_dropped', 'Log records dropped because the log queue was full', lambda: log_handler.dropped)
+
+
+def timed(histogram: Histogram, label: Optional[str] = None):
+    """Decorator recording the duration of an async function (returns it unchanged when metrics are off)"""
+    def decorate(fn):
+        if not metrics.enabled:
+            return fn
+        name = label or fn.__name__
+        
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, name)
+        return wrapper
+    return decorate
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    """Prometheus scrape endpoint"""
+    return web.Response(
+        body=metrics.render().encode(),
+        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+    )
+
+
+async def start_metrics_server() -> web.AppRunner:
+    """Serve /metrics on METRICS_HOST:METRICS_PORT"""
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    logger.info("Metrics endpoint listening on %s:%s/metrics", METRICS_HOST, METRICS_PORT)
+    return runner
+
+
+# Database filename (DB_PATH overrides, e.g. for load tests)
+DB_NAME = os.getenv('DB_PATH', 'tickets.db')
+
+# Optional: shared PostgreSQL database for several bot instances (empty = SQLite at DB_PATH)
+DATABASE_URL = os.getenv('DATABASE_URL', '').strip()
+DB_POOL_SIZE = get_int_env('DB_POOL_SIZE', 10)                      # max PostgreSQL connections per instance
+# Customer groups added on another instance become visible after this many seconds
+GROUP_CACHE_REFRESH_SECONDS = get_int_env('GROUP_CACHE_REFRESH_SECONDS', 60)
+
+# Number of reader threads (each holds its own SQLite connection)
+DB_READER_THREADS = 2
+
+# Ticket IDs reserved per database round trip
+TICKET_ID_BLOCK_SIZE = get_int_env('TICKET_ID_BLOCK_SIZE', 10)
+
+# Group commit: SQLite writes queued within this window share one transaction (at most DB_COMMIT_MAX_OPS)
+DB_COMMIT_WINDOW_MS = get_int_env('DB_COMMIT_WINDOW_MS', 0)
+DB_COMMIT_MAX_OPS = get_int_env('DB_COMMIT_MAX_OPS', 256)
+
+# Ticket retention: closed tickets older than this move to the archive database (0 = keep forever)
+TICKET_RETENTION_DAYS = get_int_env('TICKET_RETENTION_DAYS', 0)
+RETENTION_INTERVAL_SECONDS = get_int_env('RETENTION_INTERVAL_SECONDS', 6 * 3600)
+RETENTION_BATCH_SIZE = get_int_env('RETENTION_BATCH_SIZE', 500)    # tickets per write transaction
+ARCHIVE_DB_PATH = os.getenv('ARCHIVE_DB_PATH', os.path.splitext(DB_NAME)[0] + '_archive.db')
+
+
+# ======================== Database Operations ========================
+
+TICKET_COLUMNS = (
+    'staff_msg_id, ticket_id, cust_group_id, cust_msg_id, user_id, username, '
+    'customer_anchor_msg_id, status, closed_at, created_at'
+)
+
+
+class TicketStore(ABC):
+    """
+    Ticket storage interface with an awaitable API
+
+    Handlers only call these methods, so the backend (SQLiteTicketStore by
+    default, PostgresTicketStore for DATABASE_URL) is picked by configuration.
+    The storage methods are abstract: a backend missing one fails when it is
+    created, not on first use.
+
+    The customer group set is loaded once at open() and kept in memory;
+    add/remove update it write-through, so the per-message group check
+    needs no I/O. Backends shared by several bot instances (shared=True)
+    re-read it periodically to pick up changes made by the other instances.
+
+    Ticket IDs are allocated from blocks reserved in the id_sequences table
+    (hi/lo): one round trip reserves id_block_size IDs, so IDs are short,
+    increasing and unique across bot processes sharing the database.
+    """
+
+    shared = False  # True when other bot instances may write the same database
+
+    def __init__(self, id_block_size: int = TICKET_ID_BLOCK_SIZE):
+        self.id_block_size = id_block_size
+        self._next_id = 0
+        self._id_block_end = 0
+        self._id_lock: Optional[asyncio.Lock] = None
+        self._customer_groups = set()
+
+    @abstractmethod
+    async def open(self):
+        """Connect, apply pending schema migrations and load customer groups"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def close(self):
+        """Wait for pending operations and release all connections"""
+        raise NotImplementedError
+
+    @property
+    def pending_writes(self) -> int:
+        """Writes accepted but not yet committed"""
+        return 0
+
+    async def _load_caches(self):
+        """Prepare the in-memory state (called at the end of open())"""
+        self._id_lock = asyncio.Lock()
+        await self.refresh_customer_groups()
+        logger.info("Loaded %s customer groups", len(self._customer_groups))
+
+    # ---------- Customer groups ----------
+
+    def is_customer_group(self, group_id: int) -> bool:
+        """Check if group is in customer groups list (in-memory, no I/O)"""
+        return group_id in self._customer_groups
+
+    def get_all_customer_groups(self) -> list:
+        """Get all customer group IDs"""
+        return sorted(self._customer_groups)
+
+    async def refresh_customer_groups(self):
+        """Re-read the customer group set from the database"""
+        self._customer_groups = await self._select_customer_groups()
+
+    async def refresh_groups_forever(self, interval: int):
+        """Periodically re-read customer groups (changes made by other instances)"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.refresh_customer_groups()
+            except Exception as e:
+                logger.warning("Failed to refresh customer groups: %s", e)
+
+    @timed(DB_SECONDS)
+    async def add_customer_group(self, group_id: int) -> bool:
+        """Add customer group"""
+        try:
+            await self._insert_customer_group(group_id)
+            self._customer_groups.add(group_id)
+            return True
+        except Exception as e:
+            logger.error("Failed to add customer group: %s", e)
+            return False
+
+    @timed(DB_SECONDS)
+    async def remove_customer_group(self, group_id: int) -> bool:
+        """Remove customer group"""
+        try:
+            await self._delete_customer_group(group_id)
+            self._customer_groups.discard(group_id)
+            return True
+        except Exception as e:
+            logger.error("Failed to remove customer group: %s", e)
+            return False
+
+    @abstractmethod
+    async def _select_customer_groups(self) -> set:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def _insert_customer_group(self, group_id: int):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def _delete_customer_group(self, group_id: int):
+        raise NotImplementedError
+
+    # ---------- Tickets ----------
+
+    @abstractmethod
+    async def _reserve_ids(self, name: str, count: int) -> int:
+        """Reserve `count` consecutive IDs from a sequence, returns the first one"""
+        raise NotImplementedError
+
+    @timed(DB_SECONDS)
+    async def next_ticket_id(self) -> int:
+        """Allocate a unique ticket ID (hits the database once per block)"""
+        while self._next_id >= self._id_block_end:
+            async with self._id_lock:
+                if self._next_id >= self._id_block_end:
+                    start = await self._reserve_ids('ticket', self.id_block_size)
+                    self._next_id, self._id_block_end = start, start + self.id_block_size
+        ticket_id = self._next_id
+        self._next_id += 1
+        return ticket_id
+
+    @abstractmethod
+    async def save_ticket(self, staff_msg_id: int, ticket_id: int, cust_group_id: int,
+                          cust_msg_id: int, user_id: int, username: str):
+        """Save ticket mapping and its wrapper message map row (staff_msg_id is wrapper message ID)"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_ticket(self, staff_msg_id: int) -> Optional[dict]:
+        """Get ticket info by staff group wrapper message ID"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_ticket_by_id(self, ticket_id: int) -> Optional[dict]:
+        """Get ticket info by ticket_id (for /t command)"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_ticket_by_message(self, chat_id: int, message_id: int) -> Optional[dict]:
+        """Get ticket info by any message of its thread (staff or customer chat)"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def add_ticket_messages(self, ticket_id: int, chat_id: int, message_ids: list, kind: str):
+        """Record messages of a ticket thread (append-only, duplicates ignored)"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def update_customer_anchor(self, staff_msg_id: int, customer_anchor_msg_id: int,
+                                     extra_message_ids: list = ()):
+        """Update the customer anchor and map it (plus extra_message_ids) to the ticket"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def close_ticket_by_staff_msg_id(self, staff_msg_id: int) -> bool:
+        """Close ticket (by staff group wrapper message ID)"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def reopen_ticket_by_staff_msg_id(self, staff_msg_id: int) -> bool:
+        """Reopen ticket (by staff group wrapper message ID)"""
+        raise NotImplementedError
+
+    # ---------- Statistics ----------
+    # Per-group counters are updated in the same transaction as the ticket
+    # change, so the staff dashboard never scans the tickets table.
+
+    @abstractmethod
+    async def get_group_stats(self) -> list:
+        """Per-group counters: [{'cust_group_id', 'open_tickets', 'total_tickets'}, ...]"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_oldest_open_tickets(self, limit: int) -> list:
+        """The `limit` longest-waiting open tickets, oldest first (by created_at, then ticket_id)"""
+        raise NotImplementedError
+
+    # ---------- Search ----------
+
+    @abstractmethod
+    async def index_ticket_texts(self, rows: list):
+        """Add (ticket_id, kind, author, body, created_at) rows to the search index in one transaction"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def search_tickets(self, terms: list, limit: int) -> list:
+        """Texts containing all terms, best match first: [{'ticket_id', 'body', 'status', 'username'}, ...]"""
+        raise NotImplementedError
+
+    # ---------- Outbox ----------
+    # Durable Bot API calls. A row is written before the first attempt and is
+    # finished (sent together with its follow-up action, or dead) in one
+    # transaction. Times are in ms; a pending row is retried once due_at passes.
+    # Follow-up actions ({'kind': ..., ...}) applied when the call is sent:
+    #   ticket        save the ticket, the first sent message is its wrapper
+    #   staff_reply   the first sent message is the new customer anchor
+    #   continuation  map the sent messages to the ticket
+    #   map           map the sent messages to the ticket as action['as'] (in chat action['chat_id'])
+    # An action may also list 'follow_ups' ({'key', 'method', 'payload', 'priority',
+    # 'action'}): calls recorded, due now, in the same transaction when the outbox
+    # worker delivers the call - in reply to its first sent message where the call
+    # can reply and its payload does not reply elsewhere. A handler that gets the
+    # call through posts them itself.
+
+    @abstractmethod
+    async def add_outbox_call(self, key: str, method: str, payload: str, priority: int,
+                              action: Optional[dict], due_at: int) -> Optional[int]:
+        """Record a call, returns its outbox ID (None if the idempotency key is already taken)"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def save_unsent_calls(self, rows: list):
+        """Store (method, payload, priority, created_at) rows left in the send queue at shutdown, due now"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def claim_outbox_calls(self, now: int, lease_until: int, limit: int) -> list:
+        """
+        Pending calls due at `now`, oldest first, not due again before lease_until:
+        [{'id', 'method', 'payload', 'priority', 'attempts', 'action'}, ...]
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    async def finish_outbox_call(self, outbox_id: int, message_ids: list, action: Optional[dict], now: int):
+        """Mark a call sent and apply its follow-up action (skipped if it was finished already)"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def retry_outbox_call(self, outbox_id: int, attempts: int, due_at: int, error: str):
+        """Record a failed round, the call is retried at due_at"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def fail_outbox_call(self, outbox_id: int, attempts: int, error: str, now: int):
+        """Give up on a call (dead letter)"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def release_outbox_calls(self, outbox_ids: list):
+        """Make calls this instance stopped working on due now"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def purge_outbox(self, finished_before: int) -> int:
+        """Delete sent and dead calls finished before `finished_before`, returns rows deleted"""
+        raise NotImplementedError
+
+    # ---------- Maintenance ----------
+
+    @abstractmethod
+    async def archive_closed_tickets(self, closed_before: int, batch_size: int) -> tuple:
+        """Archive up to batch_size tickets closed before `closed_before` (ms), returns (tickets, messages)"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def compact(self) -> int:
+        """Release free space after archiving, returns bytes reclaimed"""
+        raise NotImplementedError
+
+
+def outbox_follow_up_rows(action: dict, message_ids: list, now: int) -> list:
+    """Insert parameters of an action's follow-up calls (see TicketStore), in reply to the first sent message"""
+    rows = []
+    for follow_up in action.get('follow_ups', ()):
+        payload = json.loads(follow_up['payload'])
+        if 'reply_to_message_id' in getattr(aiogram.methods, follow_up['method']).model_fields:
+            payload.setdefault('reply_to_message_id', message_ids[0])
+        rows.append((
+            follow_up['key'], follow_up['method'], json.dumps(payload, ensure_ascii=False), follow_up['priority'],
+            json.dumps(follow_up['action']) if follow_up['action'] else None, now, now
+        ))
+    return rows
+
+
+# ---------- SQLite backend ----------
+
+# SQL statements are kept as constants so sqlite3's statement cache reuses
+# the prepared statement on every call instead of re-parsing the query.
+SQL_SELECT_ALL_GROUPS = 'SELECT group_id FROM customer_groups'
+SQL_INSERT_GROUP = 'INSERT OR IGNORE INTO customer_groups (group_id) VALUES (?)'
+SQL_DELETE_GROUP = 'DELETE FROM customer_groups WHERE group_id = ?'
+
+SQL_INSERT_TICKET = '''
+    INSERT INTO tickets
+    (staff_msg_id, ticket_id, cust_group_id, cust_msg_id, user_id, username,
+     customer_anchor_msg_id, status, closed_at, created_at)
+    VALUES (?, ?, ?, ?, ?, ?, NULL, 'open', NULL, ?)
+'''
+SQL_SELECT_TICKET_BY_STAFF_MSG = f'SELECT {TICKET_COLUMNS} FROM tickets WHERE staff_msg_id = ?'
+SQL_SELECT_TICKET_BY_ID = f'SELECT {TICKET_COLUMNS} FROM tickets WHERE ticket_id = ?'
+SQL_UPDATE_ANCHOR = 'UPDATE tickets SET customer_anchor_msg_id = ? WHERE staff_msg_id = ?'
+SQL_CLOSE_TICKET = "UPDATE tickets SET status = 'closed', closed_at = ? WHERE staff_msg_id = ? AND status = 'open'"
+SQL_REOPEN_TICKET = "UPDATE tickets SET status = 'open', closed_at = NULL WHERE staff_msg_id = ? AND status = 'closed'"
+
+# Dashboard counters, maintained by save/close/reopen (closed = total - open, archived tickets included)
+SQL_COUNT_NEW_TICKET = '''
+    INSERT INTO group_stats (cust_group_id, open_tickets, total_tickets) VALUES (?, 1, 1)
+    ON CONFLICT (cust_group_id) DO UPDATE
+    SET open_tickets = open_tickets + 1, total_tickets = total_tickets + 1
+'''
+SQL_COUNT_OPEN_DELTA = '''
+    UPDATE group_stats SET open_tickets = open_tickets + ?
+    WHERE cust_group_id = (SELECT cust_group_id FROM tickets WHERE staff_msg_id = ?)
+'''
+SQL_SELECT_GROUP_STATS = 'SELECT cust_group_id, open_tickets, total_tickets FROM group_stats'
+SQL_SELECT_OLDEST_OPEN = (
+    f"SELECT {TICKET_COLUMNS} FROM tickets WHERE status = 'open' "
+    "ORDER BY COALESCE(created_at, 0), ticket_id LIMIT ?"
+)
+
+# Message map: every relayed message of a ticket, in the staff and customer chats
+SQL_INSERT_TICKET_MESSAGE = (
+    'INSERT OR IGNORE INTO ticket_messages (chat_id, message_id, ticket_id, kind) VALUES (?, ?, ?, ?)'
+)
+SQL_INSERT_ANCHOR_MESSAGE = '''
+    INSERT OR IGNORE INTO ticket_messages (chat_id, message_id, ticket_id, kind)
+    SELECT cust_group_id, ?, ticket_id, 'staff_reply' FROM tickets WHERE staff_msg_id = ?
+'''
+SQL_SELECT_TICKET_BY_MESSAGE = (
+    f'SELECT {TICKET_COLUMNS} FROM tickets WHERE ticket_id = '
+    '(SELECT ticket_id FROM ticket_messages WHERE chat_id = ? AND message_id = ?)'
+)
+
+# Search: ticket_texts holds the text, ticket_search is its FTS5 index (kept in sync by triggers).
+# Terms of 3+ characters use the trigram index (ranked by bm25); shorter ones, common in
+# Chinese, are LIKE filters - alone they scan ticket_texts newest first until LIMIT rows match.
+SEARCH_MIN_INDEXED_TERM = 3
+SQL_INSERT_TICKET_TEXT = (
+    'INSERT INTO ticket_texts (ticket_id, kind, author, body, created_at) VALUES (?, ?, ?, ?, ?)'
+)
+SQL_SEARCH_RANKED = '''
+    SELECT x.ticket_id, x.body, t.status, t.username
+    FROM ticket_search JOIN ticket_texts x ON x.id = ticket_search.rowid
+    LEFT JOIN tickets t ON t.ticket_id = x.ticket_id
+    WHERE ticket_search MATCH ?{filters}
+    ORDER BY ticket_search.rank LIMIT ?
+'''
+SQL_SEARCH_RECENT = '''
+    SELECT x.ticket_id, x.body, t.status, t.username
+    FROM ticket_texts x LEFT JOIN tickets t ON t.ticket_id = x.ticket_id
+    WHERE 1{filters}
+    ORDER BY x.id DESC LIMIT ?
+'''
+SQL_SEARCH_LIKE_FILTER = " AND x.body LIKE ? ESCAPE '\\'"
+
+# Outbox: durable Bot API calls and the calls still queued at shutdown
+SQL_INSERT_OUTBOX_CALL = '''
+    INSERT INTO outbox (idempotency_key, method, payload, priority, action, due_at, created_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (idempotency_key) DO NOTHING
+'''
+SQL_INSERT_UNSENT_CALL = 'INSERT INTO outbox (method, payload, priority, due_at, created_at) VALUES (?, ?, ?, ?, ?)'
+SQL_SELECT_DUE_OUTBOX_CALLS = '''
+    SELECT id, method, payload, priority, attempts, action FROM outbox
+    WHERE status = 'pending' AND due_at <= ? ORDER BY due_at, id LIMIT ?
+'''
+SQL_LEASE_OUTBOX_CALL = 'UPDATE outbox SET due_at = ? WHERE id = ?'
+SQL_FINISH_OUTBOX_CALL = '''
+    UPDATE outbox SET status = 'sent', result = ?, finished_at = ? WHERE id = ? AND status = 'pending'
+'''
+SQL_RETRY_OUTBOX_CALL = "UPDATE outbox SET attempts = ?, due_at = ?, last_error = ? WHERE id = ? AND status = 'pending'"
+SQL_FAIL_OUTBOX_CALL = '''
+    UPDATE outbox SET status = 'dead', attempts = ?, last_error = ?, finished_at = ?
+    WHERE id = ? AND status = 'pending'
+'''
+SQL_RELEASE_OUTBOX_CALL = "UPDATE outbox SET due_at = 0 WHERE id = ? AND status = 'pending'"
+SQL_PURGE_OUTBOX = 'DELETE FROM outbox WHERE finished_at < ?'
+
+# Retention: expired tickets are staged in a temp table, copied to the attached archive, then deleted
+SQL_STAGE_EXPIRED_TICKETS = '''
+    INSERT INTO temp.retention_batch (ticket_id)
+    SELECT ticket_id FROM tickets WHERE status = 'closed' AND closed_at < ?
+    ORDER BY closed_at LIMIT ?
+'''
+SQL_ARCHIVE_TICKETS = f'''
+    INSERT OR REPLACE INTO archive.tickets ({TICKET_COLUMNS}, archived_at)
+    SELECT {TICKET_COLUMNS}, ? FROM tickets WHERE ticket_id IN (SELECT ticket_id FROM temp.retention_batch)
+'''
+SQL_ARCHIVE_TICKET_MESSAGES = '''
+    INSERT OR REPLACE INTO archive.ticket_messages (chat_id, message_id, ticket_id, kind)
+    SELECT chat_id, message_id, ticket_id, kind FROM ticket_messages
+    WHERE ticket_id IN (SELECT ticket_id FROM temp.retention_batch)
+'''
+SQL_ARCHIVE_TICKET_TEXTS = '''
+    INSERT OR REPLACE INTO archive.ticket_texts (id, ticket_id, kind, author, body, created_at)
+    SELECT id, ticket_id, kind, author, body, created_at FROM ticket_texts
+    WHERE ticket_id IN (SELECT ticket_id FROM temp.retention_batch)
+'''
+SQL_DELETE_ARCHIVED_TEXTS = (
+    'DELETE FROM ticket_texts WHERE ticket_id IN (SELECT ticket_id FROM temp.retention_batch)'
+)
+SQL_DELETE_ARCHIVED_MESSAGES = (
+    'DELETE FROM ticket_messages WHERE ticket_id IN (SELECT ticket_id FROM temp.retention_batch)'
+)
+SQL_DELETE_ARCHIVED_TICKETS = 'DELETE FROM tickets WHERE ticket_id IN (SELECT ticket_id FROM temp.retention_batch)'
+
+ARCHIVE_SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS archive.tickets (
+        staff_msg_id INTEGER NOT NULL,
+        ticket_id INTEGER PRIMARY KEY,
+        cust_group_id INTEGER NOT NULL,
+        cust_msg_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        username TEXT,
+        customer_anchor_msg_id INTEGER,
+        status TEXT,
+        closed_at INTEGER,
+        archived_at INTEGER NOT NULL,
+        created_at INTEGER
+    )''',
+    '''CREATE TABLE IF NOT EXISTS archive.ticket_messages (
+        chat_id INTEGER NOT NULL,
+        message_id INTEGER NOT NULL,
+        ticket_id INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        PRIMARY KEY (chat_id, message_id)
+    ) WITHOUT ROWID''',
+    '''CREATE TABLE IF NOT EXISTS archive.ticket_texts (
+        id INTEGER PRIMARY KEY,
+        ticket_id INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        author TEXT,
+        body TEXT NOT NULL,
+        created_at INTEGER NOT NULL
+    )''',
+    'CREATE TEMP TABLE IF NOT EXISTS retention_batch (ticket_id INTEGER PRIMARY KEY)',
+)
+
+SQL_RESERVE_IDS = 'UPDATE id_sequences SET next_value = next_value + ? WHERE name = ?'
+SQL_SELECT_NEXT_ID = 'SELECT next_value FROM id_sequences WHERE name = ?'
+
+
+def connect_db(path: str) -> sqlite3.Connection:
+    """Open a long-lived SQLite connection tuned for concurrent access"""
+    conn = sqlite3.connect(path, check_same_thread=False, cached_statements=64)
+    conn.row_factory = sqlite3.Row
+    # Lets retention hand freed pages back to the OS; only takes effect on a new
+    # database (existing ones: tools/enable_incremental_vacuum.py, offline)
+    conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+    # WAL lets readers run while the writer commits; NORMAL sync is durable
+    # across application crashes and skips the fsync on every commit
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA busy_timeout=5000')
+    return conn
+
+
+# ---------- Schema migrations ----------
+# Each migration runs once, in order, inside its own transaction. The applied
+# version is stored in SQLite's built-in PRAGMA user_version, so startup only
+# compares one integer on an up-to-date database.
+
+def _migration_001_base_schema(conn: sqlite3.Connection):
+    """Create base tables, and add status/closed_at to pre-v2.0 tickets tables"""
+    # Create customer groups table
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS customer_groups (
+            group_id INTEGER PRIMARY KEY
+        )
+    ''')
+
+    # Create tickets mapping table (with status and closed_at)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS tickets (
+            staff_msg_id INTEGER PRIMARY KEY,
+            ticket_id INTEGER NOT NULL,
+            cust_group_id INTEGER,
+            cust_msg_id INTEGER,
+            user_id INTEGER,
+            username TEXT,
+            customer_anchor_msg_id INTEGER,
+            status TEXT NOT NULL DEFAULT 'open',
+            closed_at INTEGER DEFAULT NULL
+        )
+    ''')
+
+    # Databases created before v2.0 lack the status and closed_at fields
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(tickets)")]
+    if 'status' not in columns:
+        conn.execute("ALTER TABLE tickets ADD COLUMN status TEXT NOT NULL DEFAULT 'open'")
+    if 'closed_at' not in columns:
+        conn.execute("ALTER TABLE tickets ADD COLUMN closed_at INTEGER DEFAULT NULL")
+
+
+def _migration_002_lookup_indexes(conn: sqlite3.Connection):
+    """Index the /t lookup and the customer reply (anchor) lookup"""
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_tickets_ticket_id ON tickets (ticket_id)')
+    conn.execute(
+        'CREATE INDEX IF NOT EXISTS idx_tickets_customer_anchor '
+        'ON tickets (cust_group_id, customer_anchor_msg_id)'
+    )
+
+
+def _migration_003_ticket_id_sequence(conn: sqlite3.Connection):
+    """Add the ticket ID sequence and make ticket_id unique"""
+    conn.execute('''
+        CREATE TABLE id_sequences (
+            name TEXT PRIMARY KEY,
+            next_value INTEGER NOT NULL
+        )
+    ''')
+    # Continue after the existing (timestamp based) IDs so old and new never collide; new IDs
+    # are therefore only short on a new database, existing ones keep getting 13-digit IDs
+    max_id = conn.execute('SELECT MAX(ticket_id) FROM tickets').fetchone()[0] or 0
+    next_value = max_id + 1
+
+    # Timestamp IDs could collide; keep the first ticket and renumber the others
+    duplicates = conn.execute('''
+        SELECT staff_msg_id, ticket_id FROM tickets
+        WHERE ticket_id IN (SELECT ticket_id FROM tickets GROUP BY ticket_id HAVING COUNT(*) > 1)
+        ORDER BY ticket_id, staff_msg_id
+    ''').fetchall()
+    seen = set()
+    for staff_msg_id, ticket_id in duplicates:
+        if ticket_id not in seen:
+            seen.add(ticket_id)
+            continue
+        logger.warning(
+            "Migration: duplicate ticket #%s (staff_msg_id=%s) renumbered to #%s",
+            ticket_id, staff_msg_id, next_value
+        )
+        conn.execute('UPDATE tickets SET ticket_id = ? WHERE staff_msg_id = ?', (next_value, staff_msg_id))
+        next_value += 1
+
+    conn.execute("INSERT INTO id_sequences (name, next_value) VALUES ('ticket', ?)", (next_value,))
+    conn.execute('DROP INDEX IF EXISTS idx_tickets_ticket_id')
+    conn.execute('CREATE UNIQUE INDEX idx_tickets_ticket_id ON tickets (ticket_id)')
+
+
+def _migration_004_message_map(conn: sqlite3.Connection):
+    """Map every message of a ticket thread (both chats) to its ticket"""
+    # Clustered on (chat_id, message_id): one B-tree probe per lookup, no rowid table
+    conn.execute('''
+        CREATE TABLE ticket_messages (
+            chat_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            ticket_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            PRIMARY KEY (chat_id, message_id)
+        ) WITHOUT ROWID
+    ''')
+    # Existing tickets: the wrapper and the latest customer anchor are known
+    conn.execute('''
+        INSERT OR IGNORE INTO ticket_messages (chat_id, message_id, ticket_id, kind)
+        SELECT ?, staff_msg_id, ticket_id, 'wrapper' FROM tickets
+    ''', (STAFF_GROUP_ID,))
+    conn.execute('''
+        INSERT OR IGNORE INTO ticket_messages (chat_id, message_id, ticket_id, kind)
+        SELECT cust_group_id, customer_anchor_msg_id, ticket_id, 'staff_reply' FROM tickets
+        WHERE customer_anchor_msg_id IS NOT NULL
+    ''')
+
+
+def _migration_005_retention_indexes(conn: sqlite3.Connection):
+    """Indexes for the retention job"""
+    # Partial index: only closed tickets, ordered by close time
+    conn.execute("CREATE INDEX idx_tickets_closed_at ON tickets (closed_at) WHERE status = 'closed'")
+    conn.execute('CREATE INDEX idx_ticket_messages_ticket ON ticket_messages (ticket_id)')
+
+
+def _migration_006_ticket_stats(conn: sqlite3.Connection):
+    """Ticket creation time, per-group counters and the open ticket index (staff dashboard)"""
+    conn.execute('ALTER TABLE tickets ADD COLUMN created_at INTEGER DEFAULT NULL')
+    conn.execute('''
+        CREATE TABLE group_stats (
+            cust_group_id INTEGER PRIMARY KEY,
+            open_tickets INTEGER NOT NULL DEFAULT 0,
+            total_tickets INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    # One scan now; from here on save/close/reopen keep the counters current
+    conn.execute('''
+        INSERT INTO group_stats (cust_group_id, open_tickets, total_tickets)
+        SELECT cust_group_id, SUM(status = 'open'), COUNT(*) FROM tickets
+        WHERE cust_group_id IS NOT NULL GROUP BY cust_group_id
+    ''')
+    # Lowest open IDs first (replaced by the creation time index in v11)
+    conn.execute("CREATE INDEX idx_tickets_open ON tickets (ticket_id) WHERE status = 'open'")
+
+
+def _migration_007_ticket_search(conn: sqlite3.Connection):
+    """Ticket texts and their full-text index (/search)"""
+    # AUTOINCREMENT: IDs of archived texts are never reused
+    conn.execute('''
+        CREATE TABLE ticket_texts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ticket_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            author TEXT,
+            body TEXT NOT NULL,
+            created_at INTEGER NOT NULL
+        )
+    ''')
+    conn.execute('CREATE INDEX idx_ticket_texts_ticket ON ticket_texts (ticket_id)')
+    # Trigram tokens match any substring, so text without spaces (Chinese) is searchable too
+    tokenizer = 'trigram' if sqlite3.sqlite_version_info >= (3, 34) else 'unicode61'
+    if tokenizer != 'trigram':
+        logger.warning("SQLite %s has no trigram tokenizer, /search matches whole words only", sqlite3.sqlite_version)
+    # External content index: the text itself is stored once, in ticket_texts
+    conn.execute(f'''
+        CREATE VIRTUAL TABLE ticket_search USING fts5(
+            body, author, content='ticket_texts', content_rowid='id', tokenize='{tokenizer}'
+        )
+    ''')
+    conn.execute('''
+        CREATE TRIGGER ticket_texts_ai AFTER INSERT ON ticket_texts BEGIN
+            INSERT INTO ticket_search (rowid, body, author) VALUES (new.id, new.body, new.author);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER ticket_texts_ad AFTER DELETE ON ticket_texts BEGIN
+            INSERT INTO ticket_search (ticket_search, rowid, body, author)
+            VALUES ('delete', old.id, old.body, old.author);
+        END
+    ''')
+
+
+def _migration_008_outbox(conn: sqlite3.Connection):
+    """Bot API calls left unsent at shutdown"""
+    conn.execute('''
+        CREATE TABLE outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            method TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            priority INTEGER NOT NULL,
+            created_at INTEGER NOT NULL
+        )
+    ''')
+
+
+def _migration_009_durable_outbox(conn: sqlite3.Connection):
+    """Delivery state of outbox calls (idempotency key, retries, dead letters)"""
+    conn.execute('ALTER TABLE outbox ADD COLUMN idempotency_key TEXT')
+    conn.execute("ALTER TABLE outbox ADD COLUMN status TEXT NOT NULL DEFAULT 'pending'")
+    conn.execute('ALTER TABLE outbox ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0')
+    conn.execute('ALTER TABLE outbox ADD COLUMN due_at INTEGER NOT NULL DEFAULT 0')
+    conn.execute('ALTER TABLE outbox ADD COLUMN action TEXT')
+    conn.execute('ALTER TABLE outbox ADD COLUMN result TEXT')
+    conn.execute('ALTER TABLE outbox ADD COLUMN last_error TEXT')
+    conn.execute('ALTER TABLE outbox ADD COLUMN finished_at INTEGER')
+    # Calls stored at shutdown have no key (NULLs never conflict)
+    conn.execute('CREATE UNIQUE INDEX idx_outbox_key ON outbox (idempotency_key)')
+    conn.execute("CREATE INDEX idx_outbox_due ON outbox (due_at) WHERE status = 'pending'")
+    conn.execute('CREATE INDEX idx_outbox_finished ON outbox (finished_at) WHERE finished_at IS NOT NULL')
+
+
+def _migration_010_drop_anchor_index(conn: sqlite3.Connection):
+    """Drop the anchor index (customer replies are looked up in the message map since v4)"""
+    conn.execute('DROP INDEX IF EXISTS idx_tickets_customer_anchor')
+
+
+def _migration_011_open_ticket_age_index(conn: sqlite3.Connection):
+    """Index open tickets by creation time (/oldest)"""
+    # Ticket ID order is not creation order once instances take ID blocks;
+    # tickets from before created_at existed sort first, by ticket ID
+    conn.execute('DROP INDEX IF EXISTS idx_tickets_open')
+    conn.execute(
+        "CREATE INDEX idx_tickets_open_age ON tickets (COALESCE(created_at, 0), ticket_id) WHERE status = 'open'"
+    )
+
+
+# (version, description, function) - append new migrations, never edit applied ones
+MIGRATIONS = [
+    (1, "Base schema (customer_groups, tickets with status/closed_at)", _migration_001_base_schema),
+    (2, "Indexes on ticket_id and (cust_group_id, customer_anchor_msg_id)", _migration_002_lookup_indexes),
+    (3, "Ticket ID sequence and unique ticket_id", _migration_003_ticket_id_sequence),
+    (4, "Message map (ticket_messages) for replies to any message of a ticket", _migration_004_message_map),
+    (5, "Indexes for ticket retention (closed_at, ticket_messages.ticket_id)", _migration_005_retention_indexes),
+    (6, "Ticket created_at, per-group counters and open ticket index", _migration_006_ticket_stats),
+    (7, "Ticket texts and full-text search index", _migration_007_ticket_search),
+    (8, "Outbox for Bot API calls unsent at shutdown", _migration_008_outbox),
+    (9, "Durable outbox delivery state (idempotency key, retries, dead letters)", _migration_009_durable_outbox),
+    (10, "Drop the unused (cust_group_id, customer_anchor_msg_id) index", _migration_010_drop_anchor_index),
+    (11, "Open ticket index by creation time", _migration_011_open_ticket_age_index),
+]
+
+
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    """Get the schema version recorded in the database"""
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate_db(conn: sqlite3.Connection, target_version: Optional[int] = None):
+    """Apply pending schema migrations up to target_version (idempotent operation)"""
+    current = get_schema_version(conn)
+    for version, description, migration in MIGRATIONS:
+        if version <= current:
+            continue
+        if target_version is not None and version > target_version:
+            break
+        logger.info("Migration %s: %s", version, description)
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            migration(conn)
+            conn.execute(f'PRAGMA user_version = {version:d}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        current = version
+    logger.info("Database schema is at version %s", current)
+
+
+def init_db(conn: sqlite3.Connection):
+    """Initialize database: create tables and apply pending migrations"""
+    migrate_db(conn)
+    logger.info("Database initialization completed")
+
+
+class SQLiteTicketStore(TicketStore):
+    """
+    Ticket store in a local SQLite database (default backend)
+
+    All writes go through one dedicated writer thread that owns a single
+    connection, so commits are serialized without blocking the event loop.
+    Reads run on a small pool of reader threads with their own connections;
+    WAL mode lets them proceed while the writer is committing.
+
+    Writes are group-committed: each one is queued, and the queue is drained
+    in order into shared transactions (everything that arrived within
+    commit_window, at most commit_max_ops per transaction), one savepoint
+    per write so a failing write only rolls back itself. A write returns
+    once its transaction has committed, and a read first waits for the
+    writes queued before it, so reads always see earlier writes.
+
+    Expired closed tickets can be moved to a separate archive database
+    (attached to the writer connection on first use) in small batches.
+    """
+
+    def __init__(self, path: str, reader_threads: int = DB_READER_THREADS,
+                 id_block_size: int = TICKET_ID_BLOCK_SIZE, archive_path: str = ARCHIVE_DB_PATH,
+                 commit_window: float = DB_COMMIT_WINDOW_MS / 1000, commit_max_ops: int = DB_COMMIT_MAX_OPS):
+        super().__init__(id_block_size)
+        self.path = path
+        self.reader_threads = reader_threads
+        self.archive_path = archive_path
+        self.commit_window = commit_window
+        self.commit_max_ops = max(1, commit_max_ops)
+        self._writes = []               # (operation, future) waiting for the next group commit
+        self._last_write = None         # future of the newest queued write (read-your-writes)
+        self._writes_queued: Optional[asyncio.Event] = None
+        self._batch_full: Optional[asyncio.Event] = None
+        self._committer: Optional[asyncio.Task] = None
+        self._closing = False
+        self._archive_attached = False
+        self._writer_conn: Optional[sqlite3.Connection] = None
+        self._writer: Optional[ThreadPoolExecutor] = None
+        self._readers: Optional[ThreadPoolExecutor] = None
+        self._reader_local = threading.local()
+        self._reader_conns = []
+        self._reader_conns_lock = threading.Lock()
+
+    async def open(self):
+        """Open the writer connection, initialize the schema and load customer groups"""
+        self._writer_conn = connect_db(self.path)
+        init_db(self._writer_conn)
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        self._readers = ThreadPoolExecutor(
+            max_workers=self.reader_threads, thread_name_prefix='db-reader'
+        )
+        self._writes_queued = asyncio.Event()
+        self._batch_full = asyncio.Event()
+        self._closing = False
+        self._committer = asyncio.create_task(self._commit_forever())
+        await self._load_caches()
+
+    async def close(self):
+        """Commit queued writes, wait for pending operations and close all connections"""
+        if self._committer:
+            self._closing = True
+            self._writes_queued.set()
+            await self._committer
+            self._committer = None
+        if self._writer:
+            self._writer.shutdown(wait=True)
+            self._readers.shutdown(wait=True)
+            self._writer = self._readers = None
+        with self._reader_conns_lock:
+            for conn in self._reader_conns:
+                conn.close()
+            self._reader_conns.clear()
+        if self._writer_conn:
+            self._writer_conn.close()
+            self._writer_conn = None
+            self._archive_attached = False
+
+    def _reader_conn(self) -> sqlite3.Connection:
+        """Get (or lazily open) the connection owned by the current reader thread"""
+        conn = getattr(self._reader_local, 'conn', None)
+        if conn is None:
+            conn = connect_db(self.path)
+            self._reader_local.conn = conn
+            with self._reader_conns_lock:
+                self._reader_conns.append(conn)
+        return conn
+
+    # ---------- Group commit ----------
+
+    @property
+    def pending_writes(self) -> int:
+        return len(self._writes)
+
+    async def _submit(self, operation):
+        """
+        Queue operation(conn) for the next group commit and return its result once committed
+        The operation runs on the writer thread inside a shared transaction and must not commit.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._writes.append((operation, future))
+        self._last_write = future
+        self._writes_queued.set()
+        if len(self._writes) >= self.commit_max_ops:
+            self._batch_full.set()
+        # Shielded: a cancelled caller does not take the write out of the queue
+        return await asyncio.shield(future)
+
+    async def _commit_forever(self):
+        """Drain the write queue in order, one transaction per batch (until close())"""
+        loop = asyncio.get_running_loop()
+        while self._writes or not self._closing:
+            if not self._writes:
+                self._writes_queued.clear()
+                await self._writes_queued.wait()
+                continue
+            if self.commit_window and len(self._writes) < self.commit_max_ops and not self._closing:
+                # Give concurrent handlers a moment to add their writes to this transaction
+                self._batch_full.clear()
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._batch_full.wait(), self.commit_window)
+            batch = self._writes[:self.commit_max_ops]
+            del self._writes[:len(batch)]
+            try:
+                results = await loop.run_in_executor(self._writer, self._commit_batch, [op for op, _ in batch])
+            except Exception as e:
+                # The commit itself failed: none of the batch was written
+                results = [(False, e)] * len(batch)
+            for (_, future), (ok, value) in zip(batch, results):
+                if future.cancelled():
+                    continue
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+
+    def _commit_batch(self, operations: list) -> list:
+        """Run queued writes in one transaction (writer thread), returns [(ok, result or exception)]"""
+        conn = self._writer_conn
+        results = []
+        with conn:
+            conn.execute('BEGIN')
+            for operation in operations:
+                conn.execute('SAVEPOINT write')
+                try:
+                    results.append((True, operation(conn)))
+                except Exception as e:
+                    conn.execute('ROLLBACK TO write')
+                    results.append((False, e))
+                conn.execute('RELEASE write')
+        DB_COMMITS.inc()
+        DB_COMMITTED_WRITES.inc(amount=len(operations))
+        return results
+
+    async def _write(self, sql: str, params: tuple = ()) -> int:
+        """Execute one statement in the next group commit, returns rowcount"""
+        return await self._submit(lambda conn: conn.execute(sql, params).rowcount)
+
+    async def _write_many(self, statements: list):
+        """Execute (sql, params) statements in the next group commit (all or none of them)"""
+        def operation(conn):
+            for sql, params in statements:
+                conn.execute(sql, params)
+        await self._submit(operation)
+
+    async def _wait_for_writes(self):
+        """Read-your-writes: wait until the writes queued so far are committed"""
+        last_write = self._last_write
+        if last_write is not None and not last_write.done():
+            await asyncio.wait([last_write])
+
+    async def _fetchone(self, sql: str, params: tuple = ()) -> Optional[sqlite3.Row]:
+        """Run a query on a reader thread and return the first row"""
+        def run():
+            return self._reader_conn().execute(sql, params).fetchone()
+        await self._wait_for_writes()
+        return await asyncio.get_running_loop().run_in_executor(self._readers, run)
+
+    async def _fetchall(self, sql: str, params: tuple = ()) -> list:
+        """Run a query on a reader thread and return all rows"""
+        def run():
+            return self._reader_conn().execute(sql, params).fetchall()
+        await self._wait_for_writes()
+        return await asyncio.get_running_loop().run_in_executor(self._readers, run)
+
+    # ---------- Customer groups ----------
+
+    async def _select_customer_groups(self) -> set:
+        return {row[0] for row in await self._fetchall(SQL_SELECT_ALL_GROUPS)}
+
+    async def _insert_customer_group(self, group_id: int):
+        await self._write(SQL_INSERT_GROUP, (group_id,))
+
+    async def _delete_customer_group(self, group_id: int):
+        await self._write(SQL_DELETE_GROUP, (group_id,))
+
+    # ---------- Tickets ----------
+
+    async def _reserve_ids(self, name: str, count: int) -> int:
+        """Reserve `count` consecutive IDs from a sequence, returns the first one"""
+        def operation(conn):
+            conn.execute(SQL_RESERVE_IDS, (count, name))
+            return conn.execute(SQL_SELECT_NEXT_ID, (name,)).fetchone()[0] - count
+        return await self._submit(operation)
+
+    @staticmethod
+    def _ticket_statements(staff_msg_id: int, ticket_id: int, cust_group_id: int,
+                           cust_msg_id: int, user_id: int, username: str) -> list:
+        return [
+            (SQL_INSERT_TICKET,
+             (staff_msg_id, ticket_id, cust_group_id, cust_msg_id, user_id, username, int(time.time() * 1000))),
+            (SQL_INSERT_TICKET_MESSAGE, (STAFF_GROUP_ID, staff_msg_id, ticket_id, 'wrapper')),
+            (SQL_COUNT_NEW_TICKET, (cust_group_id,)),
+        ]
+
+    @staticmethod
+    def _anchor_statements(staff_msg_id: int, customer_anchor_msg_id: int, extra_message_ids) -> list:
+        return (
+            [(SQL_UPDATE_ANCHOR, (customer_anchor_msg_id, staff_msg_id))]
+            + [(SQL_INSERT_ANCHOR_MESSAGE, (message_id, staff_msg_id))
+               for message_id in (customer_anchor_msg_id, *extra_message_ids)]
+        )
+
+    @timed(DB_SECONDS)
+    async def save_ticket(self, staff_msg_id: int, ticket_id: int, cust_group_id: int,
+                          cust_msg_id: int, user_id: int, username: str):
+        """Save ticket mapping (staff_msg_id is wrapper message ID)"""
+        await self._write_many(
+            self._ticket_statements(staff_msg_id, ticket_id, cust_group_id, cust_msg_id, user_id, username)
+        )
+
+    @timed(DB_SECONDS)
+    async def get_ticket(self, staff_msg_id: int) -> Optional[dict]:
+        """Get ticket info by staff group wrapper message ID"""
+        row = await self._fetchone(SQL_SELECT_TICKET_BY_STAFF_MSG, (staff_msg_id,))
+        return dict(row) if row else None
+
+    @timed(DB_SECONDS)
+    async def get_ticket_by_id(self, ticket_id: int) -> Optional[dict]:
+        """Get ticket info by ticket_id (for /t command)"""
+        row = await self._fetchone(SQL_SELECT_TICKET_BY_ID, (ticket_id,))
+        return dict(row) if row else None
+
+    @timed(DB_SECONDS)
+    async def get_ticket_by_message(self, chat_id: int, message_id: int) -> Optional[dict]:
+        """Get ticket info by any message of its thread (staff or customer chat)"""
+        row = await self._fetchone(SQL_SELECT_TICKET_BY_MESSAGE, (chat_id, message_id))
+        return dict(row) if row else None
+
+    @timed(DB_SECONDS)
+    async def add_ticket_messages(self, ticket_id: int, chat_id: int, message_ids: list, kind: str):
+        """Record messages of a ticket thread (append-only, duplicates ignored)"""
+        if message_ids:
+            await self._write_many([
+                (SQL_INSERT_TICKET_MESSAGE, (chat_id, message_id, ticket_id, kind))
+                for message_id in message_ids
+            ])
+
+    @timed(DB_SECONDS)
+    async def update_customer_anchor(self, staff_msg_id: int, customer_anchor_msg_id: int,
+                                     extra_message_ids: list = ()):
+        """
+        Update customer group anchor message ID (called after staff reply)
+        The anchor and extra_message_ids (e.g. a media copy) are added to the message map.
+        """
+        await self._write_many(self._anchor_statements(staff_msg_id, customer_anchor_msg_id, extra_message_ids))
+
+    async def _change_status(self, sql: str, params: tuple, staff_msg_id: int, open_delta: int):
+        """Apply a status change, and the open counter only if the status actually changed"""
+        def operation(conn):
+            if conn.execute(sql, params).rowcount:
+                conn.execute(SQL_COUNT_OPEN_DELTA, (open_delta, staff_msg_id))
+        await self._submit(operation)
+
+    @timed(DB_SECONDS)
+    async def close_ticket_by_staff_msg_id(self, staff_msg_id: int) -> bool:
+        """Close ticket (by staff group wrapper message ID)"""
+        try:
+            closed_at = int(time.time() * 1000)
+            await self._change_status(SQL_CLOSE_TICKET, (closed_at, staff_msg_id), staff_msg_id, -1)
+            return True
+        except Exception as e:
+            logger.error("Failed to close ticket: %s", e)
+            return False
+
+    @timed(DB_SECONDS)
+    async def reopen_ticket_by_staff_msg_id(self, staff_msg_id: int) -> bool:
+        """Reopen ticket (by staff group wrapper message ID)"""
+        try:
+            await self._change_status(SQL_REOPEN_TICKET, (staff_msg_id,), staff_msg_id, 1)
+            return True
+        except Exception as e:
+            logger.error("Failed to reopen ticket: %s", e)
+            return False
+
+    # ---------- Statistics ----------
+
+    @timed(DB_SECONDS)
+    async def get_group_stats(self) -> list:
+        return [dict(row) for row in await self._fetchall(SQL_SELECT_GROUP_STATS)]
+
+    @timed(DB_SECONDS)
+    async def get_oldest_open_tickets(self, limit: int) -> list:
+        return [dict(row) for row in await self._fetchall(SQL_SELECT_OLDEST_OPEN, (limit,))]
+
+    # ---------- Search ----------
+
+    @timed(DB_SECONDS)
+    async def index_ticket_texts(self, rows: list):
+        await self._write_many([(SQL_INSERT_TICKET_TEXT, row) for row in rows])
+
+    @timed(DB_SECONDS)
+    async def search_tickets(self, terms: list, limit: int) -> list:
+        indexed = [term for term in terms if len(term) >= SEARCH_MIN_INDEXED_TERM]
+        short = [term for term in terms if len(term) < SEARCH_MIN_INDEXED_TERM]
+        like_params = tuple('%' + re.sub(r'([\\%_])', r'\\\1', term) + '%' for term in short)
+        filters = SQL_SEARCH_LIKE_FILTER * len(short)
+        if indexed:
+            # Every term as a quoted phrase: no FTS5 query syntax from user input
+            match = ' '.join('"' + term.replace('"', '""') + '"' for term in indexed)
+            sql, params = SQL_SEARCH_RANKED.format(filters=filters), (match, *like_params, limit)
+        else:
+            sql, params = SQL_SEARCH_RECENT.format(filters=filters), (*like_params, limit)
+        return [dict(row) for row in await self._fetchall(sql, params)]
+
+    # ---------- Outbox ----------
+
+    @timed(DB_SECONDS)
+    async def add_outbox_call(self, key: str, method: str, payload: str, priority: int,
+                              action: Optional[dict], due_at: int) -> Optional[int]:
+        def operation(conn):
+            cursor = conn.execute(SQL_INSERT_OUTBOX_CALL, (
+                key, method, payload, priority, json.dumps(action) if action else None,
+                due_at, int(time.time() * 1000)
+            ))
+            return cursor.lastrowid if cursor.rowcount else None
+        return await self._submit(operation)
+
+    @timed(DB_SECONDS)
+    async def save_unsent_calls(self, rows: list):
+        await self._write_many([
+            (SQL_INSERT_UNSENT_CALL, (method, payload, priority, created_at, created_at))
+            for method, payload, priority, created_at in rows
+        ])
+
+    @timed(DB_SECONDS)
+    async def claim_outbox_calls(self, now: int, lease_until: int, limit: int) -> list:
+        def operation(conn):
+            rows = [dict(row) for row in conn.execute(SQL_SELECT_DUE_OUTBOX_CALLS, (now, limit))]
+            for row in rows:
+                conn.execute(SQL_LEASE_OUTBOX_CALL, (lease_until, row['id']))
+                row['action'] = json.loads(row['action']) if row['action'] else None
+            return rows
+        return await self._submit(operation)
+
+    def _action_statements(self, action: dict, message_ids: list, now: int) -> list:
+        """Follow-up writes of a sent outbox call (see TicketStore)"""
+        return self._kind_statements(action, message_ids) + [
+            (SQL_INSERT_OUTBOX_CALL, row) for row in outbox_follow_up_rows(action, message_ids, now)
+        ]
+
+    def _kind_statements(self, action: dict, message_ids: list) -> list:
+        kind = action['kind']
+        if kind == 'ticket':
+            return self._ticket_statements(
+                message_ids[0], action['ticket_id'], action['cust_group_id'], action['cust_msg_id'],
+                action['user_id'], action['username']
+            )
+        if kind == 'staff_reply':
+            return self._anchor_statements(action['staff_msg_id'], message_ids[0], message_ids[1:]) + [
+                (SQL_INSERT_TICKET_MESSAGE, (STAFF_GROUP_ID, action['reply_msg_id'], action['ticket_id'], 'staff'))
+            ]
+        if kind == 'continuation':
+            return [
+                (SQL_INSERT_TICKET_MESSAGE, (STAFF_GROUP_ID, message_id, action['ticket_id'], 'continuation'))
+                for message_id in message_ids
+            ]
+        if kind == 'map':
+            return [
+                (SQL_INSERT_TICKET_MESSAGE, (action['chat_id'], message_id, action['ticket_id'], action['as']))
+                for message_id in message_ids
+            ]
+        raise ValueError(f"unknown outbox action {kind}")
+
+    @timed(DB_SECONDS)
+    async def finish_outbox_call(self, outbox_id: int, message_ids: list, action: Optional[dict], now: int):
+        statements = self._action_statements(action, message_ids, now) if action and message_ids else []
+        def operation(conn):
+            if conn.execute(SQL_FINISH_OUTBOX_CALL, (json.dumps(message_ids), now, outbox_id)).rowcount:
+                for sql, params in statements:
+                    conn.execute(sql, params)
+        await self._submit(operation)
+
+    @timed(DB_SECONDS)
+    async def retry_outbox_call(self, outbox_id: int, attempts: int, due_at: int, error: str):
+        await self._write(SQL_RETRY_OUTBOX_CALL, (attempts, due_at, error, outbox_id))
+
+    @timed(DB_SECONDS)
+    async def fail_outbox_call(self, outbox_id: int, attempts: int, error: str, now: int):
+        await self._write(SQL_FAIL_OUTBOX_CALL, (attempts, error, now, outbox_id))
+
+    @timed(DB_SECONDS)
+    async def release_outbox_calls(self, outbox_ids: list):
+        await self._write_many([(SQL_RELEASE_OUTBOX_CALL, (outbox_id,)) for outbox_id in outbox_ids])
+
+    @timed(DB_SECONDS)
+    async def purge_outbox(self, finished_before: int) -> int:
+        return await self._write(SQL_PURGE_OUTBOX, (finished_before,))
+
+    # ---------- Maintenance ----------
+
+    def _attach_archive(self, conn: sqlite3.Connection):
+        """Attach the archive database and create its tables (writer thread, once)"""
+        if self._archive_attached:
+            return
+        conn.execute('ATTACH DATABASE ? AS archive', (self.archive_path,))
+        for sql in ARCHIVE_SCHEMA:
+            conn.execute(sql)
+        # Archives created before tickets had created_at
+        if 'created_at' not in [row[1] for row in conn.execute('PRAGMA archive.table_info(tickets)')]:
+            conn.execute('ALTER TABLE archive.tickets ADD COLUMN created_at INTEGER')
+        conn.commit()
+        self._archive_attached = True
+
+    async def archive_closed_tickets(self, closed_before: int, batch_size: int) -> tuple:
+        """
+        Move up to batch_size tickets closed before `closed_before` (ms) and their
+        message map rows to the archive database
+        
+        Returns:
+            (tickets moved, messages moved)
+        """
+        def run():
+            conn = self._writer_conn
+            self._attach_archive(conn)
+            # WAL commits are atomic per database file: if the process dies between
+            # the two files, the rows are still in tickets and get re-copied next run
+            with conn:
+                conn.execute('DELETE FROM temp.retention_batch')
+                tickets = conn.execute(SQL_STAGE_EXPIRED_TICKETS, (closed_before, batch_size)).rowcount
+                if not tickets:
+                    return 0, 0
+                conn.execute(SQL_ARCHIVE_TICKETS, (int(time.time() * 1000),))
+                conn.execute(SQL_ARCHIVE_TICKET_MESSAGES)
+                conn.execute(SQL_ARCHIVE_TICKET_TEXTS)
+                conn.execute(SQL_DELETE_ARCHIVED_TEXTS)
+                messages = conn.execute(SQL_DELETE_ARCHIVED_MESSAGES).rowcount
+                conn.execute(SQL_DELETE_ARCHIVED_TICKETS)
+            return tickets, messages
+        return await asyncio.get_running_loop().run_in_executor(self._writer, run)
+
+    async def compact(self) -> int:
+        """Release free pages back to the file system (incremental vacuum), returns bytes reclaimed"""
+        def run():
+            conn = self._writer_conn
+            page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+            pages_before = conn.execute('PRAGMA page_count').fetchone()[0]
+            if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+                # Converting needs a full VACUUM, which would block every write and read
+                # behind it on this thread; it is an offline step instead
+                logger.info(
+                    "Database is not in incremental auto-vacuum mode, freed pages are reused but "
+                    "not released; run tools/enable_incremental_vacuum.py with the bot stopped"
+                )
+                return 0
+            conn.execute('PRAGMA incremental_vacuum').fetchall()
+            # Truncation reaches the main file at checkpoint time
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+            pages_after = conn.execute('PRAGMA page_count').fetchone()[0]
+            return (pages_before - pages_after) * page_size
+        return await asyncio.get_running_loop().run_in_executor(self._writer, run)
+
+
+# ---------- PostgreSQL backend ----------
+# Same tables as the SQLite schema (64-bit IDs); archived rows move to
+# *_archive tables in the same database. asyncpg prepares each statement
+# once per pooled connection and reuses it.
+
+PG_SELECT_ALL_GROUPS = 'SELECT group_id FROM customer_groups'
+PG_INSERT_GROUP = 'INSERT INTO customer_groups (group_id) VALUES ($1) ON CONFLICT DO NOTHING'
+PG_DELETE_GROUP = 'DELETE FROM customer_groups WHERE group_id = $1'
+PG_RESERVE_IDS = (
+    'UPDATE id_sequences SET next_value = next_value + $1 WHERE name = $2 RETURNING next_value - $1'
+)
+
+# Multi-statement writes are single statements (data-modifying CTEs): atomic and one round trip
+PG_INSERT_TICKET = '''
+    WITH ticket AS (
+        INSERT INTO tickets (staff_msg_id, ticket_id, cust_group_id, cust_msg_id, user_id, username, created_at)
+        VALUES ($1, $2, $3, $4, $5, $6, $8)
+    ), stats AS (
+        INSERT INTO group_stats (cust_group_id, open_tickets, total_tickets) VALUES ($3, 1, 1)
+        ON CONFLICT (cust_group_id) DO UPDATE
+        SET open_tickets = group_stats.open_tickets + 1, total_tickets = group_stats.total_tickets + 1
+    )
+    INSERT INTO ticket_messages (chat_id, message_id, ticket_id, kind)
+    VALUES ($7, $1, $2, 'wrapper') ON CONFLICT DO NOTHING
+'''
+PG_SELECT_TICKET_BY_STAFF_MSG = f'SELECT {TICKET_COLUMNS} FROM tickets WHERE staff_msg_id = $1'
+PG_SELECT_TICKET_BY_ID = f'SELECT {TICKET_COLUMNS} FROM tickets WHERE ticket_id = $1'
+PG_SELECT_TICKET_BY_MESSAGE = (
+    f'SELECT {TICKET_COLUMNS} FROM tickets WHERE ticket_id = '
+    '(SELECT ticket_id FROM ticket_messages WHERE chat_id = $1 AND message_id = $2)'
+)
+PG_INSERT_TICKET_MESSAGES = '''
+    INSERT INTO ticket_messages (chat_id, message_id, ticket_id, kind)
+    SELECT $1, unnest($2::bigint[]), $3, $4 ON CONFLICT DO NOTHING
+'''
+PG_UPDATE_ANCHOR = '''
+    WITH ticket AS (
+        UPDATE tickets SET customer_anchor_msg_id = $2 WHERE staff_msg_id = $1
+        RETURNING ticket_id, cust_group_id
+    )
+    INSERT INTO ticket_messages (chat_id, message_id, ticket_id, kind)
+    SELECT cust_group_id, unnest($3::bigint[]), ticket_id, 'staff_reply' FROM ticket
+    ON CONFLICT DO NOTHING
+'''
+PG_CLOSE_TICKET = '''
+    WITH ticket AS (
+        UPDATE tickets SET status = 'closed', closed_at = $1 WHERE staff_msg_id = $2 AND status = 'open'
+        RETURNING cust_group_id
+    )
+    UPDATE group_stats SET open_tickets = open_tickets - 1 WHERE cust_group_id = (SELECT cust_group_id FROM ticket)
+'''
+PG_REOPEN_TICKET = '''
+    WITH ticket AS (
+        UPDATE tickets SET status = 'open', closed_at = NULL WHERE staff_msg_id = $1 AND status = 'closed'
+        RETURNING cust_group_id
+    )
+    UPDATE group_stats SET open_tickets = open_tickets + 1 WHERE cust_group_id = (SELECT cust_group_id FROM ticket)
+'''
+PG_SELECT_GROUP_STATS = 'SELECT cust_group_id, open_tickets, total_tickets FROM group_stats'
+PG_SELECT_OLDEST_OPEN = (
+    f"SELECT {TICKET_COLUMNS} FROM tickets WHERE status = 'open' "
+    "ORDER BY COALESCE(created_at, 0), ticket_id LIMIT $1"
+)
+
+# Retention: SKIP LOCKED lets several instances run the job without blocking each other
+PG_ARCHIVE_TICKETS = f'''
+    WITH batch AS (
+        SELECT ticket_id FROM tickets WHERE status = 'closed' AND closed_at < $1
+        ORDER BY closed_at LIMIT $2 FOR UPDATE SKIP LOCKED
+    ), moved AS (
+        DELETE FROM tickets WHERE ticket_id IN (SELECT ticket_id FROM batch)
+        RETURNING {TICKET_COLUMNS}
+    ), archived AS (
+        INSERT INTO tickets_archive ({TICKET_COLUMNS}, archived_at)
+        SELECT {TICKET_COLUMNS}, $3 FROM moved ON CONFLICT DO NOTHING
+    )
+    SELECT ticket_id FROM moved
+'''
+PG_ARCHIVE_TICKET_MESSAGES = '''
+    WITH moved AS (
+        DELETE FROM ticket_messages WHERE ticket_id = ANY($1::bigint[])
+        RETURNING chat_id, message_id, ticket_id, kind
+    ), archived AS (
+        INSERT INTO ticket_messages_archive (chat_id, message_id, ticket_id, kind)
+        SELECT chat_id, message_id, ticket_id, kind FROM moved ON CONFLICT DO NOTHING
+    )
+    SELECT count(*) FROM moved
+'''
+
+# Search: word terms use the tsvector (GIN) index, CJK terms (no spaces to split words on) are ILIKE filters
+PG_INSERT_TICKET_TEXTS = '''
+    INSERT INTO ticket_texts (ticket_id, kind, author, body, created_at)
+    SELECT * FROM unnest($1::bigint[], $2::text[], $3::text[], $4::text[], $5::bigint[])
+'''
+PG_SEARCH_TICKETS = '''
+    SELECT x.ticket_id, x.body, t.status, t.username
+    FROM ticket_texts x LEFT JOIN tickets t ON t.ticket_id = x.ticket_id
+    WHERE ($1 = '' OR x.search @@ plainto_tsquery('simple', $1)) AND x.body ILIKE ALL ($2::text[])
+    ORDER BY ts_rank(x.search, plainto_tsquery('simple', $1)) DESC, x.id DESC
+    LIMIT $3
+'''
+PG_ARCHIVE_TICKET_TEXTS = '''
+    WITH moved AS (
+        DELETE FROM ticket_texts WHERE ticket_id = ANY($1::bigint[])
+        RETURNING id, ticket_id, kind, author, body, created_at
+    )
+    INSERT INTO ticket_texts_archive (id, ticket_id, kind, author, body, created_at)
+    SELECT id, ticket_id, kind, author, body, created_at FROM moved ON CONFLICT DO NOTHING
+'''
+CJK_PATTERN = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]')
+
+# Outbox: SKIP LOCKED + lease, so instances polling together never claim the same call
+PG_INSERT_OUTBOX_CALL = '''
+    INSERT INTO outbox (idempotency_key, method, payload, priority, action, due_at, created_at)
+    VALUES ($1, $2, $3, $4, $5, $6, $7) ON CONFLICT (idempotency_key) DO NOTHING RETURNING id
+'''
+PG_INSERT_UNSENT_CALLS = '''
+    INSERT INTO outbox (method, payload, priority, created_at, due_at)
+    SELECT m, p, pr, c, c FROM unnest($1::text[], $2::text[], $3::int[], $4::bigint[]) AS u (m, p, pr, c)
+'''
+PG_CLAIM_OUTBOX_CALLS = '''
+    WITH due AS (
+        SELECT id FROM outbox WHERE status = 'pending' AND due_at <= $1
+        ORDER BY due_at, id LIMIT $3 FOR UPDATE SKIP LOCKED
+    )
+    UPDATE outbox SET due_at = $2 FROM due WHERE outbox.id = due.id
+    RETURNING outbox.id, method, payload, priority, attempts, action
+'''
+PG_FINISH_OUTBOX_CALL = '''
+    UPDATE outbox SET status = 'sent', result = $2, finished_at = $3 WHERE id = $1 AND status = 'pending'
+'''
+PG_RETRY_OUTBOX_CALL = '''
+    UPDATE outbox SET attempts = $2, due_at = $3, last_error = $4 WHERE id = $1 AND status = 'pending'
+'''
+PG_FAIL_OUTBOX_CALL = '''
+    UPDATE outbox SET status = 'dead', attempts = $2, last_error = $3, finished_at = $4
+    WHERE id = $1 AND status = 'pending'
+'''
+PG_RELEASE_OUTBOX_CALLS = "UPDATE outbox SET due_at = 0 WHERE id = ANY($1::bigint[]) AND status = 'pending'"
+PG_PURGE_OUTBOX = 'DELETE FROM outbox WHERE finished_at < $1'
+
+# Serializes migrations when several instances start at once (pg_advisory_xact_lock key)
+PG_MIGRATION_LOCK_ID = 0x54494b54
+
+# (version, description, statements) - append new migrations, never edit applied ones
+PG_MIGRATIONS = [
+    (1, "Base schema (equivalent to SQLite schema version 5)", (
+        'CREATE TABLE customer_groups (group_id BIGINT PRIMARY KEY)',
+        '''CREATE TABLE tickets (
+            staff_msg_id BIGINT PRIMARY KEY,
+            ticket_id BIGINT NOT NULL UNIQUE,
+            cust_group_id BIGINT,
+            cust_msg_id BIGINT,
+            user_id BIGINT,
+            username TEXT,
+            customer_anchor_msg_id BIGINT,
+            status TEXT NOT NULL DEFAULT 'open',
+            closed_at BIGINT DEFAULT NULL
+        )''',
+        'CREATE INDEX idx_tickets_customer_anchor ON tickets (cust_group_id, customer_anchor_msg_id)',
+        "CREATE INDEX idx_tickets_closed_at ON tickets (closed_at) WHERE status = 'closed'",
+        '''CREATE TABLE id_sequences (
+            name TEXT PRIMARY KEY,
+            next_value BIGINT NOT NULL
+        )''',
+        "INSERT INTO id_sequences (name, next_value) VALUES ('ticket', 1)",
+        '''CREATE TABLE ticket_messages (
+            chat_id BIGINT NOT NULL,
+            message_id BIGINT NOT NULL,
+            ticket_id BIGINT NOT NULL,
+            kind TEXT NOT NULL,
+            PRIMARY KEY (chat_id, message_id)
+        )''',
+        'CREATE INDEX idx_ticket_messages_ticket ON ticket_messages (ticket_id)',
+        '''CREATE TABLE tickets_archive (
+            LIKE tickets INCLUDING DEFAULTS,
+            archived_at BIGINT NOT NULL,
+            PRIMARY KEY (ticket_id)
+        )''',
+        '''CREATE TABLE ticket_messages_archive (
+            LIKE ticket_messages,
+            PRIMARY KEY (chat_id, message_id)
+        )''',
+    )),
+    (2, "Ticket created_at, per-group counters and open ticket index", (
+        'ALTER TABLE tickets ADD COLUMN created_at BIGINT DEFAULT NULL',
+        'ALTER TABLE tickets_archive ADD COLUMN created_at BIGINT DEFAULT NULL',
+        '''CREATE TABLE group_stats (
+            cust_group_id BIGINT PRIMARY KEY,
+            open_tickets BIGINT NOT NULL DEFAULT 0,
+            total_tickets BIGINT NOT NULL DEFAULT 0
+        )''',
+        '''INSERT INTO group_stats (cust_group_id, open_tickets, total_tickets)
+        SELECT cust_group_id, COUNT(*) FILTER (WHERE status = 'open'), COUNT(*) FROM tickets
+        WHERE cust_group_id IS NOT NULL GROUP BY cust_group_id''',
+        "CREATE INDEX idx_tickets_open ON tickets (ticket_id) WHERE status = 'open'",
+    )),
+    (3, "Ticket texts and full-text search index", (
+        '''CREATE TABLE ticket_texts (
+            id BIGINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+            ticket_id BIGINT NOT NULL,
+            kind TEXT NOT NULL,
+            author TEXT,
+            body TEXT NOT NULL,
+            created_at BIGINT NOT NULL,
+            search TSVECTOR GENERATED ALWAYS AS (to_tsvector('simple', coalesce(author, '') || ' ' || body)) STORED
+        )''',
+        'CREATE INDEX idx_ticket_texts_ticket ON ticket_texts (ticket_id)',
+        'CREATE INDEX idx_ticket_texts_search ON ticket_texts USING GIN (search)',
+        '''CREATE TABLE ticket_texts_archive (
+            id BIGINT PRIMARY KEY,
+            ticket_id BIGINT NOT NULL,
+            kind TEXT NOT NULL,
+            author TEXT,
+            body TEXT NOT NULL,
+            created_at BIGINT NOT NULL
+        )''',
+    )),
+    (4, "Outbox for Bot API calls unsent at shutdown", (
+        '''CREATE TABLE outbox (
+            id BIGINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+            method TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            priority INTEGER NOT NULL,
+            created_at BIGINT NOT NULL
+        )''',
+    )),
+    (5, "Durable outbox delivery state (idempotency key, retries, dead letters)", (
+        '''ALTER TABLE outbox
+            ADD COLUMN idempotency_key TEXT UNIQUE,
+            ADD COLUMN status TEXT NOT NULL DEFAULT 'pending',
+            ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0,
+            ADD COLUMN due_at BIGINT NOT NULL DEFAULT 0,
+            ADD COLUMN action JSONB,
+            ADD COLUMN result TEXT,
+            ADD COLUMN last_error TEXT,
+            ADD COLUMN finished_at BIGINT''',
+        "CREATE INDEX idx_outbox_due ON outbox (due_at) WHERE status = 'pending'",
+        'CREATE INDEX idx_outbox_finished ON outbox (finished_at) WHERE finished_at IS NOT NULL',
+    )),
+    (6, "Drop the unused (cust_group_id, customer_anchor_msg_id) index", (
+        'DROP INDEX IF EXISTS idx_tickets_customer_anchor',
+    )),
+    (7, "Open ticket index by creation time", (
+        'DROP INDEX IF EXISTS idx_tickets_open',
+        "CREATE INDEX idx_tickets_open_age ON tickets ((COALESCE(created_at, 0)), ticket_id) WHERE status = 'open'",
+    )),
+]
+
+
+async def migrate_postgres(conn):
+    """Apply pending PostgreSQL migrations (one transaction, safe with concurrent instances)"""
+    async with conn.transaction():
+        await conn.execute('SELECT pg_advisory_xact_lock($1)', PG_MIGRATION_LOCK_ID)
+        await conn.execute('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)')
+        current = await conn.fetchval('SELECT MAX(version) FROM schema_version') or 0
+        for version, description, statements in PG_MIGRATIONS:
+            if version <= current:
+                continue
+            logger.info("Migration %s: %s", version, description)
+            for sql in statements:
+                await conn.execute(sql)
+            await conn.execute('INSERT INTO schema_version (version) VALUES ($1)', version)
+            current = version
+    logger.info("PostgreSQL schema is at version %s", current)
+
+
+class PostgresTicketStore(TicketStore):
+    """
+    Ticket store in a PostgreSQL database shared by several bot instances
+
+    Used for multi-instance deployments (e.g. webhook replicas behind a load
+    balancer). Calls run on an asyncpg connection pool of up to pool_size
+    connections. Ticket IDs come from the shared id_sequences row, and
+    customer groups added by other instances are picked up by the periodic
+    refresh (GROUP_CACHE_REFRESH_SECONDS).
+    """
+
+    shared = True
+
+    def __init__(self, dsn: str, pool_size: int = DB_POOL_SIZE,
+                 id_block_size: int = TICKET_ID_BLOCK_SIZE):
+        super().__init__(id_block_size)
+        self.dsn = dsn
+        self.pool_size = pool_size
+        self._pool = None
+
+    async def open(self):
+        """Create the connection pool, apply pending migrations and load customer groups"""
+        if asyncpg is None:
+            raise RuntimeError("DATABASE_URL points to PostgreSQL but asyncpg is not installed (pip install asyncpg)")
+        self._pool = await asyncpg.create_pool(self.dsn, min_size=1, max_size=self.pool_size)
+        async with self._pool.acquire() as conn:
+            await migrate_postgres(conn)
+        await self._load_caches()
+
+    async def close(self):
+        """Wait for connections in use and close the pool"""
+        if self._pool:
+            await self._pool.close()
+            self._pool = None
+
+    # ---------- Customer groups ----------
+
+    async def _select_customer_groups(self) -> set:
+        return {row[0] for row in await self._pool.fetch(PG_SELECT_ALL_GROUPS)}
+
+    async def _insert_customer_group(self, group_id: int):
+        await self._pool.execute(PG_INSERT_GROUP, group_id)
+
+    async def _delete_customer_group(self, group_id: int):
+        await self._pool.execute(PG_DELETE_GROUP, group_id)
+
+    # ---------- Tickets ----------
+
+    async def _reserve_ids(self, name: str, count: int) -> int:
+        return await self._pool.fetchval(PG_RESERVE_IDS, count, name)
+
+    @timed(DB_SECONDS)
+    async def save_ticket(self, staff_msg_id: int, ticket_id: int, cust_group_id: int,
+                          cust_msg_id: int, user_id: int, username: str):
+        await self._pool.execute(
+            PG_INSERT_TICKET, staff_msg_id, ticket_id, cust_group_id, cust_msg_id, user_id, username,
+            STAFF_GROUP_ID, int(time.time() * 1000)
+        )
+
+    @timed(DB_SECONDS)
+    async def get_ticket(self, staff_msg_id: int) -> Optional[dict]:
+        row = await self._pool.fetchrow(PG_SELECT_TICKET_BY_STAFF_MSG, staff_msg_id)
+        return dict(row) if row else None
+
+    @timed(DB_SECONDS)
+    async def get_ticket_by_id(self, ticket_id: int) -> Optional[dict]:
+        row = await self._pool.fetchrow(PG_SELECT_TICKET_BY_ID, ticket_id)
+        return dict(row) if row else None
+
+    @timed(DB_SECONDS)
+    async def get_ticket_by_message(self, chat_id: int, message_id: int) -> Optional[dict]:
+        row = await self._pool.fetchrow(PG_SELECT_TICKET_BY_MESSAGE, chat_id, message_id)
+        return dict(row) if row else None
+
+    @timed(DB_SECONDS)
+    async def add_ticket_messages(self, ticket_id: int, chat_id: int, message_ids: list, kind: str):
+        if message_ids:
+            await self._pool.execute(PG_INSERT_TICKET_MESSAGES, chat_id, list(message_ids), ticket_id, kind)
+
+    @timed(DB_SECONDS)
+    async def update_customer_anchor(self, staff_msg_id: int, customer_anchor_msg_id: int,
+                                     extra_message_ids: list = ()):
+        await self._pool.execute(
+            PG_UPDATE_ANCHOR, staff_msg_id, customer_anchor_msg_id,
+            [customer_anchor_msg_id, *extra_message_ids]
+        )
+
+    @timed(DB_SECONDS)
+    async def close_ticket_by_staff_msg_id(self, staff_msg_id: int) -> bool:
+        try:
+            await self._pool.execute(PG_CLOSE_TICKET, int(time.time() * 1000), staff_msg_id)
+            return True
+        except Exception as e:
+            logger.error("Failed to close ticket: %s", e)
+            return False
+
+    @timed(DB_SECONDS)
+    async def reopen_ticket_by_staff_msg_id(self, staff_msg_id: int) -> bool:
+        try:
+            await self._pool.execute(PG_REOPEN_TICKET, staff_msg_id)
+            return True
+        except Exception as e:
+            logger.error("Failed to reopen ticket: %s", e)
+            return False
+
+    # ---------- Statistics ----------
+
+    @timed(DB_SECONDS)
+    async def get_group_stats(self) -> list:
+        return [dict(row) for row in await self._pool.fetch(PG_SELECT_GROUP_STATS)]
+
+    @timed(DB_SECONDS)
+    async def get_oldest_open_tickets(self, limit: int) -> list:
+        return [dict(row) for row in await self._pool.fetch(PG_SELECT_OLDEST_OPEN, limit)]
+
+    # ---------- Search ----------
+
+    @timed(DB_SECONDS)
+    async def index_ticket_texts(self, rows: list):
+        await self._pool.execute(PG_INSERT_TICKET_TEXTS, *(list(column) for column in zip(*rows)))
+
+    @timed(DB_SECONDS)
+    async def search_tickets(self, terms: list, limit: int) -> list:
+        words = ' '.join(term for term in terms if not CJK_PATTERN.search(term))
+        patterns = [
+            '%' + re.sub(r'([\\%_])', r'\\\1', term) + '%' for term in terms if CJK_PATTERN.search(term)
+        ]
+        return [dict(row) for row in await self._pool.fetch(PG_SEARCH_TICKETS, words, patterns, limit)]
+
+    # ---------- Outbox ----------
+
+    @timed(DB_SECONDS)
+    async def add_outbox_call(self, key: str, method: str, payload: str, priority: int,
+                              action: Optional[dict], due_at: int) -> Optional[int]:
+        return await self._pool.fetchval(
+            PG_INSERT_OUTBOX_CALL, key, method, payload, priority,
+            json.dumps(action) if action else None, due_at, int(time.time() * 1000)
+        )
+
+    @timed(DB_SECONDS)
+    async def save_unsent_calls(self, rows: list):
+        await self._pool.execute(PG_INSERT_UNSENT_CALLS, *(list(column) for column in zip(*rows)))
+
+    @timed(DB_SECONDS)
+    async def claim_outbox_calls(self, now: int, lease_until: int, limit: int) -> list:
+        rows = [dict(row) for row in await self._pool.fetch(PG_CLAIM_OUTBOX_CALLS, now, lease_until, limit)]
+        for row in rows:
+            row['action'] = json.loads(row['action']) if row['action'] else None
+        return sorted(rows, key=lambda row: row['id'])
+
+    @timed(DB_SECONDS)
+    async def finish_outbox_call(self, outbox_id: int, message_ids: list, action: Optional[dict], now: int):
+        async with self._pool.acquire() as conn:
+            async with conn.transaction():
+                finished = await conn.execute(PG_FINISH_OUTBOX_CALL, outbox_id, json.dumps(message_ids), now)
+                if finished == 'UPDATE 0' or not (action and message_ids):
+                    return
+                kind = action['kind']
+                if kind == 'ticket':
+                    await conn.execute(
+                        PG_INSERT_TICKET, message_ids[0], action['ticket_id'], action['cust_group_id'],
+                        action['cust_msg_id'], action['user_id'], action['username'], STAFF_GROUP_ID, now
+                    )
+                elif kind == 'staff_reply':
+                    await conn.execute(PG_UPDATE_ANCHOR, action['staff_msg_id'], message_ids[0], message_ids)
+                    await conn.execute(
+                        PG_INSERT_TICKET_MESSAGES, STAFF_GROUP_ID, [action['reply_msg_id']], action['ticket_id'], 'staff'
+                    )
+                elif kind == 'continuation':
+                    await conn.execute(
+                        PG_INSERT_TICKET_MESSAGES, STAFF_GROUP_ID, message_ids, action['ticket_id'], 'continuation'
+                    )
+                elif kind == 'map':
+                    await conn.execute(
+                        PG_INSERT_TICKET_MESSAGES, action['chat_id'], message_ids, action['ticket_id'], action['as']
+                    )
+                else:
+                    raise ValueError(f"unknown outbox action {kind}")
+                follow_ups = outbox_follow_up_rows(action, message_ids, now)
+                if follow_ups:
+                    await conn.executemany(PG_INSERT_OUTBOX_CALL, follow_ups)
+
+    @timed(DB_SECONDS)
+    async def retry_outbox_call(self, outbox_id: int, attempts: int, due_at: int, error: str):
+        await self._pool.execute(PG_RETRY_OUTBOX_CALL, outbox_id, attempts, due_at, error)
+
+    @timed(DB_SECONDS)
+    async def fail_outbox_call(self, outbox_id: int, attempts: int, error: str, now: int):
+        await self._pool.execute(PG_FAIL_OUTBOX_CALL, outbox_id, attempts, error, now)
+
+    @timed(DB_SECONDS)
+    async def release_outbox_calls(self, outbox_ids: list):
+        await self._pool.execute(PG_RELEASE_OUTBOX_CALLS, list(outbox_ids))
+
+    @timed(DB_SECONDS)
+    async def purge_outbox(self, finished_before: int) -> int:
+        status = await self._pool.execute(PG_PURGE_OUTBOX, finished_before)
+        return int(status.split()[-1])
+
+    # ---------- Maintenance ----------
+
+    async def archive_closed_tickets(self, closed_before: int, batch_size: int) -> tuple:
+        async with self._pool.acquire() as conn:
+            async with conn.transaction():
+                rows = await conn.fetch(PG_ARCHIVE_TICKETS, closed_before, batch_size, int(time.time() * 1000))
+                if not rows:
+                    return 0, 0
+                ticket_ids = [row[0] for row in rows]
+                messages = await conn.fetchval(PG_ARCHIVE_TICKET_MESSAGES, ticket_ids)
+                await conn.execute(PG_ARCHIVE_TICKET_TEXTS, ticket_ids)
+        return len(rows), messages
+
+    async def compact(self) -> int:
+        """Nothing to do: autovacuum reuses the space of archived rows"""
+        return 0
+
+
+def create_store(database_url: str = DATABASE_URL) -> TicketStore:
+    """Create the configured backend: PostgreSQL for a postgresql:// URL, SQLite at DB_PATH otherwise"""
+    if not database_url:
+        return SQLiteTicketStore(DB_NAME)
+    if database_url.startswith(('postgresql://', 'postgres://')):
+        return PostgresTicketStore(database_url)
+    raise ValueError(f"DATABASE_URL must be a postgresql:// URL, got: {database_url.split(':', 1)[0]}://...")
+
+
+# Shared ticket store (opened in main())
+store = create_store()
+metrics.gauge('bot_db_pending_writes', 'Store writes waiting for a group commit', lambda: store.pending_writes)
+
+
+# ======================== Bot Initialization ========================
+
+bot = Bot(
+    token=API_TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+)
+dp = Dispatcher()
+
+
+async def handler_metrics_middleware(handler, event, data):
+    """Record how long each message handler takes"""
+    name = data['handler'].callback.__name__
+    start = time.perf_counter()
+    try:
+        return await handler(event, data)
+    except Exception:
+        HANDLER_ERRORS.inc(name)
+        raise
+    finally:
+        HANDLER_SECONDS.observe(time.perf_counter() - start, name)
+
+
+async def api_metrics_middleware(make_request, bot: Bot, method: TelegramMethod):
+    """Record latency and failures of every Bot API call"""
+    name = method.__api_method__
+    start = time.perf_counter()
+    try:
+        return await make_request(bot, method)
+    except Exception as e:
+        API_ERRORS.inc(name, type(e).__name__)
+        raise
+    finally:
+        API_SECONDS.observe(time.perf_counter() - start, name)
+
+
+if metrics.enabled:
+    dp.message.middleware(handler_metrics_middleware)
+    bot.session.middleware(api_metrics_middleware)
+
+
+class BotIdentity:
+    """
+    Bot account info shared by all handlers
+    Resolved once in main() (optionally refreshed in background), so handlers
+    never call getMe on the message path
+    """
+
+    def __init__(self):
+        self.id: Optional[int] = None
+        self.username: str = ''
+        self.mention: str = ''
+        self.mention_pattern: Optional[re.Pattern] = None
+
+    def update(self, user: types.User):
+        """Store identity and precompile the @username matcher"""
+        self.id = user.id
+        self.username = user.username
+        self.mention = f"@{user.username}"
+        # Telegram usernames are case-insensitive
+        self.mention_pattern = re.compile(re.escape(self.mention), re.IGNORECASE)
+
+    async def resolve(self, bot: Bot):
+        """Fetch identity from Bot API"""
+        self.update(await bot.get_me())
+
+    async def refresh_forever(self, bot: Bot, interval: int):
+        """Periodically re-resolve identity (e.g. after a username change)"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.resolve(bot)
+            except Exception as e:
+                logger.warning("Failed to refresh bot identity: %s", e)
+
+
+bot_identity = BotIdentity()
+
+
+# ======================== Message Rendering ========================
+
+# Telegram limits, counted after entity parsing
+TEXT_LIMIT = 4096       # Message text
+CAPTION_LIMIT = 1024    # Media captions
+
+TICKET_RULE = '─' * 30
+CONTINUATION_RULE = '─' * 20
+
+# Headers, formatted once per message (staff replies are sent as HTML)
+WRAPPER_HEADER = (
+    "🎫 Ticket #{ticket_id}\n"
+    "📍 From group: {group}\n"
+    "👤 User: {user}\n"
+    f"{TICKET_RULE}\n"
+).format
+CONTINUATION_HEADER = (
+    "💬 Continued message (Ticket #{ticket_id})\n"
+    "👤 {user}\n"
+    f"{CONTINUATION_RULE}\n"
+).format
+STAFF_REPLY_HEADER = (
+    "💬 Staff reply (Ticket #{ticket_id})\n"
+    "📢 <a href=\"tg://user?id={user_id}\">{username}</a>\n"
+    f"{TICKET_RULE}\n"
+).format
+
+# Long texts: later parts are threaded under the first message, very long ones become a document
+PART_HEADER = "📄 Part {part}/{total} (Ticket #{ticket_id})\n".format
+TEXT_DOCUMENT_NAME = "ticket-{ticket_id}.txt".format
+TEXT_DOCUMENT_CAPTION = "📄 Full text (Ticket #{ticket_id})".format
+LONG_TEXT_PREVIEW = 1000    # Characters of a text sent as document shown in the message itself
+
+# Wrapper body per content type; the fields come from SUMMARY_FIELDS
+CONTENT_SUMMARIES = {
+    'text': "{text}",
+    'photo': "📷 Photo attachment{caption}",
+    'video': "🎬 Video attachment{caption}",
+    'document': "📎 File attachment: {file_name}{caption}",
+    'voice': "🎤 Voice message ({duration}s)",
+    'audio': "🎵 Audio{audio_title}",
+    'video_note': "🎥 Video message",
+    'sticker': "🎭 Sticker: {emoji}",
+    'animation': "🎞️ GIF animation",
+}
+DEFAULT_SUMMARY = "📦 {content_type} type message"
+
+SUMMARY_FIELDS = {
+    'text': lambda m: m.text,
+    'caption': lambda m: f"\nCaption: {m.caption}" if m.caption else '',
+    'file_name': lambda m: m.document.file_name or "Unnamed file",
+    'duration': lambda m: m.voice.duration or 0,
+    'audio_title': lambda m: f": {m.audio.title}" if m.audio.title else " attachment",
+    'emoji': lambda m: m.sticker.emoji or '',
+    'content_type': lambda m: m.content_type,
+}
+
+# Emoji labels for the album summary in the wrapper
+ALBUM_ITEM_LABELS = {
+    'photo': '📷 photo',
+    'video': '🎬 video',
+    'document': '📎 file',
+    'audio': '🎵 audio',
+}
+
+TRUNCATION_MARK = '…'
+HTML_TAG_PATTERN = re.compile(r'<[^>]*>')
+
+# Where a long text is preferably split, best first
+SPLIT_BOUNDARIES = ('\n\n', '\n', ' ')
+
+
+class _SummaryFields(dict):
+    """Template fields of one message, read only when the template uses them"""
+
+    def __init__(self, message: Message):
+        super().__init__()
+        self.message = message
+
+    def __missing__(self, name: str):
+        return SUMMARY_FIELDS[name](self.message)
+
+
+def text_length(text: str) -> int:
+    """Length as Telegram counts it (UTF-16 code units)"""
+    return len(text.encode('utf-16-le')) // 2
+
+
+def html_length(text: str) -> int:
+    """Visible length of an HTML message (tags removed, entities decoded)"""
+    return text_length(html.unescape(HTML_TAG_PATTERN.sub('', text)))
+
+
+def _prefix(text: str, limit: int) -> str:
+    """Longest prefix of text within limit UTF-16 units (a surrogate pair split by the cut is dropped)"""
+    return text.encode('utf-16-le')[:limit * 2].decode('utf-16-le', errors='ignore')
+
+
+def truncate(text: str, limit: int) -> str:
+    """Cut text to at most limit UTF-16 units, marking the cut"""
+    if text_length(text) <= limit:
+        return text
+    return _prefix(text, max(limit - text_length(TRUNCATION_MARK), 0)) + TRUNCATION_MARK
+
+
+def split_text(text: str, limit: int) -> list:
+    """Split text into parts of at most limit UTF-16 units, at paragraph, line or word boundaries if possible"""
+    parts = []
+    while text_length(text) > limit:
+        head = _prefix(text, limit)
+        cut = len(head)
+        for boundary in SPLIT_BOUNDARIES:
+            # Only boundaries in the second half, so parts stay reasonably full
+            index = head.rfind(boundary, len(head) // 2)
+            if index > 0:
+                cut = index + len(boundary)
+                break
+        parts.append(text[:cut])
+        text = text[cut:]
+    parts.append(text)
+    return parts
+
+
+def layout_text(header: str, body: str, ticket_id: int, as_html: bool = False) -> tuple:
+    """
+    Lay out a header and a body of any length as (messages, document)
+    A body too long for one message is split into at most LONG_TEXT_MAX_PARTS
+    messages, later ones under a part header. Longer bodies get a preview in
+    the message and the full text as a .txt document (otherwise None).
+    With as_html the header is HTML and the body parts are escaped.
+    """
+    escape = html.escape if as_html else str
+    room = TEXT_LIMIT - (html_length(header) if as_html else text_length(header))
+    length = text_length(body)
+    if length <= room:
+        return [header + escape(body)], None
+    
+    part_room = TEXT_LIMIT - text_length(PART_HEADER(part=LONG_TEXT_MAX_PARTS, total=LONG_TEXT_MAX_PARTS,
+                                                     ticket_id=ticket_id))
+    room = min(room, part_room)
+    # Checked before splitting, so a huge paste is never split just to find it has too many parts
+    parts = split_text(body, room) if length <= room * LONG_TEXT_MAX_PARTS else None
+    if parts is None or len(parts) > LONG_TEXT_MAX_PARTS:
+        document = BufferedInputFile(body.encode('utf-8'), filename=TEXT_DOCUMENT_NAME(ticket_id=ticket_id))
+        return [header + escape(truncate(body, LONG_TEXT_PREVIEW))], document
+    
+    total = len(parts)
+    return [header + escape(parts[0])] + [
+        PART_HEADER(part=number, total=total, ticket_id=ticket_id) + escape(part)
+        for number, part in enumerate(parts[1:], 2)
+    ], None
+
+
+def user_mention(user: types.User) -> str:
+    """@username, or the full name for users without one"""
+    return f"@{user.username}" if user.username else user.full_name
+
+
+def render_album_summary(album: list) -> str:
+    """Wrapper body of an album: item counts and every caption"""
+    counts = {}
+    for item in album:
+        label = ALBUM_ITEM_LABELS.get(item.content_type, '📦 other')
+        counts[label] = counts.get(label, 0) + 1
+    summary = ", ".join(f"{count} {label}" for label, count in counts.items())
+    text = f"🖼️ Album ({len(album)} items: {summary})"
+    captions = [item.caption for item in album if item.caption]
+    if captions:
+        text += "\nCaption: " + "\n".join(captions)
+    return text
+
+
+def render_wrapper(ticket_id: int, message: Message, album: Optional[list] = None) -> tuple:
+    """Wrapper of a new ticket (header plus full text or a content summary) as layout_text() (messages, document)"""
+    header = WRAPPER_HEADER(ticket_id=ticket_id, group=message.chat.title, user=user_mention(message.from_user))
+    if album:
+        body = render_album_summary(album)
+    else:
+        body = CONTENT_SUMMARIES.get(message.content_type, DEFAULT_SUMMARY).format_map(_SummaryFields(message))
+    return layout_text(header, body, ticket_id)
+
+
+def render_continuation_header(ticket_id: int, user: types.User) -> str:
+    """Header above a customer's continued message in the staff group"""
+    return CONTINUATION_HEADER(ticket_id=ticket_id, user=user_mention(user))
+
+
+def render_staff_reply(ticket: dict, message: Message) -> tuple:
+    """
+    HTML staff reply to the customer group as layout_text() (messages, document)
+    The staff member's formatting is kept; a reply too long for one message is
+    split as plain text instead (splitting HTML could leave a tag open).
+    """
+    header = STAFF_REPLY_HEADER(
+        ticket_id=ticket['ticket_id'], user_id=ticket['user_id'], username=html.escape(ticket['username'])
+    )
+    text = message.text or message.caption
+    if not text:
+        return [header], None
+    body = message.html_text
+    if html_length(header + body) <= TEXT_LIMIT:
+        return [header + body], None
+    return layout_text(header, text, ticket['ticket_id'], as_html=True)
+
+
+# ======================== Outbound Send Queue ========================
+
+# Priority lanes (lower value is sent first)
+PRIORITY_STAFF_REPLY = 0    # Staff replies to customers
+PRIORITY_CONTINUATION = 1   # Customer continued messages to staff
+PRIORITY_WRAPPER = 2        # New ticket wrappers and their media copies
+PRIORITY_NOTICE = 3         # Confirmations and error notices
+
+# Content types that cannot take a caption when copied
+CAPTIONLESS_CONTENT_TYPES = ('video_note', 'sticker')
+
+# Transient errors worth retrying with exponential backoff
+RETRYABLE_SEND_ERRORS = (TelegramNetworkError, TelegramServerError)
+
+
+def _drop_defaults(value):
+    """Remove unresolved bot defaults (parse_mode etc.) from a dumped method, they are re-applied on load"""
+    if isinstance(value, dict):
+        return {key: _drop_defaults(item) for key, item in value.items() if not isinstance(item, Default)}
+    if isinstance(value, list):
+        return [_drop_defaults(item) for item in value]
+    return value
+
+
+def dump_method(method: TelegramMethod) -> str:
+    """JSON payload of a Bot API call (TypeError for calls that upload local files)"""
+    return json.dumps(_drop_defaults(method.model_dump(exclude_none=True)), ensure_ascii=False)
+
+
+def load_method(name: str, payload: str) -> TelegramMethod:
+    """Rebuild a Bot API call from its class name and dump_method() payload"""
+    method_class = getattr(aiogram.methods, name, None)
+    if not (isinstance(method_class, type) and issubclass(method_class, TelegramMethod)):
+        raise ValueError(f"unknown Bot API method {name}")
+    return method_class.model_validate(json.loads(payload))
+
+
+class TokenBucket:
+    """Token bucket rate limiter (rate tokens per second, up to capacity)"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Seconds until one token is available (0 if available now)"""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        """Consume one token"""
+        self._refill(now)
+        self.tokens -= 1
+
+
+class _SendJob:
+    """One queued Bot API call"""
+
+    __slots__ = ('method', 'priority', 'seq', 'future', 'durable', 'attempts', 'log_context')
+
+    def __init__(self, method: TelegramMethod, priority: int, seq: int, future: asyncio.Future,
+                 durable: bool = False):
+        self.method = method
+        self.priority = priority
+        self.seq = seq
+        self.future = future
+        self.durable = durable      # recorded in the outbox already
+        self.attempts = 0
+        self.log_context = log_context.get()  # retries are logged with the submitting update's fields
+
+    def __lt__(self, other: '_SendJob') -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class _ChatLane:
+    """Pending jobs and flood-control state for one chat"""
+
+    __slots__ = ('bucket', 'jobs', 'busy', 'blocked_until')
 
-# ======================== Configuration (Environment Variables) ========================
-# Required environment variables:
-#   TELEGRAM_BOT_TOKEN - Your bot token from @BotFather
-#   STAFF_GROUP_ID - Staff group ID (negative integer for groups)
-#   ADMIN_USER_ID - Admin's Telegram user ID (positive integer)
-#
-# Example usage:
-#   TELEGRAM_BOT_TOKEN=123456:ABC-DEF... STAFF_GROUP_ID=-1001234567890 ADMIN_USER_ID=123456789 python bot.py
-# =======================================================================================
+    def __init__(self, bucket: TokenBucket):
+        self.bucket = bucket
+        self.jobs = []              # heap of _SendJob, ordered by (priority, seq)
+        self.busy = False           # one request in flight per chat keeps order
+        self.blocked_until = 0.0    # set by RetryAfter / backoff
 
-def get_env_config():
-    """Load and validate configuration from environment variables"""
-    # Get API_TOKEN
-    api_token = os.getenv('TELEGRAM_BOT_TOKEN')
-    if not api_token:
-        raise ValueError("Environment variable TELEGRAM_BOT_TOKEN is required but not set")
-    
-    # Get STAFF_GROUP_ID
-    staff_group_id_str = os.getenv('STAFF_GROUP_ID')
-    if not staff_group_id_str:
-        raise ValueError("Environment variable STAFF_GROUP_ID is required but not set")
-    
-    try:
-        staff_group_id = int(staff_group_id_str)
-    except ValueError:
-        raise ValueError(f"STAFF_GROUP_ID must be a valid integer, got: {staff_group_id_str}")
-    
-    # Get ADMIN_USER_ID
-    admin_user_id_str = os.getenv('ADMIN_USER_ID')
-    if not admin_user_id_str:
-        raise ValueError("Environment variable ADMIN_USER_ID is required but not set")
+
+class SendQueue:
+    """
+    Outbound Telegram dispatcher with flood-control scheduling
+
+    Every send goes through a per-chat token bucket (~20 msg/min for groups,
+    1 msg/s for private chats) and a global bucket (~30 msg/s). Within a chat
+    jobs are sent one at a time in priority order, so staff replies overtake
+    queued wrappers. TelegramRetryAfter pauses only the affected chat for the
+    requested time, and network/server errors are retried with backoff.
+    """
+
+    def __init__(self, bot: Bot, global_rate: int, group_rate_per_min: int,
+                 group_burst: int, max_in_flight: int, max_attempts: int):
+        self.bot = bot
+        self.group_rate = group_rate_per_min / 60
+        self.group_burst = group_burst
+        self.max_attempts = max_attempts
+        self.max_in_flight = max_in_flight
+        self._global = TokenBucket(global_rate, global_rate)
+        self._lanes = {}
+        self._waiting = set()       # chat IDs with queued jobs
+        self._seq = 0
+        self._pending = 0
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._idle: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._in_flight = set()
+
+    @property
+    def pending(self) -> int:
+        """Number of queued or in-flight jobs"""
+        return self._pending
+
+    def start(self):
+        """Start the scheduler task (inside the running event loop)"""
+        self._slots = asyncio.Semaphore(self.max_in_flight)
+        self._wakeup = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self, timeout: float = 10) -> list:
+        """
+        Wait (up to timeout) for queued sends to finish, then stop the scheduler
+        
+        Returns:
+            [(method, priority)] of the calls that never started and whose
+            result is still wanted, oldest first (outbox calls are not included,
+            their rows are retried anyway)
+        """
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Send queue closed with %d unsent jobs", self._pending)
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        # A call in flight may already have reached Telegram: stop it, but never resend it
+        for task in self._in_flight:
+            task.cancel()
+        await asyncio.gather(*self._in_flight, return_exceptions=True)
+        unsent = [
+            job for lane in self._lanes.values() for job in lane.jobs if not (job.future.done() or job.durable)
+        ]
+        for lane in self._lanes.values():
+            for job in lane.jobs:
+                job.future.cancel()
+            lane.jobs.clear()
+        self._waiting.clear()
+        self._pending = 0
+        self._idle.set()
+        return [(job.method, job.priority) for job in sorted(unsent, key=lambda job: job.seq)]
+
+    def submit(self, method: TelegramMethod, priority: int, durable: bool = False) -> asyncio.Future:
+        """Queue a Bot API call, returns a future with the call result (durable: an outbox call)"""
+        future = asyncio.get_running_loop().create_future()
+        chat_id = method.chat_id
+        lane = self._lanes.get(chat_id)
+        if lane is None:
+            if isinstance(chat_id, int) and chat_id > 0:
+                bucket = TokenBucket(1, 1)
+            else:
+                bucket = TokenBucket(self.group_rate, self.group_burst)
+            lane = self._lanes[chat_id] = _ChatLane(bucket)
+        self._seq += 1
+        heapq.heappush(lane.jobs, _SendJob(method, priority, self._seq, future, durable))
+        self._waiting.add(chat_id)
+        self._pending += 1
+        self._idle.clear()
+        self._wakeup.set()
+        return future
+
+    def post(self, method: TelegramMethod, priority: int, what: str = "send message"):
+        """Queue a Bot API call without waiting for it (failures are logged)"""
+        def log_failure(future: asyncio.Future):
+            if not future.cancelled() and future.exception():
+                logger.warning("Failed to %s: %s", what, future.exception())
+        self.submit(method, priority).add_done_callback(log_failure)
+
+    def _next_job(self, now: float):
+        """Pick the best ready job, returns (chat_id, lane, job) or the wait time"""
+        best = None
+        wait = None
+        for chat_id in self._waiting:
+            lane = self._lanes[chat_id]
+            if lane.busy:
+                continue
+            delay = max(lane.blocked_until - now, lane.bucket.delay(now))
+            if delay > 0:
+                wait = delay if wait is None else min(wait, delay)
+            elif best is None or lane.jobs[0] < best[2]:
+                best = (chat_id, lane, lane.jobs[0])
+        return best, wait
+
+    async def _run(self):
+        """Scheduler loop: dispatch ready jobs within the flood limits"""
+        while True:
+            now = time.monotonic()
+            best, wait = self._next_job(now)
+            if best is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            global_delay = self._global.delay(now)
+            if global_delay > 0:
+                # Re-evaluate afterwards, a higher priority job may arrive meanwhile
+                await asyncio.sleep(global_delay)
+                continue
+
+            await self._slots.acquire()
+            chat_id, lane, _ = best
+            job = heapq.heappop(lane.jobs)
+            if not lane.jobs:
+                self._waiting.discard(chat_id)
+            now = time.monotonic()
+            lane.bucket.take(now)
+            self._global.take(now)
+            lane.busy = True
+            task = asyncio.create_task(self._execute(chat_id, lane, job))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _execute(self, chat_id, lane: _ChatLane, job: _SendJob):
+        """Perform one call; requeue it at the head of its lane on flood control"""
+        retry_delay = None
+        log_context.set(job.log_context)
+        try:
+            if job.future.cancelled():
+                return
+            job.attempts += 1
+            try:
+                result = await self.bot(job.method)
+            except TelegramRetryAfter as e:
+                retry_delay = e.retry_after
+                SEND_RETRIES.inc('flood_control')
+                logger.warning("Flood control in chat %s, retry in %ss", chat_id, e.retry_after)
+                if job.attempts >= self.max_attempts:
+                    raise
+            except RETRYABLE_SEND_ERRORS as e:
+                retry_delay = min(30.0, 0.5 * 2 ** job.attempts)
+                SEND_RETRIES.inc('network')
+                logger.warning("Send to chat %s failed (%s), retry in %.1fs", chat_id, e, retry_delay)
+                if job.attempts >= self.max_attempts:
+                    raise
+            else:
+                job.future.set_result(result)
+        except asyncio.CancelledError:
+            retry_delay = None
+            job.future.cancel()
+            raise
+        except Exception as e:
+            retry_delay = None
+            if not job.future.done():
+                job.future.set_exception(e)
+        finally:
+            if retry_delay is not None:
+                lane.blocked_until = time.monotonic() + retry_delay
+                heapq.heappush(lane.jobs, job)
+                self._waiting.add(chat_id)
+            else:
+                self._pending -= 1
+                if not self._pending:
+                    self._idle.set()
+            lane.busy = False
+            self._slots.release()
+            self._wakeup.set()
+
+
+async def send_header_and_copy(header: SendMessage, copy: CopyMessage, priority: int,
+                               key: Optional[str] = None, action: Optional[dict] = None,
+                               copy_action: Optional[dict] = None):
+    """
+    Send a text header and a message copy to the same chat
+    Without a key both calls are queued at once (the queue keeps their order
+    within the chat), so the caller waits for one pipeline instead of two
+    sequential round trips. With an idempotency key the header goes through
+    the durable outbox and the copy follows it: queued as soon as the header
+    is sent, or kept as a follow-up (keyed <key>:copy, applying copy_action)
+    if the header is deferred, so the copy never reaches the chat before it.
     
-    try:
-        admin_user_id = int(admin_user_id_str)
-    except ValueError:
-        raise ValueError(f"ADMIN_USER_ID must be a valid integer, got: {admin_user_id_str}")
+    Returns:
+        (header result, copy result, copy exception or None); raises if the header failed
+    """
+    if key:
+        follow_ups = [Outbox.follow_up(copy, priority, f"{key}:copy", copy_action), *action.get('follow_ups', ())]
+        copy_call = None
+        
+        def queue_copy(_):
+            nonlocal copy_call
+            copy_call = send_queue.submit(copy, priority)
+        
+        header_result = await outbox.send(
+            header, priority, key, {**action, 'follow_ups': follow_ups}, on_sent=queue_copy
+        )
+        try:
+            return header_result, await copy_call, None
+        except Exception as e:
+            return header_result, None, e
+    header_result, copy_result = await asyncio.gather(
+        send_queue.submit(header, priority),
+        send_queue.submit(copy, priority),
+        return_exceptions=True
+    )
+    if isinstance(header_result, Exception):
+        raise header_result
+    if isinstance(copy_result, Exception):
+        return header_result, None, copy_result
+    return header_result, copy_result, None
+
+
+async def send_text_parts(chat_id: int, parts: list, document: Optional[BufferedInputFile],
+                          reply_to_message_id: int, priority: int, ticket_id: int,
+                          parse_mode: Optional[str] = None):
+    """
+    Send the rest of a layout_text() layout under the same message as its first part
+    The later parts and the document are queued at once (the chat lane keeps
+    their order). They go through the in-memory queue only; if the first part
+    is deferred, text_part_follow_ups() keeps them with it instead.
     
-    return api_token, staff_group_id, admin_user_id
+    Returns:
+        (sent messages, first exception or None)
+    """
+    calls = [
+        send_queue.submit(
+            SendMessage(chat_id=chat_id, text=part, reply_to_message_id=reply_to_message_id, parse_mode=parse_mode),
+            priority
+        )
+        for part in parts
+    ]
+    if document is not None:
+        calls.append(send_queue.submit(
+            SendDocument(
+                chat_id=chat_id,
+                document=document,
+                caption=TEXT_DOCUMENT_CAPTION(ticket_id=ticket_id),
+                reply_to_message_id=reply_to_message_id
+            ),
+            priority
+        ))
+    results = await asyncio.gather(*calls, return_exceptions=True)
+    errors = [result for result in results if isinstance(result, Exception)]
+    return [result for result in results if not isinstance(result, Exception)], (errors[0] if errors else None)
 
 
-# Load configuration
-API_TOKEN, STAFF_GROUP_ID, ADMIN_USER_ID = get_env_config()
+def text_part_follow_ups(chat_id: int, parts: list, document: Optional[BufferedInputFile],
+                         reply_to_message_id: Optional[int], priority: int, ticket_id: int, key: str,
+                         action: dict, parse_mode: Optional[str] = None) -> list:
+    """
+    Outbox follow-ups (see TicketStore) posting what send_text_parts() would
+    Parts are keyed <key>:part<n>; without reply_to_message_id they reply to
+    the call they follow. The document is an upload and cannot be stored, a
+    note in the staff group stands in for it (pass None to tell staff otherwise).
+    """
+    follow_ups = [
+        Outbox.follow_up(
+            SendMessage(chat_id=chat_id, text=part, reply_to_message_id=reply_to_message_id, parse_mode=parse_mode),
+            priority, f"{key}:part{n}", action
+        )
+        for n, part in enumerate(parts, 1)
+    ]
+    if document is not None:
+        follow_ups.append(Outbox.follow_up(
+            SendMessage(
+                chat_id=STAFF_GROUP_ID,
+                text=f"⚠️ The full text of ticket #{ticket_id} was too long to keep for the delayed delivery, "
+                     f"see the customer's message",
+                reply_to_message_id=reply_to_message_id
+            ),
+            priority, f"{key}:document"
+        ))
+    return follow_ups
+
+
+def sent_message_ids(*results) -> list:
+    """Message IDs from send/copy results (Message, MessageId, lists of them; None is skipped)"""
+    message_ids = []
+    for result in results:
+        if isinstance(result, list):
+            message_ids.extend(item.message_id for item in result)
+        elif result is not None and not isinstance(result, Exception):
+            message_ids.append(result.message_id)
+    return message_ids
+
+
+def queue_reply(message: Message, text: str, **kwargs):
+    """Reply to a message through the send queue without waiting (notices, confirmations)"""
+    send_queue.post(message.reply(text, **kwargs), PRIORITY_NOTICE, what="send reply")
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+send_queue = SendQueue(
+    bot,
+    global_rate=OUTBOUND_GLOBAL_RATE,
+    group_rate_per_min=OUTBOUND_GROUP_RATE,
+    group_burst=OUTBOUND_GROUP_BURST,
+    max_in_flight=OUTBOUND_MAX_IN_FLIGHT,
+    max_attempts=OUTBOUND_MAX_ATTEMPTS,
 )
-logger = logging.getLogger(__name__)
+metrics.gauge('bot_send_queue_pending', 'Queued or in-flight Bot API calls', lambda: send_queue.pending)
 
-# Database filename
-DB_NAME = 'tickets.db'
 
+# ======================== Durable Outbox ========================
 
-# ======================== Database Operations ========================
+OUTBOX_POLL_SECONDS = 2                 # How often the worker looks for due calls
+OUTBOX_LEASE_SECONDS = 300              # A claimed call is due again after this (its instance died)
+OUTBOX_BATCH_SIZE = 50                  # Calls the worker delivers at a time
+OUTBOX_BACKOFF_SECONDS = 5              # Delay before the first retry round, doubled per round...
+OUTBOX_MAX_BACKOFF_SECONDS = 600        # ...up to this
+OUTBOX_PURGE_INTERVAL_SECONDS = 3600    # How often finished calls past OUTBOX_RETENTION_HOURS are deleted
 
-def check_and_migrate_db():
-    """Check and migrate database (idempotent operation)"""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    
-    # Check if tickets table has status and closed_at fields
-    cursor.execute("PRAGMA table_info(tickets)")
-    columns = [row[1] for row in cursor.fetchall()]
-    
-    # Add status field if not exists
-    if 'status' not in columns:
-        logger.info("Migration: Adding status column")
-        cursor.execute("ALTER TABLE tickets ADD COLUMN status TEXT NOT NULL DEFAULT 'open'")
-        conn.commit()
-    
-    # Add closed_at field if not exists
-    if 'closed_at' not in columns:
-        logger.info("Migration: Adding closed_at column")
-        cursor.execute("ALTER TABLE tickets ADD COLUMN closed_at INTEGER DEFAULT NULL")
-        conn.commit()
-    
-    conn.close()
-    logger.info("Database migration check completed")
 
+class SendDeferred(Exception):
+    """An outbox call was not delivered yet, the outbox worker keeps retrying it"""
 
-def init_db():
-    """Initialize database and create necessary tables"""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    
-    # Create customer groups table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS customer_groups (
-            group_id INTEGER PRIMARY KEY
+
+class DuplicateSend(Exception):
+    """The idempotency key was used before: the update behind the call was already handled"""
+
+
+class Outbox:
+    """
+    Durable Bot API calls (staff replies, ticket wrappers, continuations)
+
+    send() records the call in the outbox table before the first attempt,
+    under an idempotency key derived from the update that caused it, so an
+    update handled twice (delivered again after a restart) raises
+    DuplicateSend instead of sending twice. The call then goes through the
+    send queue like any other; once it is sent, the row is marked sent
+    together with its follow-up action (ticket mapping, anchor, message map)
+    in one transaction, so a crash can no longer separate the two. Calls that
+    go under it (parts of a long text, an attachment copy) are posted by the
+    handler once it is sent, or recorded as follow-up rows by that transaction
+    when the worker delivers it.
+
+    When the send queue gives up on a transient error (network, 5xx, flood
+    control) the caller gets SendDeferred and the worker retries the call
+    with exponential backoff and jitter, up to max_attempts rounds; permanent
+    errors and exhausted retries leave it in the dead letters (status 'dead').
+    Calls of an instance that died are retried once their lease runs out.
+    The Bot API has no idempotency keys, so a call that reached Telegram just
+    before a crash is sent again (at least once, never lost).
+    """
+
+    def __init__(self, max_attempts: int, retention_hours: int):
+        self.max_attempts = max(1, max_attempts)
+        self.retention_ms = retention_hours * 3600 * 1000
+        self._owned = set()         # outbox IDs this instance is delivering
+        self._retrying = set()      # ... of them, claimed by the worker
+        self._deliveries = set()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Start the retry worker (inside the running event loop)"""
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Stop the worker; calls still in progress are made due now for the next start"""
+        if self._task:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        # Their send queue jobs end with send_queue.close()
+        await asyncio.gather(*self._deliveries, return_exceptions=True)
+        if self._owned:
+            try:
+                await store.release_outbox_calls(sorted(self._owned))
+            except Exception as e:
+                logger.warning("Failed to release %s outbox calls: %s", len(self._owned), e)
+            self._owned.clear()
+
+    async def record(self, method: TelegramMethod, priority: int, key: str, action: Optional[dict] = None) -> int:
+        """Write a call to the outbox, returns its ID (DuplicateSend if the key was used before)"""
+        lease_until = int(time.time() * 1000) + OUTBOX_LEASE_SECONDS * 1000
+        outbox_id = await store.add_outbox_call(
+            key, type(method).__name__, dump_method(method), priority, action, lease_until
         )
-    ''')
+        if outbox_id is None:
+            OUTBOX_EVENTS.inc('duplicate')
+            raise DuplicateSend(key)
+        self._owned.add(outbox_id)
+        return outbox_id
+
+    def deliver(self, outbox_id: int, method: TelegramMethod, priority: int, action: Optional[dict] = None,
+                attempts: int = 0, background: bool = False, on_sent=None) -> asyncio.Future:
+        """
+        Queue a recorded call right away, returns a future with its result
+        The outcome is recorded even if the caller stops waiting. on_sent(result)
+        runs as soon as the call is sent, while its row is still being written.
+        """
+        self._owned.add(outbox_id)
+        future = send_queue.submit(method, priority, durable=True)
+        task = asyncio.create_task(self._settle(outbox_id, method, future, action, attempts, background, on_sent))
+        self._deliveries.add(task)
+        task.add_done_callback(self._deliveries.discard)
+        return asyncio.shield(task)
+
+    async def send(self, method: TelegramMethod, priority: int, key: str, action: Optional[dict] = None,
+                   on_sent=None):
+        """Record and send a call, returns its result (raises SendDeferred / DuplicateSend, see class doc)"""
+        outbox_id = await self.record(method, priority, key, action)
+        return await self.deliver(outbox_id, method, priority, action, on_sent=on_sent)
+
+    @staticmethod
+    def follow_up(method: TelegramMethod, priority: int, key: str, action: Optional[dict] = None) -> dict:
+        """Entry of an action's 'follow_ups' (see TicketStore): a call posted after it if the worker delivers it"""
+        return {
+            'key': key, 'method': type(method).__name__, 'payload': dump_method(method),
+            'priority': priority, 'action': action
+        }
+
+    @staticmethod
+    def backoff(attempts: int, error: Exception) -> float:
+        """Seconds before the next round: exponential with jitter, at least the RetryAfter"""
+        delay = min(OUTBOX_MAX_BACKOFF_SECONDS, OUTBOX_BACKOFF_SECONDS * 2 ** (attempts - 1))
+        return max(delay * random.uniform(0.5, 1.0), getattr(error, 'retry_after', 0))
+
+    async def _settle(self, outbox_id: int, method: TelegramMethod, future: asyncio.Future,
+                      action: Optional[dict], attempts: int, background: bool, on_sent=None):
+        """Wait for one delivery round and record its outcome"""
+        name = type(method).__name__
+        try:
+            result = await future
+        except (TelegramRetryAfter, *RETRYABLE_SEND_ERRORS) as e:
+            attempts += 1
+            if attempts >= self.max_attempts:
+                await self._fail(outbox_id, name, attempts, e, action, background)
+                raise
+            delay = self.backoff(attempts, e)
+            await store.retry_outbox_call(outbox_id, attempts, int((time.time() + delay) * 1000), str(e))
+            self._owned.discard(outbox_id)
+            OUTBOX_EVENTS.inc('deferred')
+            logger.warning("Outbox %s #%s not delivered (%s), retry %d in %.0fs", name, outbox_id, e, attempts, delay)
+            raise SendDeferred(str(e)) from e
+        except Exception as e:
+            await self._fail(outbox_id, name, attempts + 1, e, action, background)
+            raise
+
+        if not background and action and 'follow_ups' in action:
+            # The waiting handler posts them (see TicketStore)
+            action = {field: value for field, value in action.items() if field != 'follow_ups'}
+        if on_sent is not None:
+            on_sent(result)
+        try:
+            await store.finish_outbox_call(outbox_id, sent_message_ids(result), action, int(time.time() * 1000))
+        except Exception as e:
+            logger.error("Outbox %s #%s was sent but not recorded, it may be sent again: %s", name, outbox_id, e)
+            raise
+        self._owned.discard(outbox_id)
+        OUTBOX_EVENTS.inc('sent')
+        if background and action and action['kind'] == 'staff_reply':
+            send_queue.post(
+                SendMessage(
+                    chat_id=STAFF_GROUP_ID,
+                    text=f"✅ Delayed reply to ticket #{action['ticket_id']} delivered",
+                    reply_to_message_id=action['reply_msg_id']
+                ),
+                PRIORITY_NOTICE, what="send outbox notice"
+            )
+        return result
+
+    async def _fail(self, outbox_id: int, name: str, attempts: int, error: Exception,
+                    action: Optional[dict], background: bool):
+        """Move a call to the dead letters (staff are told about calls no handler reports)"""
+        await store.fail_outbox_call(outbox_id, attempts, str(error), int(time.time() * 1000))
+        self._owned.discard(outbox_id)
+        OUTBOX_EVENTS.inc('dead')
+        logger.error("Outbox %s #%s dead-lettered after %d rounds: %s", name, outbox_id, attempts, error)
+        if background and action:
+            send_queue.post(
+                SendMessage(
+                    chat_id=STAFF_GROUP_ID,
+                    text=f"❌ A delayed message of ticket #{action['ticket_id']} could not be delivered: {error}",
+                    reply_to_message_id=action.get('reply_msg_id')
+                ),
+                PRIORITY_NOTICE, what="send outbox notice"
+            )
+
+    def _retried(self, outbox_id: int, delivery: asyncio.Future):
+        self._retrying.discard(outbox_id)
+        if not delivery.cancelled():
+            delivery.exception()  # outcome already recorded and logged
+
+    async def _run(self):
+        """Worker: deliver due calls (retries, calls left by stopped instances), purge finished ones"""
+        purge_at = 0.0
+        while True:
+            try:
+                now = time.time()
+                if now >= purge_at:
+                    purge_at = now + OUTBOX_PURGE_INTERVAL_SECONDS
+                    purged = await store.purge_outbox(int(now * 1000) - self.retention_ms)
+                    if purged:
+                        logger.info("Purged %s finished outbox calls", purged)
+                room = OUTBOX_BATCH_SIZE - len(self._retrying)
+                rows = []
+                if room > 0:
+                    now_ms = int(now * 1000)
+                    rows = await store.claim_outbox_calls(now_ms, now_ms + OUTBOX_LEASE_SECONDS * 1000, room)
+                for row in rows:
+                    if row['id'] in self._owned:
+                        continue
+                    try:
+                        method = load_method(row['method'], row['payload'])
+                    except Exception as e:
+                        await self._fail(row['id'], row['method'], row['attempts'], e, row['action'], True)
+                        continue
+                    self._retrying.add(row['id'])
+                    delivery = self.deliver(
+                        row['id'], method, row['priority'], row['action'], row['attempts'], background=True
+                    )
+                    delivery.add_done_callback(functools.partial(self._retried, row['id']))
+            except Exception as e:
+                logger.warning("Outbox worker failed: %s", e)
+            await asyncio.sleep(OUTBOX_POLL_SECONDS)
+
+
+outbox = Outbox(OUTBOX_MAX_ATTEMPTS, OUTBOX_RETENTION_HOURS)
+
+
+# ======================== Media Albums ========================
+
+# Maximum number of items in a Telegram album
+ALBUM_MAX_ITEMS = 10
+
+# Coalesced text replies are forwarded at once when this many are buffered
+COALESCE_MAX_MESSAGES = 10
+
+
+class MessageBuffer:
+    """
+    Debounced per-key message collector
     
-    # Create tickets mapping table (with status and closed_at)
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS tickets (
-            staff_msg_id INTEGER PRIMARY KEY,
-            ticket_id INTEGER NOT NULL,
-            cust_group_id INTEGER,
-            cust_msg_id INTEGER,
-            user_id INTEGER,
-            username TEXT,
-            customer_anchor_msg_id INTEGER,
-            status TEXT NOT NULL DEFAULT 'open',
-            closed_at INTEGER DEFAULT NULL
-        )
-    ''')
+    Messages added under the same key are held until none arrives for `window`
+    seconds (or max_items is reached), then handed to on_flush(key, messages)
+    as one batch in a background task.
+    """
+
+    def __init__(self, window: float, on_flush, max_items: int = 0):
+        self.window = window
+        self.on_flush = on_flush
+        self.max_items = max_items
+        self._batches = {}      # key -> list of messages
+        self._timers = {}       # key -> asyncio.TimerHandle
+        self._tasks = set()     # running on_flush tasks
+
+    @property
+    def pending(self) -> int:
+        """Number of buffered messages not yet flushed"""
+        return sum(len(batch) for batch in self._batches.values())
+
+    def add(self, key, message: Message):
+        """Buffer a message and restart the key's debounce timer"""
+        batch = self._batches.setdefault(key, [])
+        batch.append(message)
+        timer = self._timers.pop(key, None)
+        if timer:
+            timer.cancel()
+        if self.max_items and len(batch) >= self.max_items:
+            self._flush(key)
+        else:
+            self._timers[key] = asyncio.get_running_loop().call_later(self.window, self._flush, key)
+
+    def take(self, key) -> list:
+        """Remove and return the key's buffered messages without flushing them (the caller handles them)"""
+        timer = self._timers.pop(key, None)
+        if timer:
+            timer.cancel()
+        return self._batches.pop(key, [])
+
+    def _flush(self, key):
+        timer = self._timers.pop(key, None)
+        if timer:
+            timer.cancel()
+        batch = self._batches.pop(key, None)
+        if not batch:
+            return
+        task = asyncio.create_task(self._run(key, batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, key, batch: list):
+        name = self.on_flush.__name__
+        start = time.perf_counter()
+        try:
+            await self.on_flush(key, batch)
+        except Exception as e:
+            HANDLER_ERRORS.inc(name)
+            logger.error("Failed to handle buffered messages %s: %s", key, e, exc_info=True)
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - start, name)
+
+    async def close(self):
+        """Flush everything still buffered and wait for the handlers to finish"""
+        for key in list(self._batches):
+            self._flush(key)
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+def build_album_media(messages: list, header: str = '') -> Optional[list]:
+    """
+    Build InputMedia items re-sending an album by file_id (keeps it grouped)
+    The header is prepended to the first caption. Returns None if an item
+    cannot be part of a media group or the first caption would be too long.
+    """
+    media = []
+    for index, message in enumerate(messages):
+        caption = message.caption
+        entities = message.caption_entities
+        if index == 0 and header:
+            caption = header + (caption or '')
+            entities = None
+            if text_length(caption) > CAPTION_LIMIT:
+                return None
+        
+        if message.photo:
+            media_type, file_id = InputMediaPhoto, message.photo[-1].file_id
+        elif message.video:
+            media_type, file_id = InputMediaVideo, message.video.file_id
+        elif message.document:
+            media_type, file_id = InputMediaDocument, message.document.file_id
+        elif message.audio:
+            media_type, file_id = InputMediaAudio, message.audio.file_id
+        else:
+            return None
+        media.append(media_type(media=file_id, caption=caption, caption_entities=entities))
+    return media
+
+
+async def send_album_copy(messages: list, reply_to_message_id: int, priority: int, header: str = ''):
+    """
+    Copy a customer album to the staff group with a single call
     
-    conn.commit()
-    conn.close()
-    logger.info("Database initialization completed")
+    Sent as one media group replying to reply_to_message_id, with the header
+    in the first caption. If that is not possible, the header is sent as its
+    own message and the album is copied with copy_messages (which cannot reply,
+    so the copy is not threaded).
     
-    # Execute migration check (for existing tables)
-    check_and_migrate_db()
+    Returns:
+        List of sent messages / message IDs (header first, if sent separately)
+    """
+    media = build_album_media(messages, header)
+    if media:
+        try:
+            return await send_queue.submit(
+                SendMediaGroup(
+                    chat_id=STAFF_GROUP_ID,
+                    media=media,
+                    reply_to_message_id=reply_to_message_id
+                ),
+                priority
+            )
+        except Exception as e:
+            logger.warning("send_media_group failed, using copy_messages: %s", e)
+            COPY_FALLBACKS.inc('album')
+    
+    copy_method = CopyMessages(
+        chat_id=STAFF_GROUP_ID,
+        from_chat_id=messages[0].chat.id,
+        message_ids=[m.message_id for m in messages]
+    )
+    if not header:
+        return await send_queue.submit(copy_method, priority)
+    header_msg, copied, copy_error = await send_header_and_copy(
+        SendMessage(chat_id=STAFF_GROUP_ID, text=header, reply_to_message_id=reply_to_message_id),
+        copy_method,
+        priority
+    )
+    if copy_error:
+        raise copy_error
+    return [header_msg, *copied]
 
 
-def is_customer_group(group_id: int) -> bool:
-    """Check if group is in customer groups list"""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('SELECT group_id FROM customer_groups WHERE group_id = ?', (group_id,))
-    result = cursor.fetchone()
-    conn.close()
-    return result is not None
+# ======================== Update Scheduling ========================
 
+class KeyedLock:
+    """asyncio locks created on demand per key (FIFO per key), dropped when unused"""
 
-def add_customer_group(group_id: int) -> bool:
-    """Add customer group"""
-    try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        cursor.execute('INSERT OR IGNORE INTO customer_groups (group_id) VALUES (?)', (group_id,))
-        conn.commit()
-        conn.close()
-        return True
-    except Exception as e:
-        logger.error(f"Failed to add customer group: {e}")
-        return False
+    def __init__(self):
+        self._locks = {}    # key -> [asyncio.Lock, holders + waiters]
 
+    def __len__(self) -> int:
+        return len(self._locks)
 
-def remove_customer_group(group_id: int) -> bool:
-    """Remove customer group"""
-    try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        cursor.execute('DELETE FROM customer_groups WHERE group_id = ?', (group_id,))
-        conn.commit()
-        conn.close()
-        return True
-    except Exception as e:
-        logger.error(f"Failed to remove customer group: {e}")
-        return False
+    @contextlib.asynccontextmanager
+    async def hold(self, key):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
 
 
-def get_all_customer_groups() -> list:
-    """Get all customer group IDs"""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('SELECT group_id FROM customer_groups')
-    groups = [row[0] for row in cursor.fetchall()]
-    conn.close()
-    return groups
-
-
-def save_ticket(staff_msg_id: int, ticket_id: int, cust_group_id: int, 
-                cust_msg_id: int, user_id: int, username: str):
-    """Save ticket mapping (staff_msg_id is wrapper message ID)"""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT OR REPLACE INTO tickets 
-        (staff_msg_id, ticket_id, cust_group_id, cust_msg_id, user_id, username, 
-         customer_anchor_msg_id, status, closed_at)
-        VALUES (?, ?, ?, ?, ?, ?, NULL, 'open', NULL)
-    ''', (staff_msg_id, ticket_id, cust_group_id, cust_msg_id, user_id, username))
-    conn.commit()
-    conn.close()
-
-
-def get_ticket(staff_msg_id: int) -> Optional[dict]:
-    """Get ticket info by staff group wrapper message ID"""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT staff_msg_id, ticket_id, cust_group_id, cust_msg_id, user_id, username, 
-               customer_anchor_msg_id, status, closed_at
-        FROM tickets 
-        WHERE staff_msg_id = ?
-    ''', (staff_msg_id,))
-    result = cursor.fetchone()
-    conn.close()
-    
-    if result:
-        return {
-            'staff_msg_id': result[0],
-            'ticket_id': result[1],
-            'cust_group_id': result[2],
-            'cust_msg_id': result[3],
-            'user_id': result[4],
-            'username': result[5],
-            'customer_anchor_msg_id': result[6],
-            'status': result[7],
-            'closed_at': result[8]
-        }
-    return None
-
-
-def get_ticket_by_customer_anchor(chat_id: int, anchor_msg_id: int) -> Optional[dict]:
-    """Get ticket info by customer group anchor message ID (for continued conversation)"""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT staff_msg_id, ticket_id, cust_group_id, cust_msg_id, user_id, username, 
-               customer_anchor_msg_id, status, closed_at
-        FROM tickets 
-        WHERE cust_group_id = ? AND customer_anchor_msg_id = ?
-    ''', (chat_id, anchor_msg_id))
-    result = cursor.fetchone()
-    conn.close()
-    
-    if result:
-        return {
-            'staff_msg_id': result[0],
-            'ticket_id': result[1],
-            'cust_group_id': result[2],
-            'cust_msg_id': result[3],
-            'user_id': result[4],
-            'username': result[5],
-            'customer_anchor_msg_id': result[6],
-            'status': result[7],
-            'closed_at': result[8]
-        }
-    return None
-
-
-def get_ticket_by_id(ticket_id: int) -> Optional[dict]:
-    """Get ticket info by ticket_id (for /t command)"""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT staff_msg_id, ticket_id, cust_group_id, cust_msg_id, user_id, username, 
-               customer_anchor_msg_id, status, closed_at
-        FROM tickets 
-        WHERE ticket_id = ?
-    ''', (ticket_id,))
-    result = cursor.fetchone()
-    conn.close()
-    
-    if result:
-        return {
-            'staff_msg_id': result[0],
-            'ticket_id': result[1],
-            'cust_group_id': result[2],
-            'cust_msg_id': result[3],
-            'user_id': result[4],
-            'username': result[5],
-            'customer_anchor_msg_id': result[6],
-            'status': result[7],
-            'closed_at': result[8]
-        }
-    return None
+class UpdateScheduler:
+    """
+    Outer update middleware: parallel across chats, ordered within one
 
+    Updates are processed concurrently (polling and webhook both run each
+    update as a task) up to max_concurrent at a time. Updates sharing an
+    ordering key - the same customer chat, or staff replies to the same
+    message - run one at a time in arrival order. The key lock is taken
+    before a concurrency slot, so a busy chat never holds slots idle.
+    Staff group updates draw from their own pool of max_concurrent slots:
+    customer handlers hold a slot while their wrapper waits behind the
+    staff group's send rate limit, and a burst of new tickets must not
+    keep staff replies from running.
+    Updates are tracked from arrival, so drain() at shutdown also covers
+    the ones still waiting for their turn.
+    """
 
-def update_customer_anchor(staff_msg_id: int, customer_anchor_msg_id: int):
-    """Update customer group anchor message ID (called after staff reply)"""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
-        UPDATE tickets 
-        SET customer_anchor_msg_id = ?
-        WHERE staff_msg_id = ?
-    ''', (customer_anchor_msg_id, staff_msg_id))
-    conn.commit()
-    conn.close()
+    def __init__(self, max_concurrent: int):
+        self.max_concurrent = max_concurrent
+        self.keys = KeyedLock()
+        self.active = 0
+        self.last_update_id: Optional[int] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._staff_slots: Optional[asyncio.Semaphore] = None
+        self._running = {}      # task -> update_id, from arrival until the handler returns
 
+    @staticmethod
+    def ordering_key(update: types.Update):
+        """Key of the conversation an update belongs to (None = no ordering needed)"""
+        message = update.message or update.edited_message
+        if message is None:
+            return None
+        if message.chat.id == STAFF_GROUP_ID:
+            if message.reply_to_message:
+                return ('staff', message.reply_to_message.message_id)
+            return None
+        return ('chat', message.chat.id)
 
-def close_ticket_by_staff_msg_id(staff_msg_id: int) -> bool:
-    """Close ticket (by staff group wrapper message ID)"""
-    try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        closed_at = int(time.time() * 1000)
-        cursor.execute('''
-            UPDATE tickets 
-            SET status = 'closed', closed_at = ?
-            WHERE staff_msg_id = ?
-        ''', (closed_at, staff_msg_id))
-        conn.commit()
-        conn.close()
-        return True
-    except Exception as e:
-        logger.error(f"Failed to close ticket: {e}")
-        return False
+    async def __call__(self, handler, event: types.Update, data: dict):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_concurrent)
+            self._staff_slots = asyncio.Semaphore(self.max_concurrent)
+        message = event.message or event.edited_message
+        slots = self._staff_slots if message and message.chat.id == STAFF_GROUP_ID else self._slots
+        task = asyncio.current_task()
+        self._running[task] = event.update_id
+        self.last_update_id = max(self.last_update_id or 0, event.update_id)
+        key = self.ordering_key(event)
+        try:
+            async with self.keys.hold(key) if key is not None else contextlib.nullcontext():
+                async with slots:
+                    self.active += 1
+                    try:
+                        return await handler(event, data)
+                    finally:
+                        self.active -= 1
+        finally:
+            self._running.pop(task, None)
 
+    async def drain(self, timeout: float) -> list:
+        """Wait up to timeout for the updates being handled, cancel the rest; returns their update IDs"""
+        if not self._running:
+            return []
+        logger.info("Waiting for %s in-flight updates", len(self._running))
+        _, pending = await asyncio.wait(set(self._running), timeout=timeout)
+        unfinished = sorted(self._running[task] for task in pending if task in self._running)
+        if pending:
+            logger.warning("Cancelling %s updates still running after %.0fs", len(pending), timeout)
+            for task in pending:
+                task.cancel()
+            await asyncio.wait(pending)
+        return unfinished
 
-def reopen_ticket_by_staff_msg_id(staff_msg_id: int) -> bool:
-    """Reopen ticket (by staff group wrapper message ID)"""
+
+async def log_context_middleware(handler, event: types.Update, data: dict):
+    """Outer update middleware: tag the log records of an update with its update/chat/user IDs"""
+    fields = {'update_id': event.update_id}
+    message = event.message or event.edited_message
+    if message:
+        fields['chat_id'] = message.chat.id
+        if message.from_user:
+            fields['user_id'] = message.from_user.id
+    token = log_context.set(fields)
     try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        cursor.execute('''
-            UPDATE tickets 
-            SET status = 'open', closed_at = NULL
-            WHERE staff_msg_id = ?
-        ''', (staff_msg_id,))
-        conn.commit()
-        conn.close()
+        logger.debug("Handling update %s (%s)", event.update_id, event.event_type)
+        return await handler(event, data)
+    finally:
+        log_context.reset(token)
+
+
+update_scheduler = UpdateScheduler(MAX_CONCURRENT_UPDATES)
+dp.update.outer_middleware(log_context_middleware)
+dp.update.outer_middleware(update_scheduler)
+metrics.gauge('bot_updates_in_progress', 'Updates being handled', lambda: update_scheduler.active)
+
+# Serializes state changes of one ticket across chats (customer continuation vs staff /close)
+ticket_locks = KeyedLock()
+
+
+# ======================== Abuse Throttling ========================
+
+class SlidingWindow:
+    """Event times per key, allowing at most limit events in any window seconds (limit 0 = unlimited)"""
+
+    def __init__(self, limit: int, window: float):
+        self.limit = limit
+        self.window = window
+        self._events = {}   # key -> deque of monotonic times, oldest first
+        self._swept = time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self._events)
+
+    def retry_after(self, key, now: float) -> float:
+        """Seconds until key may have another event (0 = now)"""
+        events = self._events.get(key)
+        if not self.limit or not events:
+            return 0.0
+        while events and events[0] <= now - self.window:
+            events.popleft()
+        if len(events) < self.limit:
+            return 0.0
+        return events[0] + self.window - now
+
+    def add(self, key, now: float):
+        """Record an event for key"""
+        if not self.limit:
+            return
+        events = self._events.get(key)
+        if events is None:
+            events = self._events[key] = collections.deque()
+        events.append(now)
+        if now - self._swept > self.window:
+            self._sweep(now)
+
+    def _sweep(self, now: float):
+        """Forget keys without events in the window (many users sending once would grow the dict)"""
+        cutoff = now - self.window
+        self._events = {key: events for key, events in self._events.items() if events[-1] > cutoff}
+        self._swept = now
+
+
+class TicketThrottle:
+    """
+    Abuse limits for new tickets and /t messages
+    Sliding windows per user (within a group) and per group, so one noisy
+    user or group cannot use up the outbound send budget of all the others.
+    With merging on, each user's latest ticket is remembered, so rapid
+    follow-up mentions continue it instead of opening new tickets.
+    """
+
+    def __init__(self, user_limit: int, group_limit: int, window: float, merge_seconds: float):
+        self.users = SlidingWindow(user_limit, window)
+        self.groups = SlidingWindow(group_limit, window)
+        # One "slow down" notice per user (or group, at the group limit) and window:
+        # a notice per dropped message would cost a send each
+        self.notices = SlidingWindow(1, window)
+        self.merge_seconds = merge_seconds
+        self._recent = {}   # (chat_id, user_id) -> (ticket_id, monotonic time of its last message)
+        self._swept = time.monotonic()
+
+    def admit(self, chat_id: int, user_id: int) -> Optional[tuple]:
+        """Count a forwarded message; returns (blocking scope 'user' / 'group', seconds to wait) if it is over a limit"""
+        now = time.monotonic()
+        user_key = (chat_id, user_id)
+        wait = self.users.retry_after(user_key, now)
+        if wait:
+            return 'user', wait
+        wait = self.groups.retry_after(chat_id, now)
+        if wait:
+            return 'group', wait
+        self.users.add(user_key, now)
+        self.groups.add(chat_id, now)
+        return None
+
+    def should_notify(self, chat_id: int, user_id: int, scope: str) -> bool:
+        """True for the first message in a window dropped for this user (user limit) or group (group limit)"""
+        now = time.monotonic()
+        key = (chat_id, user_id if scope == 'user' else None)
+        if self.notices.retry_after(key, now):
+            return False
+        self.notices.add(key, now)
         return True
-    except Exception as e:
-        logger.error(f"Failed to reopen ticket: {e}")
-        return False
 
+    def remember(self, chat_id: int, user_id: int, ticket_id: int):
+        """Note a message of the user's ticket (the merge window starts again)"""
+        if not self.merge_seconds:
+            return
+        now = time.monotonic()
+        self._recent[(chat_id, user_id)] = (ticket_id, now)
+        if now - self._swept > self.merge_seconds:
+            cutoff = now - self.merge_seconds
+            self._recent = {key: entry for key, entry in self._recent.items() if entry[1] > cutoff}
+            self._swept = now
 
-# ======================== Bot Initialization ========================
+    def recent_ticket(self, chat_id: int, user_id: int) -> Optional[int]:
+        """Ticket a new mention of the user should continue, if within the merge window"""
+        entry = self._recent.get((chat_id, user_id))
+        if entry and time.monotonic() - entry[1] < self.merge_seconds:
+            return entry[0]
+        return None
 
-bot = Bot(token=API_TOKEN)
-dp = Dispatcher()
+
+def throttled(message: Message) -> bool:
+    """Count a customer message against the limits; True (sender told once per window) if it is dropped"""
+    blocked = ticket_throttle.admit(message.chat.id, message.from_user.id)
+    if not blocked:
+        return False
+    scope, wait = blocked
+    THROTTLED.inc(scope)
+    logger.info("Throttled message %s from user %s (%s limit)", message.message_id, message.from_user.id, scope)
+    if ticket_throttle.should_notify(message.chat.id, message.from_user.id, scope):
+        queue_reply(message, f"⏳ Too many requests, please wait {math.ceil(wait)}s and try again")
+    return True
+
+
+ticket_throttle = TicketThrottle(
+    THROTTLE_USER_LIMIT,
+    THROTTLE_GROUP_LIMIT,
+    THROTTLE_WINDOW_SECONDS,
+    TICKET_MERGE_SECONDS,
+)
 
 
 # ======================== General Command Handlers ========================
@@ -349,27 +3534,32 @@ async def cmd_start(message: Message):
     """Handle /start command, show usage instructions"""
     help_text = (
         "👋 Welcome to the Ticket Relay Bot!\n\n"
-        "📌 **Customer Usage** (in configured customer groups):\n"
+        "📌 <b>Customer Usage</b> (in configured customer groups):\n"
         "• Method 1: @bot_username + your question\n"
         "• Method 2: /ask + your question\n"
         "• Supports text, images, videos, files, voice, etc.\n\n"
-        "💬 **Continue Conversation**:\n"
-        "• Reply to bot's staff reply message\n"
-        "• Or use command: /t <ticket_id> <content>\n\n"
-        "📌 **Admin Commands** (admin only):\n"
+        "💬 <b>Continue Conversation</b>:\n"
+        "• Reply to any of the bot's staff reply messages\n"
+        "• Or use command: /t &lt;ticket_id&gt; &lt;content&gt;\n\n"
+        "📌 <b>Admin Commands</b> (admin only):\n"
         "• /addgroup - Add current group as customer group\n"
         "• /removegroup - Remove current group\n"
         "• /listgroups - List all customer groups\n\n"
-        "📌 **Staff Reply Method** (in staff group):\n"
-        "• Use Reply function on the wrapper ticket message\n"
+        "📌 <b>Staff Reply Method</b> (in staff group):\n"
+        "• Use Reply function on the wrapper or any message of the ticket thread\n"
         "• Support replying with any content type\n"
         "• System will auto-forward to customer and mention original user\n\n"
-        "🔒 **Close Ticket** (staff group):\n"
+        "🔒 <b>Close Ticket</b> (staff group):\n"
         "• Reply to wrapper and send /close or /done to close ticket\n"
         "• Reply to wrapper and send /reopen to reopen ticket\n\n"
+        "📊 <b>Dashboard</b> (staff group):\n"
+        "• /open - Open tickets per group\n"
+        "• /stats - Ticket totals and busiest groups\n"
+        "• /oldest - Longest-waiting open tickets\n"
+        "• /search &lt;terms&gt; - Find tickets by message text\n\n"
         "💡 Need help? Contact administrator"
     )
-    await message.reply(help_text, parse_mode=ParseMode.MARKDOWN)
+    queue_reply(message, help_text, parse_mode=ParseMode.HTML)
 
 
 # ======================== Admin Command Handlers ========================
@@ -383,19 +3573,19 @@ async def cmd_addgroup(message: Message):
     
     # Must be executed in group
     if message.chat.type not in ['group', 'supergroup']:
-        await message.reply("❌ This command can only be used in groups")
+        queue_reply(message, "❌ This command can only be used in groups")
         return
     
     group_id = message.chat.id
     group_name = message.chat.title or "Unknown"
     
-    if add_customer_group(group_id):
+    if await store.add_customer_group(group_id):
         # Silent mode: log only, no message to group to avoid spam
-        logger.info(f"Customer group added: ID={group_id}, Name={group_name}")
+        logger.info("Customer group added: ID=%s, Name=%s", group_id, group_name)
         # No reply to avoid group spam
     else:
         # Only reply on error
-        await message.reply("❌ Failed to add group, please check logs")
+        queue_reply(message, "❌ Failed to add group, please check logs")
 
 
 @dp.message(Command("removegroup"))
@@ -405,16 +3595,16 @@ async def cmd_removegroup(message: Message):
         return
     
     if message.chat.type not in ['group', 'supergroup']:
-        await message.reply("❌ This command can only be used in groups")
+        queue_reply(message, "❌ This command can only be used in groups")
         return
     
     group_id = message.chat.id
     
-    if remove_customer_group(group_id):
-        await message.reply(f"✅ Successfully removed customer group\nGroup ID: {group_id}")
-        logger.info(f"Removed customer group: {group_id}")
+    if await store.remove_customer_group(group_id):
+        queue_reply(message, f"✅ Successfully removed customer group\nGroup ID: {group_id}")
+        logger.info("Removed customer group: %s", group_id)
     else:
-        await message.reply("❌ Failed to remove group, please check logs")
+        queue_reply(message, "❌ Failed to remove group, please check logs")
 
 
 @dp.message(Command("listgroups"))
@@ -423,14 +3613,15 @@ async def cmd_listgroups(message: Message):
     if message.from_user.id != ADMIN_USER_ID:
         return
     
-    groups = get_all_customer_groups()
+    groups = store.get_all_customer_groups()
     
     if not groups:
-        await message.reply("📋 No customer groups")
+        queue_reply(message, "📋 No customer groups")
         return
     
     group_list = "\n".join([f"• {group_id}" for group_id in groups])
-    await message.reply(
+    queue_reply(
+        message,
         f"📋 Customer Groups ({len(groups)} total):\n\n{group_list}"
     )
 
@@ -444,7 +3635,7 @@ async def cmd_ticket_continue(message: Message):
     if message.chat.type not in ['group', 'supergroup']:
         return
     
-    if not is_customer_group(message.chat.id):
+    if not store.is_customer_group(message.chat.id):
         return
     
     # Parse command: /t <ticket_id> <content>
@@ -452,196 +3643,211 @@ async def cmd_ticket_continue(message: Message):
     parts = text.split(maxsplit=2)
     
     if len(parts) < 3:
-        await message.reply("❌ Invalid format\nCorrect format: /t <ticket_id> <content>")
+        queue_reply(message, "❌ Invalid format\nCorrect format: /t <ticket_id> <content>")
         return
     
     try:
         ticket_id = int(parts[1])
     except ValueError:
-        await message.reply("❌ Ticket ID must be a number")
+        queue_reply(message, "❌ Ticket ID must be a number")
         return
     
     content = parts[2]
+    bind_log_context(ticket_id=ticket_id)
     
-    # Find ticket
-    ticket = get_ticket_by_id(ticket_id)
-    
-    if not ticket:
-        await message.reply("❌ Ticket does not exist")
-        return
-    
-    # Check if same customer group
-    if ticket['cust_group_id'] != message.chat.id:
-        await message.reply("❌ This ticket does not belong to current group")
-        return
-    
-    # Check if ticket is closed
-    if ticket['status'] == 'closed':
-        await message.reply(
-            "⚠️ This ticket is closed. Please @bot or /ask to create a new ticket."
-        )
+    # Throttled before the lookup: a /t loop costs no database reads either
+    if throttled(message):
         return
     
-    # Forward continued message to staff group
-    await forward_continue_message_to_staff(message, ticket, content, is_text_only=True)
+    # Lookup, status check and forward under the ticket lock (ordered against staff /close)
+    async with ticket_locks.hold(ticket_id):
+        # Find ticket
+        ticket = await store.get_ticket_by_id(ticket_id)
+        
+        if not ticket:
+            queue_reply(message, "❌ Ticket does not exist")
+            return
+        
+        # Check if same customer group
+        if ticket['cust_group_id'] != message.chat.id:
+            queue_reply(message, "❌ This ticket does not belong to current group")
+            return
+        
+        # Check if ticket is closed
+        if ticket['status'] == 'closed':
+            queue_reply(
+                message,
+                "⚠️ This ticket is closed. Please @bot or /ask to create a new ticket."
+            )
+            return
+        
+        # Forward continued message to staff group
+        await forward_continue_message_to_staff(message, ticket, content, is_text_only=True)
 
 
 # ======================== Customer Question Handlers ========================
 
-async def check_bot_mentioned(message: Message, bot_username: str) -> bool:
+def check_bot_mentioned(message: Message) -> bool:
     """Check if message mentions the bot"""
     # Check /ask command
     if message.text and message.text.startswith('/ask'):
         return True
-    
-    # Check message entities for bot mention
-    if message.entities:
-        for entity in message.entities:
-            if entity.type == "mention":
-                # Extract mentioned username
-                if message.text:
-                    mention_text = message.text[entity.offset:entity.offset + entity.length]
-                    if f"@{bot_username}" == mention_text:
-                        return True
-    
-    # Check if text contains @bot_username (compatibility)
-    if message.text and f"@{bot_username}" in message.text:
+
+    # Check text and caption for @bot_username (covers mention entities as well)
+    pattern = bot_identity.mention_pattern
+    if message.text and pattern.search(message.text):
         return True
-    
-    # Check caption for bot mention
-    if message.caption:
-        if f"@{bot_username}" in message.caption:
-            return True
-        # Check caption_entities
-        if message.caption_entities:
-            for entity in message.caption_entities:
-                if entity.type == "mention":
-                    mention_text = message.caption[entity.offset:entity.offset + entity.length]
-                    if f"@{bot_username}" == mention_text:
-                        return True
-    
+    if message.caption and pattern.search(message.caption):
+        return True
+
     return False
 
 
-async def forward_to_staff(message: Message):
+async def forward_to_staff(message: Message, album: Optional[list] = None):
     """
     Forward customer message to staff group (Wrapper mechanism)
     First send wrapper ticket message, then copy original message as reply based on content type
+    
+    Args:
+        message: Customer message that opened the ticket
+        album: All messages of the album the message belongs to (one ticket per album)
     """
     try:
-        # Generate ticket ID (using timestamp)
-        ticket_id = int(time.time() * 1000)
+        # Allocate ticket ID (unique, increasing)
+        ticket_id = await store.next_ticket_id()
+        bind_log_context(ticket_id=ticket_id)
         
         # Get user info
         user = message.from_user
         username = user.username or user.full_name
-        user_mention = f"@{user.username}" if user.username else user.full_name
-        
-        # Get message content type
         content_type = message.content_type
         
-        # Build wrapper text
-        wrapper_text = (
-            f"🎫 Ticket #{ticket_id}\n"
-            f"📍 From group: {message.chat.title}\n"
-            f"👤 User: {user_mention}\n"
-            f"{'─' * 30}\n"
+        # Wrapper: header plus full text (plain text) or a content summary (media, albums);
+        # a long text continues in parts (or a document) under the wrapper
+        wrapper_parts, wrapper_document = render_wrapper(ticket_id, message, album)
+        
+        # The rest of a long text and the attachment go under the wrapper. A deferred
+        # wrapper keeps them as follow-ups, posted after it by the outbox worker (the
+        # .txt document is an upload and cannot be stored, a note stands in for it)
+        wrapper_key = f"wrapper:{message.chat.id}:{message.message_id}"
+        copy_action = {'kind': 'map', 'ticket_id': ticket_id, 'chat_id': STAFF_GROUP_ID, 'as': 'copy'}
+        follow_ups = text_part_follow_ups(
+            STAFF_GROUP_ID, wrapper_parts[1:], wrapper_document, None, PRIORITY_WRAPPER, ticket_id,
+            wrapper_key, copy_action
         )
+        copy_method = None
+        if album:
+            media = build_album_media(album)
+            copy_method = SendMediaGroup(chat_id=STAFF_GROUP_ID, media=media) if media else CopyMessages(
+                chat_id=STAFF_GROUP_ID, from_chat_id=message.chat.id, message_ids=[m.message_id for m in album]
+            )
+        elif content_type != 'text':
+            copy_method = CopyMessage(chat_id=STAFF_GROUP_ID, from_chat_id=message.chat.id, message_id=message.message_id)
+        if copy_method is not None:
+            follow_ups.append(Outbox.follow_up(copy_method, PRIORITY_WRAPPER, f"{wrapper_key}:copy", copy_action))
         
-        # Add content summary or full text based on content type
-        if content_type == 'text':
-            # Plain text message: include full content in wrapper
-            wrapper_text += message.text
-            
-        elif content_type == 'photo':
-            # Photo message
-            if message.caption:
-                wrapper_text += f"📷 Photo attachment\nCaption: {message.caption}"
-            else:
-                wrapper_text += "📷 Photo attachment"
-                
-        elif content_type == 'video':
-            # Video message
-            if message.caption:
-                wrapper_text += f"🎬 Video attachment\nCaption: {message.caption}"
-            else:
-                wrapper_text += "🎬 Video attachment"
-                
-        elif content_type == 'document':
-            # Document message
-            file_name = message.document.file_name if message.document.file_name else "Unnamed file"
-            if message.caption:
-                wrapper_text += f"📎 File attachment: {file_name}\nCaption: {message.caption}"
-            else:
-                wrapper_text += f"📎 File attachment: {file_name}"
-                
-        elif content_type == 'voice':
-            # Voice message
-            duration = message.voice.duration if message.voice.duration else 0
-            wrapper_text += f"🎤 Voice message ({duration}s)"
-            
-        elif content_type == 'audio':
-            # Audio message
-            if message.audio.title:
-                wrapper_text += f"🎵 Audio: {message.audio.title}"
-            else:
-                wrapper_text += "🎵 Audio attachment"
-                
-        elif content_type == 'video_note':
-            # Video note (circular)
-            wrapper_text += "🎥 Video message"
-            
-        elif content_type == 'sticker':
-            # Sticker
-            wrapper_text += f"🎭 Sticker: {message.sticker.emoji if message.sticker.emoji else ''}"
-            
-        elif content_type == 'animation':
-            # GIF animation
-            wrapper_text += "🎞️ GIF animation"
-            
-        else:
-            # Other types
-            wrapper_text += f"📦 {content_type} type message"
+        async def copy_attachment(wrapper_msg_id: int):
+            if album:
+                # Whole album as one media group under the wrapper
+                return await send_album_copy(album, wrapper_msg_id, PRIORITY_WRAPPER)
+            return await send_queue.submit(
+                copy_method.model_copy(update={'reply_to_message_id': wrapper_msg_id}), PRIORITY_WRAPPER
+            )
         
-        # 1. First send wrapper message to staff group
-        wrapper_msg = await bot.send_message(STAFF_GROUP_ID, wrapper_text)
+        tail = copy = None
         
-        # 2. If not plain text, copy original message as reply under wrapper
-        if content_type != 'text':
-            try:
-                await bot.copy_message(
-                    chat_id=STAFF_GROUP_ID,
-                    from_chat_id=message.chat.id,
-                    message_id=message.message_id,
-                    reply_to_message_id=wrapper_msg.message_id
+        def post_under_wrapper(wrapper: Message):
+            # Queued as soon as the wrapper is sent, while its ticket is being saved
+            nonlocal tail, copy
+            if len(wrapper_parts) > 1 or wrapper_document:
+                tail = asyncio.ensure_future(send_text_parts(
+                    STAFF_GROUP_ID, wrapper_parts[1:], wrapper_document, wrapper.message_id, PRIORITY_WRAPPER,
+                    ticket_id
+                ))
+            if copy_method is not None:
+                copy = asyncio.ensure_future(copy_attachment(wrapper.message_id))
+        
+        # 1. First send wrapper message to staff group, through the outbox: the ticket
+        # mapping is saved in the transaction that marks the wrapper sent, and the
+        # key (customer message) keeps a redelivered update from opening a second ticket
+        action = {
+            'kind': 'ticket',
+            'ticket_id': ticket_id,
+            'cust_group_id': message.chat.id,
+            'cust_msg_id': message.message_id,
+            'user_id': user.id,
+            'username': username,
+        }
+        if follow_ups:
+            action['follow_ups'] = follow_ups
+        wrapper_msg = await outbox.send(
+            SendMessage(chat_id=STAFF_GROUP_ID, text=wrapper_parts[0]),
+            PRIORITY_WRAPPER,
+            key=wrapper_key, action=action, on_sent=post_under_wrapper
+        )
+
+        # 2. Rest of a long text under the wrapper
+        if tail is not None:
+            parts, part_error = await tail
+            if part_error:
+                logger.warning("Failed to post part of ticket #%s: %s", ticket_id, part_error)
+                send_queue.post(
+                    SendMessage(
+                        chat_id=STAFF_GROUP_ID,
+                        text=f"⚠️ Part of the text of ticket #{ticket_id} could not be posted",
+                        reply_to_message_id=wrapper_msg.message_id
+                    ),
+                    PRIORITY_NOTICE
                 )
+            if parts:
+                await store.add_ticket_messages(ticket_id, STAFF_GROUP_ID, sent_message_ids(parts), 'copy')
+        
+        # 3. Copy media under wrapper (if not plain text)
+        if copy is not None:
+            try:
+                copied = await copy
             except Exception as e:
-                logger.warning(f"Failed to copy media message: {e}")
                 # Even if copy fails, wrapper contains basic info
-        
-        # 3. Save ticket mapping (using wrapper message_id)
-        save_ticket(
-            staff_msg_id=wrapper_msg.message_id,
-            ticket_id=ticket_id,
-            cust_group_id=message.chat.id,
-            cust_msg_id=message.message_id,
-            user_id=user.id,
-            username=username
-        )
+                logger.warning("Failed to copy media message: %s", e)
+                COPY_FALLBACKS.inc('wrapper_copy_failed')
+                send_queue.post(
+                    SendMessage(
+                        chat_id=STAFF_GROUP_ID,
+                        text=f"⚠️ Could not copy the attachment of ticket #{ticket_id}",
+                        reply_to_message_id=wrapper_msg.message_id
+                    ),
+                    PRIORITY_NOTICE
+                )
+            else:
+                # Replies to the media copy reach the ticket as well
+                await store.add_ticket_messages(ticket_id, STAFF_GROUP_ID, sent_message_ids(copied), 'copy')
         
         # 4. No success confirmation to customer group (stay silent)
         # Removed customer reply to avoid spam
         
-        logger.info(f"Created ticket #{ticket_id}: user {username} (group {message.chat.id}), type {content_type}")
+        search_index.add(ticket_id, 'customer', username, searchable_text(message, album))
         
+        if album:
+            content_type = f"album of {len(album)}"
+        TICKET_EVENTS.inc('opened')
+        ticket_throttle.remember(message.chat.id, user.id, ticket_id)
+        logger.info("Created ticket #%s: user %s (group %s), type %s", ticket_id, username, message.chat.id, content_type)
+
+    except DuplicateSend:
+        logger.info("Message %s already opened a ticket, skipping", message.message_id)
+    except SendDeferred:
+        # The ticket is saved when the outbox delivers the wrapper, the attachment and parts follow it
+        search_index.add(ticket_id, 'customer', username, searchable_text(message, album))
+        logger.warning("Ticket #%s wrapper deferred, the outbox retries it", ticket_id)
     except Exception as e:
-        logger.error(f"Failed to forward message to staff group: {e}", exc_info=True)
+        logger.error("Failed to forward message to staff group: %s", e, exc_info=True)
         # Only send error message to customer on exception
-        await message.reply("❌ System error, please try again later")
+        queue_reply(message, "❌ System error, please try again later")
 
 
 async def forward_continue_message_to_staff(message: Message, ticket: dict, 
-                                            text_content: str = None, is_text_only: bool = False):
+                                            text_content: str = None, is_text_only: bool = False,
+                                            album: Optional[list] = None):
     """
     Forward customer continued message to staff group (as reply under corresponding wrapper)
     
@@ -650,65 +3856,139 @@ async def forward_continue_message_to_staff(message: Message, ticket: dict,
         ticket: Ticket info dictionary
         text_content: Plain text content (for /t command)
         is_text_only: Whether text only (for /t command)
+        album: All messages of the album being continued (sent as one media group)
     """
+    # Text replies still held for coalescing go first, keeping the customer's order
+    pending = continuation_buffer.take((message.chat.id, message.from_user.id, ticket['ticket_id']))
+    if pending:
+        await forward_coalesced_continuations(pending, ticket)
+    
     try:
         # Get user info
         user = message.from_user
         username = user.username or user.full_name
-        user_mention = f"@{user.username}" if user.username else user.full_name
         
         # Build continued message header (short version)
-        continue_header = (
-            f"💬 Continued message (Ticket #{ticket['ticket_id']})\n"
-            f"👤 {user_mention}\n"
-            f"{'─' * 20}\n"
-        )
+        continue_header = render_continuation_header(ticket['ticket_id'], user)
         
-        if is_text_only:
-            # /t command: plain text continuation
-            full_text = continue_header + text_content
-            await bot.send_message(
-                STAFF_GROUP_ID,
-                full_text,
-                reply_to_message_id=ticket['staff_msg_id']
+        # Messages posted to the staff group (recorded so staff can reply to them)
+        sent = []
+        # Single-message continuations go through the outbox, which maps them to the ticket
+        key = f"continuation:{message.chat.id}:{message.message_id}"
+        action = {'kind': 'continuation', 'ticket_id': ticket['ticket_id']}
+        
+        if is_text_only or (not album and message.content_type == 'text'):
+            # Plain text continuation (reply, or /t command); a long text continues in parts
+            parts, document = layout_text(
+                continue_header, text_content if is_text_only else message.text, ticket['ticket_id']
+            )
+            follow_ups = text_part_follow_ups(
+                STAFF_GROUP_ID, parts[1:], document, ticket['staff_msg_id'], PRIORITY_CONTINUATION,
+                ticket['ticket_id'], key, action
+            )
+            await outbox.send(
+                SendMessage(
+                    chat_id=STAFF_GROUP_ID,
+                    text=parts[0],
+                    reply_to_message_id=ticket['staff_msg_id']
+                ),
+                PRIORITY_CONTINUATION,
+                key=key, action={**action, 'follow_ups': follow_ups} if follow_ups else action
             )
+            if len(parts) > 1 or document:
+                sent, part_error = await send_text_parts(
+                    STAFF_GROUP_ID, parts[1:], document, ticket['staff_msg_id'], PRIORITY_CONTINUATION,
+                    ticket['ticket_id']
+                )
+                if part_error:
+                    logger.warning("Failed to post part of continued message: %s", part_error)
+        elif album:
+            # Album continuation: one media group, header in the first caption
+            sent = await send_album_copy(album, ticket['staff_msg_id'], PRIORITY_CONTINUATION, header=continue_header)
         else:
-            # Reply continuation: support text and media
+            # Media continuation: one copy with the header as caption when possible
             content_type = message.content_type
+            copy_method = CopyMessage(
+                chat_id=STAFF_GROUP_ID,
+                from_chat_id=message.chat.id,
+                message_id=message.message_id,
+                reply_to_message_id=ticket['staff_msg_id']
+            )
+            caption = continue_header + (message.caption or '')
+            copied = False
+            if content_type not in CAPTIONLESS_CONTENT_TYPES and text_length(caption) <= CAPTION_LIMIT:
+                try:
+                    await outbox.send(
+                        copy_method.model_copy(update={'caption': caption}),
+                        PRIORITY_CONTINUATION,
+                        key=key, action=action
+                    )
+                    copied = True
+                except (SendDeferred, DuplicateSend):
+                    raise
+                except Exception as e:
+                    logger.warning("copy_message with caption failed, using fallback: %s", e)
+                    COPY_FALLBACKS.inc('continuation')
             
-            if content_type == 'text':
-                # Plain text continuation
-                full_text = continue_header + message.text
-                await bot.send_message(
-                    STAFF_GROUP_ID,
-                    full_text,
-                    reply_to_message_id=ticket['staff_msg_id']
-                )
-            else:
-                # Media continuation: send header first, then copy media
-                await bot.send_message(
-                    STAFF_GROUP_ID,
-                    continue_header,
-                    reply_to_message_id=ticket['staff_msg_id']
-                )
-                await bot.copy_message(
-                    chat_id=STAFF_GROUP_ID,
-                    from_chat_id=message.chat.id,
-                    message_id=message.message_id,
-                    reply_to_message_id=ticket['staff_msg_id']
+            if not copied:
+                # Header, then the media copy (the header maps both)
+                header_msg, copied_msg, copy_error = await send_header_and_copy(
+                    SendMessage(
+                        chat_id=STAFF_GROUP_ID,
+                        text=continue_header,
+                        reply_to_message_id=ticket['staff_msg_id']
+                    ),
+                    copy_method,
+                    PRIORITY_CONTINUATION,
+                    key=key + ':header', action=action, copy_action=action
                 )
+                if copy_error:
+                    raise copy_error
+                sent = [copied_msg]
+        
+        if sent:
+            await store.add_ticket_messages(
+                ticket['ticket_id'], STAFF_GROUP_ID, sent_message_ids(sent), 'continuation'
+            )
+        search_index.add(
+            ticket['ticket_id'], 'customer', username,
+            text_content if is_text_only else searchable_text(message, album)
+        )
         
-        logger.info(f"Forwarded continued message: Ticket #{ticket['ticket_id']}, user {username}")
+        logger.info("Forwarded continued message: Ticket #%s, user %s", ticket['ticket_id'], username)
         
+    except DuplicateSend:
+        logger.info("Continued message %s was already forwarded, skipping", message.message_id)
+    except SendDeferred:
+        # Staff get it (and it is mapped) once the outbox delivers it
+        logger.warning("Continued message for ticket #%s deferred, the outbox retries it", ticket['ticket_id'])
     except Exception as e:
-        logger.error(f"Failed to forward continued message: {e}", exc_info=True)
-        await message.reply("❌ Failed to forward continued message")
+        logger.error("Failed to forward continued message: %s", e, exc_info=True)
+        queue_reply(message, "❌ Failed to forward continued message")
+
+
+async def forward_coalesced_continuations(messages: list, ticket: dict):
+    """Forward text replies buffered by continuation_buffer as one staff message (keyed on the first one)"""
+    # Replies buffered after this batch was flushed join it, in the customer's order
+    # (forward_continue_message_to_staff would otherwise send them ahead of it)
+    messages = messages + continuation_buffer.take(
+        (messages[0].chat.id, messages[0].from_user.id, ticket['ticket_id'])
+    )
+    messages.sort(key=lambda m: m.message_id)
+    if len(messages) > 1:
+        COALESCED.inc(amount=len(messages) - 1)
+    text = "\n".join(m.text for m in messages)
+    await forward_continue_message_to_staff(messages[0], ticket, text, is_text_only=True)
 
 
-async def check_and_handle_continue_message(message: Message) -> bool:
+async def check_and_handle_continue_message(message: Message, album: Optional[list] = None) -> bool:
     """
     Check and handle continued message
     
+    Args:
+        message: Customer message (for albums, the item carrying the reply)
+        album: All messages of the album, forwarded together
+    
     Returns:
         bool: True if continued message, False otherwise
     """
@@ -724,53 +4004,272 @@ async def check_and_handle_continue_message(message: Message) -> bool:
     if not message.reply_to_message.from_user.is_bot:
         return False
     
-    # Try to extract ticket_id from replied message
-    reply_text = message.reply_to_message.text or message.reply_to_message.caption or ""
-    
-    # Match "Ticket #<number>"
-    match = re.search(r'Ticket #(\d+)', reply_text)
-    
-    if not match:
-        return False
-    
-    # Find ticket by anchor message ID
-    anchor_msg_id = message.reply_to_message.message_id
-    ticket = get_ticket_by_customer_anchor(message.chat.id, anchor_msg_id)
+    # Find ticket by the replied message (any bot message of the ticket thread)
+    ticket = await store.get_ticket_by_message(message.chat.id, message.reply_to_message.message_id)
     
     if not ticket:
-        # Cannot find corresponding ticket
-        bot_info = await bot.get_me()
-        await message.reply(
+        # Not part of a known thread; a ticket message we lost track of still names its ticket
+        reply_text = message.reply_to_message.text or message.reply_to_message.caption or ""
+        if not re.search(r'Ticket #\d+', reply_text):
+            return False
+        queue_reply(
+            message,
             "❌ Ticket not found\n"
-            f"Please use /t <ticket_id> <content> or @{bot_info.username} to ask again"
+            f"Please use /t <ticket_id> <content> or {bot_identity.mention} to ask again"
         )
         return True  # Intent to continue conversation, even if not found
     
-    # Check if ticket is closed
-    if ticket['status'] == 'closed':
-        bot_info = await bot.get_me()
-        await message.reply(
-            "⚠️ This ticket is closed. Please @bot or /ask to create a new ticket."
+    bind_log_context(ticket_id=ticket['ticket_id'])
+    async with ticket_locks.hold(ticket['ticket_id']):
+        # Re-read under the lock: a staff /close may have landed since the lookup
+        ticket = await store.get_ticket_by_id(ticket['ticket_id']) or ticket
+        
+        # Check if ticket is closed
+        if ticket['status'] == 'closed':
+            queue_reply(
+                message,
+                "⚠️ This ticket is closed. Please @bot or /ask to create a new ticket."
+            )
+            return True
+        
+        # Text replies are held briefly: a question sent as several quick messages becomes one staff post
+        if CONTINUATION_COALESCE_MS and not album and message.content_type == 'text':
+            continuation_buffer.add((message.chat.id, message.from_user.id, ticket['ticket_id']), message)
+            return True
+        
+        # Found ticket and not closed, forward continued message
+        await forward_continue_message_to_staff(message, ticket, album=album)
+    
+    return True
+
+
+async def open_ticket(message: Message, album: Optional[list] = None):
+    """
+    Open a ticket for a mention, or continue the user's ticket instead
+    With TICKET_MERGE_SECONDS set, a mention that follows the user's last
+    ticket message in this group within that time is forwarded to that
+    ticket (if still open) rather than opening another one.
+    """
+    ticket_id = ticket_throttle.recent_ticket(message.chat.id, message.from_user.id)
+    if ticket_id:
+        bind_log_context(ticket_id=ticket_id)
+        async with ticket_locks.hold(ticket_id):
+            ticket = await store.get_ticket_by_id(ticket_id)
+            if ticket and ticket['status'] == 'open':
+                TICKET_EVENTS.inc('merged')
+                ticket_throttle.remember(message.chat.id, message.from_user.id, ticket_id)
+                await forward_continue_message_to_staff(message, ticket, album=album)
+                return
+    await forward_to_staff(message, album)
+
+
+# ======================== Staff Dashboard Commands ========================
+
+DASHBOARD_GROUPS_SHOWN = 10    # Groups listed by /open and /stats
+OLDEST_TICKETS_SHOWN = 10      # Tickets listed by /oldest
+
+
+def format_age(since_ms: Optional[int], now_ms: int) -> str:
+    """Readable age of a timestamp (ms), e.g. '3d 4h', '2h 15m', '7m'"""
+    if not since_ms:
+        return "age unknown"
+    minutes = max(0, (now_ms - since_ms) // 60000)
+    days, minutes = divmod(minutes, 1440)
+    hours, minutes = divmod(minutes, 60)
+    if days:
+        return f"{days}d {hours}h"
+    if hours:
+        return f"{hours}h {minutes}m"
+    return f"{minutes}m"
+
+
+def format_group_lines(rows: list, line) -> list:
+    """One line per group (first DASHBOARD_GROUPS_SHOWN), plus a '... more' line"""
+    lines = [line(row) for row in rows[:DASHBOARD_GROUPS_SHOWN]]
+    if len(rows) > DASHBOARD_GROUPS_SHOWN:
+        lines.append(f"… and {len(rows) - DASHBOARD_GROUPS_SHOWN} more groups")
+    return lines
+
+
+@dp.message(Command("open"), F.chat.id == STAFF_GROUP_ID)
+async def cmd_open(message: Message):
+    """Show open tickets per customer group (staff group, served from counters)"""
+    stats = await store.get_group_stats()
+    busy = sorted((row for row in stats if row['open_tickets'] > 0), key=lambda row: -row['open_tickets'])
+    
+    lines = [f"📂 Open tickets: {sum(row['open_tickets'] for row in busy)}"]
+    if busy:
+        lines.append("")
+        lines += format_group_lines(busy, lambda row: f"• Group {row['cust_group_id']}: {row['open_tickets']}")
+    queue_reply(message, "\n".join(lines))
+
+
+@dp.message(Command("stats"), F.chat.id == STAFF_GROUP_ID)
+async def cmd_stats(message: Message):
+    """Show ticket totals and the busiest customer groups (staff group, served from counters)"""
+    stats = await store.get_group_stats()
+    total = sum(row['total_tickets'] for row in stats)
+    open_tickets = sum(row['open_tickets'] for row in stats)
+    busiest = sorted(stats, key=lambda row: (-row['total_tickets'], -row['open_tickets']))
+    
+    lines = [
+        "📊 Ticket statistics",
+        f"Total: {total} | Open: {open_tickets} | Closed: {total - open_tickets}",
+        f"Groups with tickets: {len(stats)}",
+    ]
+    if busiest:
+        lines += ["", "🔥 Busiest groups (total / open):"]
+        lines += format_group_lines(
+            busiest, lambda row: f"• Group {row['cust_group_id']}: {row['total_tickets']} / {row['open_tickets']}"
         )
-        return True
+    queue_reply(message, "\n".join(lines))
+
+
+@dp.message(Command("oldest"), F.chat.id == STAFF_GROUP_ID)
+async def cmd_oldest(message: Message):
+    """Show the longest-waiting open tickets (staff group)"""
+    tickets = await store.get_oldest_open_tickets(OLDEST_TICKETS_SHOWN)
+    if not tickets:
+        queue_reply(message, "✅ No open tickets")
+        return
+    
+    now_ms = int(time.time() * 1000)
+    lines = ["⏳ Oldest open tickets:", ""]
+    lines += [
+        f"• #{ticket['ticket_id']} · {format_age(ticket['created_at'], now_ms)} · "
+        f"{ticket['username']} · group {ticket['cust_group_id']}"
+        for ticket in tickets
+    ]
+    queue_reply(message, "\n".join(lines))
+
+
+# ======================== Ticket Search ========================
+
+SEARCH_MAX_TERMS = 8          # Terms used from a /search query
+SEARCH_RESULTS_SHOWN = 10     # Tickets listed by /search
+SEARCH_SNIPPET_WIDTH = 60     # Characters of context around the first match
+
+
+class SearchIndexer:
+    """
+    Batched writer for the ticket search index
+    
+    Handlers add texts without waiting on the database; a background task
+    writes everything collected every `interval` seconds (or as soon as
+    max_batch texts are waiting) in a single transaction.
+    """
+
+    def __init__(self, interval: float, max_batch: int):
+        self.interval = interval
+        self.max_batch = max_batch
+        self._rows = []                 # (ticket_id, kind, author, body, created_at)
+        self._full = asyncio.Event()    # set when max_batch rows are waiting
+        self._task = None
+
+    @property
+    def pending(self) -> int:
+        """Number of texts not yet written"""
+        return len(self._rows)
+
+    def add(self, ticket_id: int, kind: str, author: Optional[str], body: Optional[str]):
+        """Queue a ticket text for indexing (empty texts are skipped)"""
+        if not body or not body.strip():
+            return
+        self._rows.append((ticket_id, kind, author, body, int(time.time() * 1000)))
+        if len(self._rows) >= self.max_batch:
+            self._full.set()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._full.wait(), self.interval)
+            await self.flush()
+
+    async def flush(self):
+        """Write all queued texts in one transaction"""
+        self._full.clear()
+        rows, self._rows = self._rows, []
+        if not rows:
+            return
+        try:
+            await store.index_ticket_texts(rows)
+        except Exception as e:
+            # Search misses these texts; the tickets themselves are unaffected
+            logger.error("Failed to index %s ticket texts: %s", len(rows), e, exc_info=True)
+
+    async def close(self):
+        """Stop the background task and write what is still queued"""
+        if self._task:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        await self.flush()
+
+
+search_index = SearchIndexer(SEARCH_INDEX_INTERVAL_MS / 1000, SEARCH_INDEX_BATCH_SIZE)
+metrics.gauge('bot_search_index_pending', 'Ticket texts waiting to be indexed', lambda: search_index.pending)
+
+
+def searchable_text(message: Message, album: Optional[list] = None) -> str:
+    """Text, captions and file names of a message (or of every album item)"""
+    parts = []
+    for item in album or [message]:
+        parts.append(item.text or item.caption or '')
+        if item.document and item.document.file_name:
+            parts.append(item.document.file_name)
+    return "\n".join(part for part in parts if part)
+
+
+def make_snippet(body: str, terms: list, width: int = SEARCH_SNIPPET_WIDTH) -> str:
+    """One-line excerpt of body around the first matching term, matches marked «like this»"""
+    body = " ".join(body.split())
+    pattern = re.compile("|".join(re.escape(term) for term in sorted(terms, key=len, reverse=True)), re.IGNORECASE)
+    match = pattern.search(body)
+    start = max(0, match.start() - width // 2) if match else 0
+    end = min(len(body), start + width)
+    start = max(0, end - width)
+    snippet = pattern.sub(lambda m: f"«{m.group(0)}»", body[start:end])
+    return ("…" if start else "") + snippet + ("…" if end < len(body) else "")
+
+
+@dp.message(Command("search"), F.chat.id == STAFF_GROUP_ID)
+async def cmd_search(message: Message):
+    """Search ticket texts, best matching tickets first (staff group)"""
+    # Parse command: /search <terms>
+    terms = message.text.split()[1:SEARCH_MAX_TERMS + 1]
+    if not terms:
+        queue_reply(message, "❌ Usage: /search <terms>\nExample: /search refund 订单")
+        return
     
-    # Found ticket and not closed, forward continued message
-    await forward_continue_message_to_staff(message, ticket)
+    # Several texts of one ticket may match: keep the best one per ticket
+    rows = await store.search_tickets(terms, SEARCH_RESULTS_SHOWN * 4)
+    best = {}
+    for row in rows:
+        best.setdefault(row['ticket_id'], row)
+    if not best:
+        queue_reply(message, f"🔎 No tickets found for: {' '.join(terms)}")
+        return
     
-    return True
+    lines = [f"🔎 Tickets matching: {' '.join(terms)}", ""]
+    for row in list(best.values())[:SEARCH_RESULTS_SHOWN]:
+        lines.append(f"• #{row['ticket_id']} ({row['status'] or 'archived'}) · {row['username'] or '?'}")
+        lines.append(f"  {make_snippet(row['body'], terms)}")
+    queue_reply(message, "\n".join(lines))
 
 
 # ======================== Staff Reply Handler ========================
 
 @dp.message(F.chat.id == STAFF_GROUP_ID)
 async def handle_staff_reply(message: Message):
-    """Handle staff group replies (must reply to wrapper message)"""
-    # Detailed log: confirm trigger and mapping key
-    logger.info(
-        f"Received staff reply: chat={message.chat.id}, "
-        f"msg_id={message.message_id}, "
-        f"reply_to={message.reply_to_message.message_id if message.reply_to_message else None}, "
-        f"from={message.from_user.id}"
+    """Handle staff group replies (to the wrapper or any other message of the ticket thread)"""
+    # Detailed log: confirm trigger and mapping key (chat and sender are in the log context)
+    logger.debug(
+        "Received staff message: msg_id=%s, reply_to=%s",
+        message.message_id, message.reply_to_message.message_id if message.reply_to_message else None
     )
     
     # Must be reply message
@@ -778,136 +4277,185 @@ async def handle_staff_reply(message: Message):
         logger.debug("Staff message is not a reply, skipping")
         return
     
-    # Get replied message ID (should be wrapper message_id)
-    wrapper_msg_id = message.reply_to_message.message_id
-    
-    # Query ticket info
-    ticket = get_ticket(wrapper_msg_id)
+    # Query ticket info by the replied message (wrapper, media copy, continuation or staff reply)
+    reply_to_msg_id = message.reply_to_message.message_id
+    ticket = await store.get_ticket_by_message(STAFF_GROUP_ID, reply_to_msg_id)
     
     if not ticket:
-        logger.debug(f"Message {wrapper_msg_id} is not a wrapper ticket message")
+        logger.debug("Message %s is not part of a ticket thread", reply_to_msg_id)
         return
     
-    logger.info(
-        f"Found ticket mapping: ticket_id={ticket['ticket_id']}, "
-        f"cust_group={ticket['cust_group_id']}, "
-        f"cust_msg={ticket['cust_msg_id']}, "
-        f"status={ticket['status']}"
+    wrapper_msg_id = ticket['staff_msg_id']
+    bind_log_context(ticket_id=ticket['ticket_id'])
+    
+    logger.debug(
+        "Found ticket mapping: cust_group=%s, cust_msg=%s, status=%s",
+        ticket['cust_group_id'], ticket['cust_msg_id'], ticket['status']
     )
     
-    # Check if close command
-    if message.text:
-        text_lower = message.text.lower().strip()
-        
-        # /close or /done command: close ticket
-        if text_lower in ['/close', '/done']:
-            if close_ticket_by_staff_msg_id(wrapper_msg_id):
-                await message.reply(f"✅ Ticket #{ticket['ticket_id']} closed")
-                logger.info(f"Closed ticket #{ticket['ticket_id']}")
-            else:
-                await message.reply("❌ Failed to close, please check logs")
-            return
-        
-        # /reopen command: reopen ticket
-        if text_lower == '/reopen':
-            if ticket['status'] == 'open':
-                await message.reply(f"ℹ️ Ticket #{ticket['ticket_id']} is already open")
+    # Commands and replies for one ticket run one at a time (ordered against customer continuations)
+    async with ticket_locks.hold(ticket['ticket_id']):
+        # Check if close command
+        if message.text:
+            text_lower = message.text.lower().strip()
+            
+            # /close or /done command: close ticket
+            if text_lower in ['/close', '/done']:
+                if await store.close_ticket_by_staff_msg_id(wrapper_msg_id):
+                    queue_reply(message, f"✅ Ticket #{ticket['ticket_id']} closed")
+                    TICKET_EVENTS.inc('closed')
+                    logger.info("Closed ticket #%s", ticket['ticket_id'])
+                else:
+                    queue_reply(message, "❌ Failed to close, please check logs")
                 return
             
-            if reopen_ticket_by_staff_msg_id(wrapper_msg_id):
-                await message.reply(f"✅ Ticket #{ticket['ticket_id']} reopened")
-                logger.info(f"Reopened ticket #{ticket['ticket_id']}")
-            else:
-                await message.reply("❌ Failed to reopen, please check logs")
-            return
-    
-    # Normal reply: forward to customer group
-    try:
-        # Build reply header (using ticket_id from database)
-        user_mention_link = f"[{ticket['username']}](tg://user?id={ticket['user_id']})"
-        caption_text = (
-            f"💬 Staff reply (Ticket #{ticket['ticket_id']})\n"
-            f"📢 {user_mention_link}\n"
-            f"{'─' * 30}\n"
-        )
-        
-        # Get message content type
-        content_type = message.content_type
-        
-        # Add original text to caption (if exists)
-        if message.text:
-            caption_text += message.text
-        elif message.caption:
-            caption_text += message.caption
-        
-        # Check if message type supports caption
-        unsupported_caption_types = ['video_note', 'sticker']
-        
-        # Used to record customer group anchor message ID
-        customer_anchor_msg = None
+            # /reopen command: reopen ticket
+            if text_lower == '/reopen':
+                # Status may have changed while waiting for the lock
+                ticket = await store.get_ticket(wrapper_msg_id) or ticket
+                if ticket['status'] == 'open':
+                    queue_reply(message, f"ℹ️ Ticket #{ticket['ticket_id']} is already open")
+                    return
+                
+                if await store.reopen_ticket_by_staff_msg_id(wrapper_msg_id):
+                    queue_reply(message, f"✅ Ticket #{ticket['ticket_id']} reopened")
+                    TICKET_EVENTS.inc('reopened')
+                    logger.info("Reopened ticket #%s", ticket['ticket_id'])
+                else:
+                    queue_reply(message, "❌ Failed to reopen, please check logs")
+                return
         
-        if content_type == 'text':
-            # Plain text reply
-            customer_anchor_msg = await bot.send_message(
-                ticket['cust_group_id'],
-                caption_text,
-                reply_to_message_id=ticket['cust_msg_id'],
-                parse_mode=ParseMode.MARKDOWN
-            )
-        elif content_type in unsupported_caption_types:
-            # Types that don't support caption: send text message first, then copy original
-            customer_anchor_msg = await bot.send_message(
-                ticket['cust_group_id'],
-                caption_text,
+        # Normal reply: forward to customer group
+        try:
+            # Reply header (using ticket_id from database) plus the staff text or caption;
+            # a long text continues in parts (or a document) under the same customer message
+            reply_parts, reply_document = render_staff_reply(ticket, message)
+            caption_text = reply_parts[0]
+            
+            # Get message content type
+            content_type = message.content_type
+            
+            # Used to record customer group anchor message ID
+            customer_anchor_msg = None
+            # Separate media copy (when the text went as its own message)
+            copied_msg = None
+            # Set when the reply text arrived but the media copy did not
+            copy_error = None
+            
+            header_method = SendMessage(
+                chat_id=ticket['cust_group_id'],
+                text=caption_text,
                 reply_to_message_id=ticket['cust_msg_id'],
-                parse_mode=ParseMode.MARKDOWN
+                parse_mode=ParseMode.HTML
             )
-            await bot.copy_message(
+            copy_method = CopyMessage(
                 chat_id=ticket['cust_group_id'],
                 from_chat_id=message.chat.id,
                 message_id=message.message_id,
                 reply_to_message_id=ticket['cust_msg_id']
             )
-        else:
-            # Types that support caption: use copy_message with caption
-            try:
-                customer_anchor_msg = await bot.copy_message(
-                    chat_id=ticket['cust_group_id'],
-                    from_chat_id=message.chat.id,
-                    message_id=message.message_id,
-                    caption=caption_text,
-                    reply_to_message_id=ticket['cust_msg_id'],
-                    parse_mode=ParseMode.MARKDOWN
+            
+            # The reply goes through the outbox: transient errors are retried in the background,
+            # and the customer anchor (for continued conversation routing) and this staff message
+            # (colleagues may reply to it) are mapped when it is sent
+            key = f"reply:{message.chat.id}:{message.message_id}"
+            action = {
+                'kind': 'staff_reply',
+                'ticket_id': ticket['ticket_id'],
+                'staff_msg_id': wrapper_msg_id,
+                'reply_msg_id': message.message_id,
+            }
+            # Later parts and a separate media copy, when a deferred reply's outbox worker posts them
+            follow_up_action = {
+                'kind': 'map', 'ticket_id': ticket['ticket_id'], 'chat_id': ticket['cust_group_id'],
+                'as': 'staff_reply'
+            }
+            if len(reply_parts) > 1:
+                # Rest of a long reply, kept with a deferred reply (see text_part_follow_ups)
+                action['follow_ups'] = text_part_follow_ups(
+                    ticket['cust_group_id'], reply_parts[1:], None, ticket['cust_msg_id'], PRIORITY_STAFF_REPLY,
+                    ticket['ticket_id'], key, follow_up_action, parse_mode=ParseMode.HTML
                 )
-            except Exception as e:
-                # If copy_message with caption fails, fallback
-                logger.warning(f"copy_message with caption failed, using fallback: {e}")
-                customer_anchor_msg = await bot.send_message(
-                    ticket['cust_group_id'],
-                    caption_text,
-                    reply_to_message_id=ticket['cust_msg_id'],
-                    parse_mode=ParseMode.MARKDOWN
+            
+            if content_type == 'text':
+                # Plain text reply
+                customer_anchor_msg = await outbox.send(header_method, PRIORITY_STAFF_REPLY, key, action)
+            elif content_type in CAPTIONLESS_CONTENT_TYPES or html_length(caption_text) > CAPTION_LIMIT:
+                # Types that don't support caption (or a caption too long for one): text message,
+                # then copy of original under the same customer message
+                customer_anchor_msg, copied_msg, copy_error = await send_header_and_copy(
+                    header_method, copy_method, PRIORITY_STAFF_REPLY, key, action, copy_action=follow_up_action
+                )
+            else:
+                # Types that support caption: use copy_message with caption
+                try:
+                    customer_anchor_msg = await outbox.send(
+                        copy_method.model_copy(
+                            update={'caption': caption_text, 'parse_mode': ParseMode.HTML}
+                        ),
+                        PRIORITY_STAFF_REPLY,
+                        key, action
+                    )
+                except (SendDeferred, DuplicateSend):
+                    raise
+                except Exception as e:
+                    # If copy_message with caption fails, fallback
+                    logger.warning("copy_message with caption failed, using fallback: %s", e)
+                    COPY_FALLBACKS.inc('staff_reply')
+                    customer_anchor_msg, copied_msg, copy_error = await send_header_and_copy(
+                        header_method, copy_method, PRIORITY_STAFF_REPLY, key + ':header', action,
+                        copy_action=follow_up_action
+                    )
+            
+            # Rest of a long reply, mapped so customers may reply to any part
+            parts, part_error = [], None
+            if len(reply_parts) > 1 or reply_document:
+                parts, part_error = await send_text_parts(
+                    ticket['cust_group_id'], reply_parts[1:], reply_document, ticket['cust_msg_id'],
+                    PRIORITY_STAFF_REPLY, ticket['ticket_id'], parse_mode=ParseMode.HTML
                 )
-                await bot.copy_message(
-                    chat_id=ticket['cust_group_id'],
-                    from_chat_id=message.chat.id,
-                    message_id=message.message_id,
-                    reply_to_message_id=ticket['cust_msg_id']
+            
+            if copy_error:
+                queue_reply(message, f"⚠️ Reply text sent, but the attachment could not be copied: {copy_error}")
+            elif part_error:
+                queue_reply(message, f"⚠️ Reply sent, but part of it could not be delivered: {part_error}")
+            else:
+                queue_reply(message, "✅ Reply sent to customer group")
+            if parts:
+                await store.add_ticket_messages(
+                    ticket['ticket_id'], ticket['cust_group_id'], sent_message_ids(parts), 'staff_reply'
                 )
-        
-        # Update customer group anchor message ID (for continued conversation routing)
-        if customer_anchor_msg:
-            update_customer_anchor(wrapper_msg_id, customer_anchor_msg.message_id)
-            logger.info(f"Updated anchor: staff_msg={wrapper_msg_id}, anchor={customer_anchor_msg.message_id}")
-        
-        # Confirm success in staff group
-        await message.reply("✅ Reply sent to customer group")
-        
-        logger.info(f"Staff replied to ticket #{ticket['ticket_id']} for user {ticket['username']} successfully")
-        
-    except Exception as e:
-        logger.error(f"Failed to send reply to customer group: {e}", exc_info=True)
-        await message.reply(f"❌ Send failed: {str(e)}")
+            if copied_msg:
+                # Customers may reply to the separate media copy as well
+                await store.add_ticket_messages(
+                    ticket['ticket_id'], ticket['cust_group_id'], sent_message_ids(copied_msg), 'staff_reply'
+                )
+            logger.debug("Updated anchor: staff_msg=%s, anchor=%s", wrapper_msg_id, customer_anchor_msg.message_id)
+            
+            search_index.add(
+                ticket['ticket_id'], 'staff', message.from_user.username or message.from_user.full_name,
+                searchable_text(message)
+            )
+            logger.info("Staff replied to ticket #%s for user %s", ticket['ticket_id'], ticket['username'])
+            
+        except DuplicateSend:
+            logger.info("Staff message %s was already relayed, skipping", message.message_id)
+        except SendDeferred as e:
+            if reply_document:
+                queue_reply(
+                    message,
+                    f"⏳ Telegram did not take the reply yet ({e}), it is retried automatically, "
+                    f"but without the .txt file of the full text: please send that part again later"
+                )
+            else:
+                queue_reply(message, f"⏳ Telegram did not take the reply yet ({e}), it is retried automatically")
+            search_index.add(
+                ticket['ticket_id'], 'staff', message.from_user.username or message.from_user.full_name,
+                searchable_text(message)
+            )
+        except Exception as e:
+            logger.error("Failed to send reply to customer group: %s", e, exc_info=True)
+            queue_reply(message, f"❌ Send failed: {str(e)}")
 
 
 # ======================== Customer Message Handler ========================
@@ -919,59 +4467,360 @@ async def handle_customer_message(message: Message):
     Note: Explicitly exclude STAFF_GROUP_ID to avoid conflict with staff reply handler
     """
     # Must be in customer group
-    if not is_customer_group(message.chat.id):
+    if not store.is_customer_group(message.chat.id):
         return
     
     # Ignore bot's own messages
     if message.from_user.is_bot:
         return
     
+    # Album items arrive as separate updates: collect them and handle the album once
+    if message.media_group_id:
+        album_buffer.add((message.chat.id, message.media_group_id), message)
+        return
+    
     # First check if continued message
     if await check_and_handle_continue_message(message):
         return
     
-    # Get bot info
-    bot_info = await bot.get_me()
-    bot_username = bot_info.username
-    
     # Check if bot mentioned or /ask command (create new ticket)
-    if await check_bot_mentioned(message, bot_username):
-        await forward_to_staff(message)
+    if check_bot_mentioned(message) and not throttled(message):
+        await open_ticket(message)
+
+
+async def handle_customer_album(key: tuple, messages: list):
+    """Handle a buffered customer album as one message (one ticket or one continuation)"""
+    messages.sort(key=lambda m: m.message_id)
+    
+    # Flushed outside the dispatcher: keep the chat's update order
+    async with update_scheduler.keys.hold(('chat', key[0])):
+        # Continued message: any item replying to a bot message carries the reply
+        replying = next((m for m in messages if m.reply_to_message), None)
+        if replying and await check_and_handle_continue_message(replying, album=messages):
+            return
+        
+        # New ticket if any caption mentions the bot
+        mentioned = next((m for m in messages if check_bot_mentioned(m)), None)
+        if mentioned and not throttled(mentioned):
+            await open_ticket(mentioned, album=messages)
+
+
+async def handle_coalesced_continuation(key: tuple, messages: list):
+    """Handle text replies of one customer to one ticket, buffered within the coalescing window"""
+    chat_id, _, ticket_id = key
+    
+    # Flushed outside the dispatcher: keep the chat's update order
+    async with update_scheduler.keys.hold(('chat', chat_id)):
+        bind_log_context(ticket_id=ticket_id)
+        async with ticket_locks.hold(ticket_id):
+            # Checked again: staff may have closed the ticket during the window
+            ticket = await store.get_ticket_by_id(ticket_id)
+            if not ticket or ticket['status'] == 'closed':
+                queue_reply(
+                    messages[-1],
+                    "⚠️ This ticket is closed. Please @bot or /ask to create a new ticket."
+                )
+                return
+            await forward_coalesced_continuations(messages, ticket)
+
+
+album_buffer = MessageBuffer(
+    ALBUM_WINDOW_MS / 1000,
+    handle_customer_album,
+    max_items=ALBUM_MAX_ITEMS,
+)
+metrics.gauge('bot_album_buffer_pending', 'Album items waiting for the debounce window', lambda: album_buffer.pending)
+
+continuation_buffer = MessageBuffer(
+    CONTINUATION_COALESCE_MS / 1000,
+    handle_coalesced_continuation,
+    max_items=COALESCE_MAX_MESSAGES,
+)
+metrics.gauge(
+    'bot_continuation_buffer_pending', 'Customer text replies waiting for the coalescing window',
+    lambda: continuation_buffer.pending
+)
+
+
+# ======================== Maintenance ========================
+
+async def run_retention(retention_days: int = TICKET_RETENTION_DAYS,
+                        batch_size: int = RETENTION_BATCH_SIZE) -> dict:
+    """
+    Archive closed tickets older than retention_days, then compact the database
+    Each batch is its own short write, so message handling interleaves with the job.
+    """
+    started = time.perf_counter()
+    closed_before = int(time.time() * 1000) - retention_days * 86400 * 1000
+    tickets = messages = 0
+    while True:
+        moved, moved_messages = await store.archive_closed_tickets(closed_before, batch_size)
+        tickets += moved
+        messages += moved_messages
+        if moved < batch_size:
+            break
+    
+    reclaimed = await store.compact() if tickets else 0
+    RETENTION_ARCHIVED.inc('tickets', amount=tickets)
+    RETENTION_ARCHIVED.inc('ticket_messages', amount=messages)
+    RETENTION_RECLAIMED.inc(amount=reclaimed)
+    logger.info(
+        "Retention: archived %s tickets and %s message map rows closed more than %s days ago, "
+        "reclaimed %s bytes in %.1fs",
+        tickets, messages, retention_days, reclaimed, time.perf_counter() - started
+    )
+    return {'tickets': tickets, 'messages': messages, 'reclaimed_bytes': reclaimed}
+
+
+async def retention_forever(interval: int):
+    """Run the retention job every `interval` seconds (first run at startup)"""
+    while True:
+        try:
+            await run_retention()
+        except Exception as e:
+            logger.error("Retention job failed: %s", e, exc_info=True)
+        await asyncio.sleep(interval)
+
+
+# ======================== Lifecycle ========================
+
+class Lifecycle:
+    """
+    Graceful shutdown for restarts and deploys
+    
+    SIGTERM/SIGINT set `stopping`: the update source stops (polling ends,
+    the webhook listener closes), then drain() lets in-flight updates,
+    buffered albums and queued sends finish within one shutdown deadline.
+    Updates still running at the deadline are cancelled; sends that never
+    started are stored in the outbox and delivered after the next start.
+    """
+
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self.stopping: Optional[asyncio.Event] = None
+        self.unfinished_updates = []    # update IDs cancelled at the deadline
+        self._drained = False
+
+    def install_signal_handlers(self):
+        """Turn SIGTERM/SIGINT into a graceful stop (inside the running event loop)"""
+        self.stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            with contextlib.suppress(NotImplementedError):  # Windows
+                loop.add_signal_handler(sig, self.stop, sig.name)
+
+    def stop(self, reason: str = "stop requested"):
+        if not self.stopping.is_set():
+            logger.info("Shutting down (%s), finishing in-flight work within %ss", reason, self.timeout)
+            self.stopping.set()
+
+    async def drain(self):
+        """Finish in-flight updates and sends before the deadline, store what is left (once)"""
+        if self._drained:
+            return
+        self._drained = True
+        deadline = time.monotonic() + self.timeout
+        self.unfinished_updates = await update_scheduler.drain(self.timeout)
+        # Albums and text replies still inside their debounce window are handled now
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(album_buffer.close(), continuation_buffer.close()),
+                max(0.1, deadline - time.monotonic())
+            )
+        except asyncio.TimeoutError:
+            logger.warning("Album / coalesced reply handlers still running at the shutdown deadline")
+        await search_index.close()
+        unsent = await send_queue.close(max(0.0, deadline - time.monotonic()))
+        await outbox.close()
+        await store_unsent_calls(unsent)
+
+
+async def store_unsent_calls(unsent: list):
+    """Save [(method, priority)] left in the send queue to the outbox, its worker sends them after the restart"""
+    now_ms = int(time.time() * 1000)
+    rows = []
+    for method, priority in unsent:
+        try:
+            rows.append((type(method).__name__, dump_method(method), priority, now_ms))
+        except Exception as e:
+            logger.warning("Dropping unsent %s call: %s", type(method).__name__, e)
+    if not rows:
+        return
+    try:
+        await store.save_unsent_calls(rows)
+        logger.warning("Stored %s unsent Bot API calls, they are sent after the restart", len(rows))
+    except Exception as e:
+        logger.error("Failed to store %s unsent Bot API calls: %s", len(rows), e, exc_info=True)
+
+
+async def confirm_polled_updates():
+    """
+    Acknowledge the updates handled before shutdown
+    aiogram confirms a polled batch only with its next getUpdates call, so the
+    last batch would be delivered again after a restart. Updates cancelled at the
+    deadline stay unconfirmed (and with them any later ones).
+    """
+    if update_scheduler.last_update_id is None:
+        return
+    offset = min(lifecycle.unfinished_updates, default=update_scheduler.last_update_id + 1)
+    try:
+        await bot.get_updates(offset=offset, limit=1, timeout=0)
+    except Exception as e:
+        logger.warning("Failed to confirm handled updates: %s", e)
+
+
+lifecycle = Lifecycle(SHUTDOWN_TIMEOUT_SECONDS)
+
+
+# ======================== Webhook Server ========================
+
+async def handle_health(request: web.Request) -> web.Response:
+    """Health check endpoint for load balancers"""
+    return web.json_response({
+        'status': 'ok',
+        'mode': BOT_MODE,
+        'bot': bot_identity.username,
+        'pending_sends': send_queue.pending,
+    })
+
+
+async def run_webhook():
+    """
+    Serve Telegram updates over an aiohttp webhook until SIGTERM/SIGINT
+
+    Updates are acknowledged immediately and processed as background tasks.
+    On shutdown the listener stops first, then the lifecycle drains
+    in-flight work before the server is torn down.
+    """
+    app = web.Application()
+    handler = SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET)
+    handler.register(app, path=WEBHOOK_PATH)
+    app.router.add_get('/healthz', handle_health)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    logger.info("Webhook server listening on %s:%s%s", WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+
+    if WEBHOOK_REGISTER:
+        await bot.set_webhook(
+            url=WEBHOOK_URL + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+        logger.info("Webhook registered: %s%s", WEBHOOK_URL, WEBHOOK_PATH)
+
+    try:
+        await lifecycle.stopping.wait()
+    finally:
+        # Stop accepting updates, then let in-flight ones finish.
+        # The webhook stays registered: Telegram queues updates until we are back.
+        await site.stop()
+        await lifecycle.drain()
+        await runner.cleanup()
+
+
+async def run_polling():
+    """Poll for updates until SIGTERM/SIGINT, then drain and confirm the handled updates"""
+    # Drop a webhook left over from webhook mode, getUpdates fails otherwise
+    await bot.delete_webhook()
+    polling = asyncio.create_task(dp.start_polling(
+        bot,
+        allowed_updates=dp.resolve_used_update_types(),
+        handle_signals=False,
+        close_bot_session=False
+    ))
+    stopping = asyncio.create_task(lifecycle.stopping.wait())
+    try:
+        await asyncio.wait({polling, stopping}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        stopping.cancel()
+        if not polling.done():
+            try:
+                await dp.stop_polling()
+            except RuntimeError:  # stopped before polling got going
+                polling.cancel()
+        await lifecycle.drain()
+    if not polling.cancelled():
+        await polling  # polling errors propagate
+    await confirm_polled_updates()
 
 
 # ======================== Main Entry Point ========================
 
 async def main():
     """Main function"""
-    # Initialize database
-    init_db()
+    # SIGTERM/SIGINT from here on drain in-flight work instead of killing it
+    lifecycle.install_signal_handlers()
+    
+    # Open ticket store (initializes database)
+    await store.open()
+    
+    # Resolve bot identity once (shared by all handlers)
+    await bot_identity.resolve(bot)
+    refresh_task = None
+    if BOT_IDENTITY_REFRESH_SECONDS > 0:
+        refresh_task = asyncio.create_task(
+            bot_identity.refresh_forever(bot, BOT_IDENTITY_REFRESH_SECONDS)
+        )
     
-    # Get bot info
-    bot_info = await bot.get_me()
+    # Shared database: pick up customer groups added on other instances
+    groups_task = None
+    if store.shared and GROUP_CACHE_REFRESH_SECONDS > 0:
+        groups_task = asyncio.create_task(store.refresh_groups_forever(GROUP_CACHE_REFRESH_SECONDS))
+    
+    # Optional ticket retention / compaction job
+    retention_task = None
+    if TICKET_RETENTION_DAYS > 0:
+        retention_task = asyncio.create_task(retention_forever(RETENTION_INTERVAL_SECONDS))
     
     # Check if token is set (without printing token value)
     token_status = "yes" if API_TOKEN else "no"
     
-    logger.info(f"Bot starting: @{bot_info.username}")
-    logger.info(f"Token is set: {token_status}")
-    logger.info(f"Staff group ID: {STAFF_GROUP_ID}")
-    logger.info(f"Admin user ID: {ADMIN_USER_ID}")
+    logger.info("Bot starting: %s", bot_identity.mention)
+    logger.info("Token is set: %s", token_status)
+    logger.info("Staff group ID: %s", STAFF_GROUP_ID)
+    logger.info("Admin user ID: %s", ADMIN_USER_ID)
     logger.info("=" * 50)
     logger.info("⚠️  Important reminders:")
     logger.info("  1. Ensure bot is added to staff group and customer groups")
     logger.info("  2. Disable Privacy Mode in bot settings")
     logger.info("     Visit @BotFather -> Bot Settings -> Group Privacy -> Turn Off")
     logger.info("  3. Use /addgroup command in customer groups (silent mode)")
-    logger.info("  4. Staff must reply to wrapper ticket message (not media copy)")
+    logger.info("  4. Staff must reply to the wrapper or another message of the ticket thread")
     logger.info("  5. Customers can reply to bot messages or use /t command to continue")
     logger.info("  6. Staff can use /close /done to close tickets, /reopen to reopen")
     logger.info("=" * 50)
     
-    # Start polling
+    # Start outbound send queue and the outbox worker (retries, calls the last run could not send)
+    send_queue.start()
+    outbox.start()
+    search_index.start()
+    
+    # Optional metrics endpoint
+    metrics_runner = await start_metrics_server() if metrics.enabled else None
+    
     try:
-        await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+        if BOT_MODE == 'webhook':
+            await run_webhook()
+        else:
+            await run_polling()
     finally:
+        # No-op after a graceful stop; drains what it can after an error
+        await lifecycle.drain()
+        if refresh_task:
+            refresh_task.cancel()
+        if retention_task:
+            retention_task.cancel()
+        if groups_task:
+            groups_task.cancel()
+        if metrics_runner:
+            await metrics_runner.cleanup()
         await bot.session.close()
+        await store.close()
 
 
 if __name__ == '__main__':
@@ -980,6 +4829,7 @@ if __name__ == '__main__':
     except KeyboardInterrupt:
         logger.info("Bot stopped")
     except ValueError as e:
-        logger.error(f"Configuration error: {e}")
+        logger.error("Configuration error: %s", e)
         logger.error("Please set required environment variables:")
         logger.error("  TELEGRAM_BOT_TOKEN, STAFF_GROUP_ID, ADMIN_USER_ID")
+        logger.error("  (webhook mode also needs WEBHOOK_URL and WEBHOOK_SECRET)")
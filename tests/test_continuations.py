@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Continuation coalescing tests
+Customer text replies to a ticket are fed through the dispatcher with a fake
+Bot API session; the tests check what the staff group receives and in which
+order (CONTINUATION_COALESCE_MS on, with a short window).
+
+Usage:
+    python -m pytest tests
+"""
+
+import asyncio
+import datetime
+import itertools
+import os
+import sys
+
+import pytest
+
+# bot.py validates its configuration on import; the tests never talk to Telegram
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:TESTS')
+os.environ.setdefault('STAFF_GROUP_ID', '-1000000000000')
+os.environ.setdefault('ADMIN_USER_ID', '1')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram.client.session.base import BaseSession  # noqa: E402
+from aiogram.types import Chat, Message, Update, User  # noqa: E402
+
+import bot  # noqa: E402
+
+STAFF = bot.STAFF_GROUP_ID
+GROUP = -2001
+WRAPPER_MSG_ID = 100
+ANCHOR_MSG_ID = 50
+WINDOW = 0.2
+
+BOT_USER = User(id=999, is_bot=True, first_name='Bot', username='support_bot')
+CUSTOMER = User(id=7, is_bot=False, first_name='Alice', username='alice')
+
+
+class FakeSession(BaseSession):
+    """Answers every Bot API call locally and records it"""
+
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+        self._message_ids = itertools.count(1000)
+
+    async def make_request(self, bot_, method, timeout=None):
+        self.calls.append(method)
+        if isinstance(method, bot.aiogram.methods.GetMe):
+            return BOT_USER
+        return Message(
+            message_id=next(self._message_ids), date=datetime.datetime.now(),
+            chat=Chat(id=method.chat_id, type='supergroup'), from_user=BOT_USER,
+            text=getattr(method, 'text', None)
+        )
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, *args, **kwargs):
+        yield b''
+
+    def staff_texts(self) -> list:
+        return [call.text for call in self.calls if getattr(call, 'chat_id', None) == STAFF]
+
+
+@pytest.fixture
+def run(monkeypatch, tmp_path):
+    """run(scenario): start the bot's services on a fresh database, await scenario(session), stop them"""
+    session = FakeSession()
+    monkeypatch.setattr(bot.bot, 'session', session)
+    monkeypatch.setattr(bot, 'store', bot.SQLiteTicketStore(str(tmp_path / 'tickets.db')))
+    monkeypatch.setattr(bot, 'CONTINUATION_COALESCE_MS', int(WINDOW * 1000))
+    monkeypatch.setattr(bot.continuation_buffer, 'window', WINDOW)
+    # Slots are bound to the event loop of the first update
+    monkeypatch.setattr(bot.update_scheduler, '_slots', None)
+    monkeypatch.setattr(bot.update_scheduler, '_staff_slots', None)
+
+    def run_scenario(scenario):
+        async def main():
+            await bot.store.open()
+            await bot.bot_identity.resolve(bot.bot)
+            bot.send_queue.start()
+            try:
+                await bot.store.add_customer_group(GROUP)
+                ticket_id = await bot.store.next_ticket_id()
+                await bot.store.save_ticket(WRAPPER_MSG_ID, ticket_id, GROUP, 1, CUSTOMER.id, 'alice')
+                await bot.store.update_customer_anchor(WRAPPER_MSG_ID, ANCHOR_MSG_ID)
+                await scenario(session)
+            finally:
+                await bot.continuation_buffer.close()
+                await bot.send_queue.close()
+                await bot.store.close()
+        asyncio.run(main())
+    return run_scenario
+
+
+update_ids = itertools.count(1)
+message_ids = itertools.count(10)
+
+
+def reply(text: str) -> Message:
+    """A customer text replying to the ticket's anchor in the customer group"""
+    anchor = Message(
+        message_id=ANCHOR_MSG_ID, date=datetime.datetime.now(),
+        chat=Chat(id=GROUP, type='supergroup'), from_user=BOT_USER, text='💬 Staff reply'
+    )
+    return Message(
+        message_id=next(message_ids), date=datetime.datetime.now(),
+        chat=Chat(id=GROUP, type='supergroup', title='Customers'), from_user=CUSTOMER,
+        text=text, reply_to_message=anchor
+    )
+
+
+async def feed(message: Message):
+    await bot.dp.feed_update(bot.bot, Update(update_id=next(update_ids), message=message))
+
+
+async def settle():
+    """Wait for the window to pass and the flushed batches to be sent"""
+    await asyncio.sleep(WINDOW * 2)
+    while bot.continuation_buffer.pending or bot.continuation_buffer._tasks or bot.send_queue.pending:
+        await asyncio.sleep(0.01)
+
+
+def test_quick_replies_are_merged(run):
+    async def scenario(session):
+        await feed(reply('FIRST'))
+        await feed(reply('SECOND'))
+        assert session.staff_texts() == []   # held for the window
+        await settle()
+        texts = session.staff_texts()
+        assert len(texts) == 1
+        assert texts[0].endswith('FIRST\nSECOND')
+    run(scenario)
+
+
+def test_replies_after_the_window_are_separate(run):
+    async def scenario(session):
+        await feed(reply('FIRST'))
+        await settle()
+        await feed(reply('SECOND'))
+        await settle()
+        texts = session.staff_texts()
+        assert len(texts) == 2
+        assert texts[0].endswith('FIRST')
+        assert texts[1].endswith('SECOND')
+    run(scenario)
+
+
+def test_reply_buffered_during_flush_keeps_order(run):
+    async def scenario(session):
+        await feed(reply('FIRST'))
+        # The window runs out while the chat is busy; the flush waits for its turn
+        async with bot.update_scheduler.keys.hold(('chat', GROUP)):
+            await asyncio.sleep(WINDOW * 2)
+            ticket_id = (await bot.store.get_ticket(WRAPPER_MSG_ID))['ticket_id']
+            bot.continuation_buffer.add((GROUP, CUSTOMER.id, ticket_id), reply('SECOND'))
+        await settle()
+        text = '\n'.join(session.staff_texts())
+        assert 'FIRST' in text and 'SECOND' in text
+        assert text.index('FIRST') < text.index('SECOND')
+    run(scenario)
+
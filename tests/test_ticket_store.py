@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""
+TicketStore contract tests
+Every backend must behave the same for the handlers. The SQLite store is
+always tested; the PostgreSQL store only when TEST_DATABASE_URL is set, in a
+throwaway schema of that database (dropped afterwards).
+
+Usage:
+    python -m pytest tests
+    TEST_DATABASE_URL=postgresql://user@host/db python -m pytest tests
+"""
+
+import asyncio
+import json
+import os
+import sys
+import time
+import uuid
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import pytest
+
+# bot.py validates its configuration on import; the tests never talk to Telegram
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:TESTS')
+os.environ.setdefault('STAFF_GROUP_ID', '-1000000000000')
+os.environ.setdefault('ADMIN_USER_ID', '1')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+TEST_DATABASE_URL = os.getenv('TEST_DATABASE_URL', '').strip()
+
+STAFF = bot.STAFF_GROUP_ID
+GROUP = -2001
+OTHER_GROUP = -2002
+
+
+def now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+def with_search_path(url: str, schema: str) -> str:
+    """The URL with a search_path (asyncpg passes unknown query parameters as server settings)"""
+    parts = urlsplit(url)
+    query = parse_qsl(parts.query) + [('search_path', schema)]
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+async def postgres_schema(schema: str, create: bool):
+    conn = await bot.asyncpg.connect(TEST_DATABASE_URL)
+    try:
+        if create:
+            await conn.execute(f'CREATE SCHEMA {schema}')
+        else:
+            await conn.execute(f'DROP SCHEMA {schema} CASCADE')
+    finally:
+        await conn.close()
+
+
+@pytest.fixture(params=['sqlite', 'postgres'])
+def run(request, tmp_path):
+    """run(check): open a fresh store of the backend, await check(store), close it"""
+    if request.param == 'postgres':
+        if not TEST_DATABASE_URL:
+            pytest.skip("TEST_DATABASE_URL is not set")
+        if bot.asyncpg is None:
+            pytest.skip("asyncpg is not installed")
+
+    def run_check(check):
+        async def main():
+            schema = None
+            if request.param == 'sqlite':
+                store = bot.SQLiteTicketStore(
+                    str(tmp_path / 'tickets.db'), archive_path=str(tmp_path / 'archive.db'), id_block_size=10
+                )
+            else:
+                schema = f"test_{uuid.uuid4().hex}"
+                await postgres_schema(schema, create=True)
+                store = bot.PostgresTicketStore(with_search_path(TEST_DATABASE_URL, schema), id_block_size=10)
+            try:
+                await store.open()
+                try:
+                    await check(store)
+                finally:
+                    await store.close()
+            finally:
+                if schema:
+                    await postgres_schema(schema, create=False)
+        asyncio.run(main())
+    return run_check
+
+
+async def open_ticket(store, staff_msg_id: int, group_id: int = GROUP, cust_msg_id: int = None) -> int:
+    ticket_id = await store.next_ticket_id()
+    await store.save_ticket(staff_msg_id, ticket_id, group_id, cust_msg_id or staff_msg_id + 1, 7, 'alice')
+    return ticket_id
+
+
+def test_incomplete_backend_fails_when_created():
+    class PartialStore(bot.TicketStore):
+        async def open(self):
+            pass
+
+    with pytest.raises(TypeError, match='abstract'):
+        PartialStore()
+
+
+# ---------- Tickets ----------
+
+def test_ticket_ids_are_unique_and_increasing(run):
+    async def check(store):
+        ids = [await store.next_ticket_id() for _ in range(25)]
+        assert ids == sorted(ids)
+        assert len(set(ids)) == len(ids)
+    run(check)
+
+
+def test_save_and_lookup(run):
+    async def check(store):
+        ticket_id = await open_ticket(store, 100, cust_msg_id=5)
+        ticket = await store.get_ticket(100)
+        assert ticket['ticket_id'] == ticket_id
+        assert ticket['cust_group_id'] == GROUP
+        assert ticket['cust_msg_id'] == 5
+        assert ticket['user_id'] == 7
+        assert ticket['username'] == 'alice'
+        assert ticket['status'] == 'open'
+        assert ticket['customer_anchor_msg_id'] is None
+        assert await store.get_ticket_by_id(ticket_id) == ticket
+        # The wrapper is the first message of the thread
+        assert await store.get_ticket_by_message(STAFF, 100) == ticket
+        assert await store.get_ticket(101) is None
+        assert await store.get_ticket_by_id(ticket_id + 1000) is None
+        assert await store.get_ticket_by_message(GROUP, 100) is None
+    run(check)
+
+
+def test_message_map(run):
+    async def check(store):
+        ticket_id = await open_ticket(store, 100)
+        other_id = await open_ticket(store, 200)
+        await store.add_ticket_messages(ticket_id, STAFF, [101, 102], 'copy')
+        await store.add_ticket_messages(ticket_id, STAFF, [102], 'continuation')  # duplicate, ignored
+        await store.add_ticket_messages(other_id, GROUP, [101], 'staff_reply')     # same ID, other chat
+        assert (await store.get_ticket_by_message(STAFF, 102))['ticket_id'] == ticket_id
+        assert (await store.get_ticket_by_message(GROUP, 101))['ticket_id'] == other_id
+
+        await store.update_customer_anchor(100, 50, [51, 52])
+        assert (await store.get_ticket(100))['customer_anchor_msg_id'] == 50
+        for message_id in (50, 51, 52):
+            assert (await store.get_ticket_by_message(GROUP, message_id))['ticket_id'] == ticket_id
+    run(check)
+
+
+def test_close_and_reopen_keep_counters(run):
+    async def check(store):
+        await open_ticket(store, 100)
+        await open_ticket(store, 200)
+        await open_ticket(store, 300, group_id=OTHER_GROUP)
+        stats = {row['cust_group_id']: row for row in await store.get_group_stats()}
+        assert (stats[GROUP]['open_tickets'], stats[GROUP]['total_tickets']) == (2, 2)
+        assert (stats[OTHER_GROUP]['open_tickets'], stats[OTHER_GROUP]['total_tickets']) == (1, 1)
+
+        assert await store.close_ticket_by_staff_msg_id(100)
+        assert await store.close_ticket_by_staff_msg_id(100)   # already closed: counters unchanged
+        ticket = await store.get_ticket(100)
+        assert ticket['status'] == 'closed'
+        assert ticket['closed_at']
+        stats = {row['cust_group_id']: row for row in await store.get_group_stats()}
+        assert (stats[GROUP]['open_tickets'], stats[GROUP]['total_tickets']) == (1, 2)
+        assert [row['staff_msg_id'] for row in await store.get_oldest_open_tickets(10)] == [200, 300]
+
+        assert await store.reopen_ticket_by_staff_msg_id(100)
+        assert await store.reopen_ticket_by_staff_msg_id(100)  # already open: counters unchanged
+        assert (await store.get_ticket(100))['status'] == 'open'
+        stats = {row['cust_group_id']: row for row in await store.get_group_stats()}
+        assert (stats[GROUP]['open_tickets'], stats[GROUP]['total_tickets']) == (2, 2)
+        assert [row['staff_msg_id'] for row in await store.get_oldest_open_tickets(2)] == [100, 200]
+    run(check)
+
+
+def test_oldest_open_follows_creation_time(run):
+    async def check(store):
+        # Instances take ID blocks, so a lower ticket ID can be saved later
+        first_id, second_id = await store.next_ticket_id(), await store.next_ticket_id()
+        await store.save_ticket(200, second_id, GROUP, 201, 7, 'alice')
+        await asyncio.sleep(0.01)
+        await store.save_ticket(100, first_id, GROUP, 101, 7, 'alice')
+        assert [row['staff_msg_id'] for row in await store.get_oldest_open_tickets(10)] == [200, 100]
+    run(check)
+
+
+# ---------- Outbox ----------
+
+def test_outbox_claim_and_finish(run):
+    async def check(store):
+        ticket_id = await store.next_ticket_id()
+        action = {
+            'kind': 'ticket', 'ticket_id': ticket_id, 'cust_group_id': GROUP, 'cust_msg_id': 5,
+            'user_id': 7, 'username': 'alice',
+        }
+        outbox_id = await store.add_outbox_call('wrapper:1', 'SendMessage', '{"text": "t"}', 3, action, 0)
+        assert outbox_id is not None
+        assert await store.add_outbox_call('wrapper:1', 'SendMessage', '{}', 3, None, 0) is None
+
+        now = now_ms()
+        rows = await store.claim_outbox_calls(now, now + 60000, 10)
+        assert [(row['id'], row['method'], row['action']) for row in rows] == [(outbox_id, 'SendMessage', action)]
+        assert json.loads(rows[0]['payload']) == {'text': 't'}
+        assert await store.claim_outbox_calls(now, now + 60000, 10) == []   # leased
+
+        await store.finish_outbox_call(outbox_id, [100], action, now)
+        assert (await store.get_ticket(100))['ticket_id'] == ticket_id
+        await store.finish_outbox_call(outbox_id, [100], action, now)       # finished already: no-op
+        assert [row['total_tickets'] for row in await store.get_group_stats()] == [1]
+        assert await store.claim_outbox_calls(now + 120000, now + 180000, 10) == []
+    run(check)
+
+
+def test_outbox_follow_ups(run):
+    async def check(store):
+        ticket_id = await open_ticket(store, 100)
+        follow_up = {
+            'key': 'reply:1:part1', 'method': 'SendMessage', 'payload': json.dumps({'chat_id': GROUP, 'text': 'p'}),
+            'priority': 1, 'action': {'kind': 'map', 'ticket_id': ticket_id, 'chat_id': GROUP, 'as': 'staff_reply'},
+        }
+        action = {'kind': 'staff_reply', 'ticket_id': ticket_id, 'staff_msg_id': 100, 'reply_msg_id': 300,
+                  'follow_ups': [follow_up]}
+        outbox_id = await store.add_outbox_call('reply:1', 'SendMessage', '{}', 1, action, 0)
+        now = now_ms()
+        await store.finish_outbox_call(outbox_id, [50], action, now)
+        assert (await store.get_ticket(100))['customer_anchor_msg_id'] == 50
+        assert (await store.get_ticket_by_message(STAFF, 300))['ticket_id'] == ticket_id
+
+        rows = await store.claim_outbox_calls(now, now + 60000, 10)
+        assert len(rows) == 1
+        assert json.loads(rows[0]['payload']) == {'chat_id': GROUP, 'text': 'p', 'reply_to_message_id': 50}
+        await store.finish_outbox_call(rows[0]['id'], [51], rows[0]['action'], now)
+        assert (await store.get_ticket_by_message(GROUP, 51))['ticket_id'] == ticket_id
+    run(check)
+
+
+def test_outbox_retry_fail_release_and_purge(run):
+    async def check(store):
+        now = now_ms()
+        retried = await store.add_outbox_call('a', 'SendMessage', '{}', 1, None, 0)
+        dead = await store.add_outbox_call('b', 'SendMessage', '{}', 1, None, 0)
+        released = await store.add_outbox_call('c', 'SendMessage', '{}', 1, None, now + 60000)
+
+        await store.retry_outbox_call(retried, 1, now + 5000, 'timeout')
+        await store.fail_outbox_call(dead, 3, 'chat not found', now)
+        assert await store.claim_outbox_calls(now, now + 60000, 10) == []
+
+        await store.release_outbox_calls([released])
+        rows = await store.claim_outbox_calls(now + 5000, now + 60000, 10)
+        assert sorted((row['id'], row['attempts']) for row in rows) == [(retried, 1), (released, 0)]
+
+        await store.finish_outbox_call(retried, [], None, now)
+        assert await store.purge_outbox(now + 1) == 2   # the sent and the dead call
+        assert await store.add_outbox_call('a', 'SendMessage', '{}', 1, None, 0) is not None
+    run(check)
+
+
+# ---------- Maintenance ----------
+
+def test_archive_closed_tickets(run):
+    async def check(store):
+        await open_ticket(store, 100)
+        await open_ticket(store, 200)
+        closed_id = await open_ticket(store, 300)
+        await store.add_ticket_messages(closed_id, STAFF, [301, 302], 'copy')
+        await store.close_ticket_by_staff_msg_id(100)
+        await store.close_ticket_by_staff_msg_id(300)
+
+        assert await store.archive_closed_tickets(now_ms() - 3600000, 10) == (0, 0)   # closed too recently
+        # Batches of one ticket with its message map rows (the wrapper, plus two copies for closed_id)
+        batches = [await store.archive_closed_tickets(now_ms() + 1000, 1) for _ in range(2)]
+        assert sorted(batches) == [(1, 1), (1, 3)]
+        assert await store.archive_closed_tickets(now_ms() + 1000, 10) == (0, 0)
+
+        assert await store.get_ticket(100) is None
+        assert await store.get_ticket_by_id(closed_id) is None
+        assert await store.get_ticket_by_message(STAFF, 301) is None
+        assert (await store.get_ticket(200))['status'] == 'open'
+        assert [row['staff_msg_id'] for row in await store.get_oldest_open_tickets(10)] == [200]
+    run(check)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Ticket lookup benchmark
+Measures /t (ticket_id) and customer reply lookup latency against table
+size, on the schema before the lookup indexes (v1) and after all migrations
+are applied. Customer replies are routed through the message map
+(ticket_messages) from v4 on; the old anchor column lookup is kept for
+comparison (its index was dropped in v10).
+
+Usage:
+    python tools/bench_ticket_lookup.py [--sizes 1000,10000,100000] [--lookups 2000]
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+# bot.py validates its configuration on import; the benchmark never talks to Telegram
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:BENCHMARK')
+os.environ.setdefault('STAFF_GROUP_ID', '-1000000000000')
+os.environ.setdefault('ADMIN_USER_ID', '1')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import logging  # noqa: E402
+
+import bot  # noqa: E402
+
+GROUPS = 50
+
+# Columns of the v1 tickets table (later migrations add columns, e.g. created_at)
+V1_TICKET_COLUMNS = (
+    'staff_msg_id, ticket_id, cust_group_id, cust_msg_id, user_id, username, '
+    'customer_anchor_msg_id, status, closed_at'
+)
+
+# Customer reply lookup before the message map (the bot no longer uses it)
+SQL_SELECT_TICKET_BY_ANCHOR = (
+    f'SELECT {bot.TICKET_COLUMNS} FROM tickets WHERE cust_group_id = ? AND customer_anchor_msg_id = ?'
+)
+
+
+def populate(conn, size: int):
+    """Insert `size` tickets spread over GROUPS customer groups"""
+    base_id = 1_700_000_000_000
+    rows = (
+        (staff_msg_id, base_id + staff_msg_id, -1000 - staff_msg_id % GROUPS,
+         staff_msg_id, staff_msg_id % 5000, f"user{staff_msg_id % 5000}",
+         staff_msg_id + 10, 'closed' if staff_msg_id % 10 else 'open', None)
+        for staff_msg_id in range(1, size + 1)
+    )
+    with conn:
+        conn.executemany('INSERT INTO tickets VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+
+def time_lookups(conn, size: int, lookups: int) -> dict:
+    """Return median/p99 latency in microseconds for each lookup path"""
+    rng = random.Random(size)
+    keys = [rng.randint(1, size) for _ in range(lookups)]
+    paths = [
+        ('ticket_id', bot.SQL_SELECT_TICKET_BY_ID,
+         lambda k: (1_700_000_000_000 + k,)),
+        ('anchor', SQL_SELECT_TICKET_BY_ANCHOR,
+         lambda k: (-1000 - k % GROUPS, k + 10)),
+    ]
+    if bot.get_schema_version(conn) >= 4:
+        paths.append(('message', bot.SQL_SELECT_TICKET_BY_MESSAGE,
+                      lambda k: (-1000 - k % GROUPS, k + 10)))
+    # The bot's queries select the latest columns; on older schemas select the columns they have
+    existing = {row[1] for row in conn.execute('PRAGMA table_info(tickets)')}
+    columns = bot.TICKET_COLUMNS if 'created_at' in existing else V1_TICKET_COLUMNS
+    results = {}
+    for name, sql, params in paths:
+        sql = sql.replace(bot.TICKET_COLUMNS, columns)
+        samples = []
+        for key in keys:
+            start = time.perf_counter()
+            row = conn.execute(sql, params(key)).fetchone()
+            samples.append((time.perf_counter() - start) * 1e6)
+            assert row is not None
+        samples.sort()
+        results[name] = (statistics.median(samples), samples[int(len(samples) * 0.99) - 1])
+    return results
+
+
+def run(sizes, lookups: int):
+    print(f"{'rows':>9} | {'schema':>6} | {'ticket_id p50/p99 (us)':>24} | {'anchor p50/p99 (us)':>22} | "
+          f"{'message map p50/p99 (us)':>24}")
+    print('-' * 99)
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            conn = bot.connect_db(os.path.join(tmp, 'tickets.db'))
+            bot.migrate_db(conn, target_version=1)
+            populate(conn, size)
+            for label in ('v1', 'latest'):
+                if label == 'latest':
+                    bot.migrate_db(conn)
+                label = f"v{bot.get_schema_version(conn)}"
+                res = time_lookups(conn, size, lookups)
+                message = (
+                    f"{res['message'][0]:>11.1f} / {res['message'][1]:>10.1f}" if 'message' in res
+                    else f"{'-':>24}"
+                )
+                print(
+                    f"{size:>9} | {label:>6} | "
+                    f"{res['ticket_id'][0]:>11.1f} / {res['ticket_id'][1]:>10.1f} | "
+                    f"{res['anchor'][0]:>9.1f} / {res['anchor'][1]:>10.1f} | {message}"
+                )
+            conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='1000,10000,100000',
+                        help='Comma-separated table sizes (default: 1000,10000,100000)')
+    parser.add_argument('--lookups', type=int, default=2000,
+                        help='Random lookups per measurement (default: 2000)')
+    args = parser.parse_args()
+
+    logging.getLogger('bot').setLevel(logging.WARNING)
+    run([int(s) for s in args.sizes.split(',')], args.lookups)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+One-time auto-vacuum conversion
+Databases created before auto_vacuum was enabled cannot hand pages freed by
+retention back to the file system. Switching them to incremental
+auto-vacuum needs one full VACUUM, which rewrites the whole file and locks
+the database meanwhile, so run this with the bot stopped.
+
+Usage:
+    python tools/enable_incremental_vacuum.py [--db tickets.db]
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+import time
+
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+def convert(path: str):
+    conn = sqlite3.connect(path, isolation_level=None)
+    try:
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == AUTO_VACUUM_INCREMENTAL:
+            print(f"{path} already uses incremental auto-vacuum, nothing to do")
+            return
+        size_before = os.path.getsize(path)
+        started = time.perf_counter()
+        conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        conn.execute('VACUUM')
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != AUTO_VACUUM_INCREMENTAL:
+            sys.exit(f"{path}: conversion failed, auto_vacuum is unchanged")
+        print(f"Converted {path} in {time.perf_counter() - started:.1f}s "
+              f"({size_before} -> {os.path.getsize(path)} bytes)")
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', default=os.getenv('DB_PATH', 'tickets.db'),
+                        help='SQLite database (default: $DB_PATH or tickets.db)')
+    args = parser.parse_args()
+    if not os.path.exists(args.db):
+        sys.exit(f"{args.db} does not exist")
+    convert(args.db)
+
+
+if __name__ == '__main__':
+    main()
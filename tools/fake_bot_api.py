@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Fake Telegram Bot API server
+An aiohttp stand-in for api.telegram.org that answers the calls bot.py makes
+(getMe, sendMessage, copyMessage, copyMessages, sendMediaGroup, ...) with
+plausible results, records every call, and can inject latency, flood
+control (429 RetryAfter) and server errors.
+
+Point the bot at it with TELEGRAM_API_URL:
+    python tools/fake_bot_api.py --port 8081 --latency-ms 40 --retry-after-rate 0.01
+    TELEGRAM_API_URL=http://127.0.0.1:8081 python bot.py
+
+tools/loadtest.py starts it in-process.
+"""
+
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import random
+import time
+
+from aiohttp import web
+
+BOT_USER = {'id': 100000, 'is_bot': True, 'first_name': 'Fake Bot', 'username': 'fake_support_bot'}
+
+
+class FakeBotAPI:
+    """In-process fake Bot API with call recording and fault injection"""
+
+    def __init__(self, latency_ms: float = 0, jitter_ms: float = 0, retry_after_rate: float = 0,
+                 retry_after: int = 1, error_rate: float = 0, record_limit: int = 10000, seed: int = 0):
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self.error_rate = error_rate
+        self.counts = collections.Counter()    # method -> answered calls
+        self.faults = collections.Counter()    # 'retry_after' / 'server_error' -> injected
+        self.calls = collections.deque(maxlen=record_limit)  # recent (method, params), oldest dropped
+        self._message_ids = itertools.count(1)
+        self._rng = random.Random(seed)
+        self._runner = None
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        return app
+
+    async def start(self, host: str = '127.0.0.1', port: int = 8081) -> str:
+        """Start serving, returns the base URL for TELEGRAM_API_URL"""
+        self._runner = web.AppRunner(self.app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]  # resolve port 0
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def _message(self, chat_id, **fields) -> dict:
+        chat_id = int(chat_id)
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'supergroup' if chat_id < 0 else 'private'},
+            'from': BOT_USER,
+        }
+        message.update({key: value for key, value in fields.items() if value is not None})
+        return message
+
+    def _result(self, method: str, params: dict):
+        if method == 'getMe':
+            return BOT_USER
+        if method == 'sendMessage':
+            return self._message(params['chat_id'], text=params.get('text', ''))
+        if method == 'copyMessage':
+            return {'message_id': next(self._message_ids)}
+        if method == 'copyMessages':
+            return [{'message_id': next(self._message_ids)} for _ in json.loads(params['message_ids'])]
+        if method == 'sendMediaGroup':
+            return [
+                self._message(params['chat_id'], caption=item.get('caption'))
+                for item in json.loads(params['media'])
+            ]
+        if method.startswith('send'):
+            return self._message(params['chat_id'], caption=params.get('caption'))
+        return True
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        params = dict(await request.post())
+        self.calls.append((method, params))
+
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + self._rng.random() * self.jitter)
+
+        if method != 'getMe':
+            roll = self._rng.random()
+            if roll < self.retry_after_rate:
+                self.faults['retry_after'] += 1
+                return web.json_response({
+                    'ok': False, 'error_code': 429,
+                    'description': f"Too Many Requests: retry after {self.retry_after}",
+                    'parameters': {'retry_after': self.retry_after},
+                }, status=429)
+            if roll < self.retry_after_rate + self.error_rate:
+                self.faults['server_error'] += 1
+                return web.json_response(
+                    {'ok': False, 'error_code': 502, 'description': 'Bad Gateway'}, status=502
+                )
+
+        self.counts[method] += 1
+        return web.json_response({'ok': True, 'result': self._result(method, params)})
+
+
+async def serve(args):
+    api = FakeBotAPI(
+        latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+        retry_after_rate=args.retry_after_rate, retry_after=args.retry_after,
+        error_rate=args.error_rate,
+    )
+    url = await api.start(args.host, args.port)
+    print(f"Fake Bot API listening on {url} (Ctrl+C to stop)")
+    try:
+        while True:
+            await asyncio.sleep(10)
+            if api.counts:
+                print(dict(api.counts), dict(api.faults))
+    finally:
+        await api.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1', help='Listen address')
+    parser.add_argument('--port', type=int, default=8081, help='Listen port')
+    parser.add_argument('--latency-ms', type=float, default=0, help='Fixed latency per call')
+    parser.add_argument('--jitter-ms', type=float, default=0, help='Random extra latency per call')
+    parser.add_argument('--retry-after-rate', type=float, default=0, help='Fraction of calls answered with 429')
+    parser.add_argument('--retry-after', type=int, default=1, help='retry_after seconds in 429 answers')
+    parser.add_argument('--error-rate', type=float, default=0, help='Fraction of calls answered with 502')
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Local webhook stub
+POSTs synthetic Telegram updates to a bot running in webhook mode, the same
+way Telegram does (JSON body + X-Telegram-Bot-Api-Secret-Token header).
+
+Start the bot locally without registering the webhook:
+    BOT_MODE=webhook WEBHOOK_SECRET=dev-secret WEBHOOK_REGISTER=0 python bot.py
+
+Then post updates:
+    python tools/post_update.py --secret dev-secret --chat-id -100123 --text "@your_bot help"
+    python tools/post_update.py --secret dev-secret --chat-id -100123 --text "hi" --count 50 --concurrency 10
+    python tools/post_update.py --health
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import sys
+import time
+
+import aiohttp
+
+_update_ids = itertools.count(int(time.time()))
+_message_ids = itertools.count(1)
+
+
+def build_update(chat_id: int, user_id: int, username: str, text: str,
+                 reply_to: int = None, chat_title: str = 'Local test group') -> dict:
+    """Build a minimal group message update"""
+    message = {
+        'message_id': next(_message_ids),
+        'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'supergroup', 'title': chat_title},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': username, 'username': username},
+        'text': text,
+    }
+    if text.startswith('/'):
+        command = text.split()[0]
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+    if reply_to:
+        message['reply_to_message'] = {
+            'message_id': reply_to,
+            'date': int(time.time()),
+            'chat': message['chat'],
+            'from': {'id': 1, 'is_bot': True, 'first_name': 'bot', 'username': 'bot'},
+            'text': 'Ticket #0',
+        }
+    return {'update_id': next(_update_ids), 'message': message}
+
+
+async def post_updates(args):
+    url = args.url.rstrip('/') + args.path
+    headers = {'X-Telegram-Bot-Api-Secret-Token': args.secret} if args.secret else {}
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies = []
+
+    async def post_one(session: aiohttp.ClientSession, index: int):
+        text = args.text if args.count == 1 else f"{args.text} #{index + 1}"
+        update = build_update(args.chat_id, args.user_id, args.username, text, args.reply_to)
+        async with semaphore:
+            start = time.perf_counter()
+            async with session.post(url, json=update, headers=headers) as response:
+                await response.read()
+                latencies.append(time.perf_counter() - start)
+                if response.status != 200:
+                    print(f"update {update['update_id']}: HTTP {response.status}", file=sys.stderr)
+
+    async with aiohttp.ClientSession() as session:
+        started = time.perf_counter()
+        await asyncio.gather(*(post_one(session, i) for i in range(args.count)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    print(
+        f"Posted {args.count} updates in {elapsed:.2f}s "
+        f"(p50 {latencies[len(latencies) // 2] * 1000:.1f} ms, max {latencies[-1] * 1000:.1f} ms)"
+    )
+
+
+async def check_health(args):
+    async with aiohttp.ClientSession() as session:
+        async with session.get(args.url.rstrip('/') + '/healthz') as response:
+            print(response.status, json.dumps(await response.json(), ensure_ascii=False))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://127.0.0.1:8080', help='Bot server base URL')
+    parser.add_argument('--path', default='/telegram/webhook', help='Webhook path (WEBHOOK_PATH)')
+    parser.add_argument('--secret', default='', help='Secret token (WEBHOOK_SECRET)')
+    parser.add_argument('--chat-id', type=int, default=-1000000000001, help='Chat ID of the message')
+    parser.add_argument('--user-id', type=int, default=10001, help='Sender user ID')
+    parser.add_argument('--username', default='local_tester', help='Sender username')
+    parser.add_argument('--text', default='/ask local webhook test', help='Message text')
+    parser.add_argument('--reply-to', type=int, default=None, help='Message ID the update replies to')
+    parser.add_argument('--count', type=int, default=1, help='Number of updates to post')
+    parser.add_argument('--concurrency', type=int, default=1, help='Parallel requests')
+    parser.add_argument('--health', action='store_true', help='Only query /healthz')
+    args = parser.parse_args()
+
+    asyncio.run(check_health(args) if args.health else post_updates(args))
+
+
+if __name__ == '__main__':
+    main()